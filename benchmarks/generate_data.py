@@ -0,0 +1,245 @@
+"""Synthetic catalogue following create.sql, generated inside PostgreSQL.
+
+Rows are produced with INSERT ... SELECT generate_series, so nothing is
+shipped over the wire and 10M songs take minutes. Ids continue after the
+existing rows and sequences are resynced afterwards. Run against a
+scratch database with create.sql and all migrations applied:
+
+    python benchmarks/generate_data.py --scale 10k     # 10k / 1m / 10m songs
+
+Every generated user has the password ``benchmark`` and the email
+``bench<username>@example.com``. Basic users get about 20 friendships
+each (3.4M ``friendship`` rows at 1m) when migration 0008 is applied.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+
+import psycopg2
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash
+
+import db
+
+SCALES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+PASSWORD = 'benchmark'
+SONGS_PER_PLAYLIST = 20
+FRIENDS_PER_USER = 10  # picks per basic user, stored in both directions: ~20 friendships each
+
+GENRES = ['rock', 'pop', 'jazz', 'metal', 'hip-hop', 'folk', 'techno', 'blues', 'classical', 'punk']
+WORDS = ['love', 'night', 'summer', 'dream', 'fire', 'heart', 'rain', 'city',
+         'blue', 'river', 'moon', 'dance', 'electric', 'golden', 'shadow', 'wild']
+COUNTRIES = [('Czech Republic', 'CZ', 'Prague'), ('Czech Republic', 'CZ', 'Brno'), ('UK', 'UK', 'London'),
+             ('Germany', 'DE', 'Berlin'), ('France', 'FR', 'Paris'), ('United States', 'US', 'Boston'),
+             ('Greece', 'GR', 'Athens'), ('Portugal', 'PT', 'Lisbon'), ('China', 'CN', 'Shanghai')]
+
+SEQUENCES = [
+    ('users', 'username'), ('location', 'location_id'), ('song', 'song_id'), ('event', 'event_id'),
+    ('playlist', 'playlist_id'), ('merchandise_product', 'product_id'), ('public_channel', 'channel_id'),
+]
+
+# Each statement gets %(u0)s etc. (ids before generation) and the row counts below.
+# "Random" picks use multiplicative hashing so runs are reproducible.
+STEPS = [
+    ('users', '''
+        INSERT INTO users (username, full_name, mobile_phone, email, links_media, password_hash)
+        SELECT %(u0)s + g, 'Bench User ' || g, '+420' || lpad(g::text, 9, '0'),
+               'bench' || (%(u0)s + g) || '@example.com', NULL, %(password_hash)s
+        FROM generate_series(1::bigint, %(users)s) g
+    '''),
+    ('manager_user', '''
+        INSERT INTO manager_user (username, role_for_artist, tasks)
+        SELECT %(u0)s + %(artists)s + g, 'manager', 'booking'
+        FROM generate_series(1::bigint, %(managers)s) g
+    '''),
+    ('artist_user', '''
+        INSERT INTO artist_user (username, manager_user_username, discography, biography, genre)
+        SELECT %(u0)s + g, %(u0)s + %(artists)s + 1 + (g * 7919) %% %(managers)s,
+               g || ' albums', 'Biography of artist ' || g, (%(genres)s::text[])[1 + g %% %(n_genres)s]
+        FROM generate_series(1::bigint, %(artists)s) g
+    '''),
+    ('content_moderator_user', '''
+        INSERT INTO content_moderator_user (username, tasks, moderation_history)
+        SELECT %(u0)s + %(artists)s + %(managers)s + g, 'review', ''
+        FROM generate_series(1::bigint, %(moderators)s) g
+    '''),
+    ('basic_user', '''
+        INSERT INTO basic_user (username, birth_date, preferences, subscription_type)
+        SELECT %(u0)s + %(artists)s + %(managers)s + %(moderators)s + g,
+               DATE '1970-01-01' + ((g * 37) %% 15000)::int, 'music', 'free'
+        FROM generate_series(1::bigint, %(basics)s) g
+    '''),
+    ('location', '''
+        INSERT INTO location (location_id, country, region, city, address)
+        SELECT %(l0)s + g, c[k][1], c[k][2], c[k][3], g || ' Bench Street'
+        FROM generate_series(1::bigint, %(locations)s) g,
+             (SELECT %(countries)s::text[] AS c) a,
+             LATERAL (SELECT 1 + g %% %(n_countries)s AS k) x
+    '''),
+    ('song', '''
+        INSERT INTO song (song_id, name, lyrics)
+        SELECT %(s0)s + g,
+               initcap(w[1 + (g * 7) %% n] || ' ' || w[1 + (g * 13) %% n] || ' ' || g),
+               w[1 + (g * 3) %% n] || ' ' || w[1 + (g * 5) %% n] || ' ' || w[1 + (g * 11) %% n]
+        FROM generate_series(1::bigint, %(songs)s) g,
+             (SELECT %(words)s::text[] AS w, %(n_words)s AS n) words
+    '''),
+    ('song_artist_user', '''
+        INSERT INTO song_artist_user (song_id, username)
+        SELECT %(s0)s + g, %(u0)s + 1 + (g * 104729 + k) %% %(artists)s
+        FROM generate_series(1::bigint, %(songs)s) g, generate_series(0, 1) k
+        WHERE k = 0 OR g %% 10 = 0
+        ON CONFLICT DO NOTHING
+    '''),
+    ('event', '''
+        INSERT INTO event (event_id, location_id, description, date, conditions)
+        SELECT %(e0)s + g, %(l0)s + 1 + (g * 31) %% %(locations)s, 'Bench concert ' || g,
+               CURRENT_DATE - 1500 + ((g * 17) %% 3000)::int, '18+'
+        FROM generate_series(1::bigint, %(events)s) g
+    '''),
+    ('event_artist_user', '''
+        INSERT INTO event_artist_user (event_id, username)
+        SELECT %(e0)s + g, %(u0)s + 1 + (g * 7919 + k) %% %(artists)s
+        FROM generate_series(1::bigint, %(events)s) g, generate_series(0, 2) k
+        WHERE k = 0 OR g %% (k + 2) = 0
+        ON CONFLICT DO NOTHING
+    '''),
+    ('playlist', '''
+        INSERT INTO playlist (playlist_id, username, description, link)
+        SELECT %(p0)s + g, %(u0)s + %(artists)s + %(managers)s + %(moderators)s + 1 + (g - 1) %% %(basics)s,
+               'Bench playlist ' || g, 'https://example.com/p/' || g
+        FROM generate_series(1::bigint, %(playlists)s) g
+    '''),
+    ('song_playlist', '''
+        INSERT INTO song_playlist (song_id, playlist_id, position)
+        SELECT %(s0)s + 1 + (g * 31 + j * 997) %% %(songs)s, %(p0)s + g, j + 1
+        FROM generate_series(1::bigint, %(playlists)s) g, generate_series(0, %(per_playlist)s - 1) j
+        ON CONFLICT DO NOTHING
+    '''),
+    # friendship (migration 0008): two rows per pick, self-picks and repeats skipped
+    ('friendship', '''
+        INSERT INTO friendship (username, friend_username)
+        SELECT b0 + e.a, b0 + e.b
+        FROM (SELECT %(u0)s + %(artists)s + %(managers)s + %(moderators)s + 1 AS b0) base,
+             generate_series(0::bigint, %(basics)s - 1) g, generate_series(1, %(friends)s) k,
+             LATERAL (SELECT (g + k * 104729) %% %(basics)s AS f) pick,
+             LATERAL (VALUES (g, pick.f), (pick.f, g)) e(a, b)
+        WHERE e.a <> e.b
+        ON CONFLICT DO NOTHING
+    '''),
+    ('merchandise_product', '''
+        INSERT INTO merchandise_product (product_id, username, product_name, shipping, description,
+                                         product_price, availibility)
+        SELECT %(m0)s + g, %(u0)s + 1 + g %% %(artists)s, 'Bench T-shirt ' || g, 'worldwide',
+               NULL, 5 + (g * 13) %% 95, g %% 4 <> 0
+        FROM generate_series(1::bigint, %(merch)s) g
+    '''),
+    ('public_channel', '''
+        INSERT INTO public_channel (channel_id, channel_name, username, location_id, description,
+                                    preferred_genre, link)
+        SELECT %(c0)s + g, 'Bench channel ' || g, %(u0)s + %(artists)s + %(managers)s + 1 + g %% %(moderators)s,
+               %(l0)s + 1 + g %% %(locations)s, 'Channel ' || g,
+               (%(genres)s::text[])[1 + g %% %(n_genres)s], 'https://example.com/c/' || g
+        FROM generate_series(1::bigint, %(channels)s) g
+    '''),
+]
+
+
+def plan(songs):
+    """Row counts for a catalogue of ``songs`` songs"""
+    users = max(songs // 5, 100)
+    artists = max(users // 10, 10)
+    managers = max(users // 30, 2)
+    moderators = max(users // 50, 2)
+    basics = users - artists - managers - moderators
+    return {
+        'songs': songs, 'users': users, 'artists': artists, 'managers': managers,
+        'moderators': moderators, 'basics': basics, 'locations': max(songs // 1000, 50),
+        'events': max(songs // 10, 10), 'playlists': basics, 'per_playlist': SONGS_PER_PLAYLIST,
+        'merch': artists * 2, 'channels': moderators, 'friends': FRIENDS_PER_USER,
+    }
+
+
+def next_ids(cur):
+    ids = {}
+    for key, (table, column) in zip(['u0', 'l0', 's0', 'e0', 'p0', 'm0', 'c0'], SEQUENCES):
+        cur.execute(f'SELECT COALESCE(MAX({column}), 0) AS max_id FROM {table}')
+        ids[key] = cur.fetchone()[0]
+    return ids
+
+
+def resync_sequences(cur):
+    for table, column in SEQUENCES:
+        cur.execute(f'''
+            SELECT setval(pg_get_serial_sequence('{table}', '{column}'),
+                          GREATEST((SELECT MAX({column}) FROM {table}), 1))
+        ''')
+
+
+def generate(conn, songs, verbose=True):
+    params = plan(songs)
+    cur = conn.cursor()
+    params.update(next_ids(cur))
+    params.update({
+        'password_hash': generate_password_hash(PASSWORD),
+        'genres': GENRES, 'n_genres': len(GENRES),
+        'words': WORDS, 'n_words': len(WORDS),
+        'countries': [list(c) for c in COUNTRIES], 'n_countries': len(COUNTRIES),
+    })
+    # tables of migrations that are not applied are skipped
+    steps = []
+    for table, sql in STEPS:
+        cur.execute('SELECT to_regclass(%s) IS NOT NULL', (table,))
+        if cur.fetchone()[0]:
+            steps.append((table, sql))
+    # Row triggers (search documents, summaries, counters) are rebuilt once at the end instead
+    for table, _ in steps:
+        cur.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+    for table, sql in steps:
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        if verbose:
+            print(f'{table:<24}{cur.rowcount:>12} rows {time.perf_counter() - start:>8.1f}s')
+    for table, _ in steps:
+        cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+    resync_sequences(cur)
+    cur.execute("SELECT 1 FROM pg_proc WHERE proname = 'search_rebuild'")
+    if cur.fetchone():
+        cur.execute('SELECT search_rebuild()')
+    cur.execute("SELECT 1 FROM pg_proc WHERE proname = 'catalogue_summary_rebuild'")
+    if cur.fetchone():
+        cur.execute('SELECT catalogue_summary_rebuild()')
+    cur.execute("SELECT 1 FROM pg_proc WHERE proname = 'moderator_channel_rebuild'")
+    if cur.fetchone():
+        cur.execute('SELECT moderator_channel_rebuild()')
+    cur.execute("SELECT 1 FROM pg_proc WHERE proname = 'install_table_counter'")
+    if cur.fetchone():
+        for table in ('users', 'artist_user', 'song', 'event'):
+            cur.execute('SELECT install_table_counter(%s)', (table,))
+    conn.commit()
+
+    cur.execute('ANALYZE')
+    conn.commit()
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', default='10k', help='10k, 1m, 10m or a song count')
+    args = parser.parse_args()
+    songs = SCALES.get(args.scale.lower()) or int(args.scale)
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    conn.autocommit = False
+    start = time.perf_counter()
+    generate(conn, songs)
+    conn.close()
+    print(f'done in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""asyncio load driver for the Flask routes, with comparable JSON reports.
+
+    python benchmarks/load_test.py run --base-url http://127.0.0.1:5000 --users 50 --duration 60
+    python benchmarks/load_test.py compare results/abc123.json results/def456.json
+
+``run`` samples artist and playlist ids from the database in .env (seed it
+with generate_data.py first), drives the routes below with ``--users``
+concurrent keep-alive clients and writes p50/p95/p99 latency and throughput
+per route to ``results/<commit>.json``. ``compare`` exits non-zero when a
+route's p95 got slower than ``--threshold`` (default 10%).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+PASSWORD = 'benchmark'  # generate_data.PASSWORD
+
+# route name -> weight; names with <...> are filled from the sampled ids
+ROUTES = {
+    '/': 10,
+    '/songs': 10,
+    '/artists': 8,
+    '/artist/<username>': 10,
+    '/events': 8,
+    '/playlist/<playlist_id>': 5,
+    'POST /login': 2,
+}
+
+
+class HttpClient:
+    """Minimal HTTP/1.1 keep-alive client with a cookie jar"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookies = {}
+        self._reader = self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def request(self, method, path, form=None):
+        if self._writer is None:
+            await self._connect()
+        body = urlencode(form).encode() if form else b''
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive']
+        if self.cookies:
+            lines.append('Cookie: ' + '; '.join(f'{k}={v}' for k, v in self.cookies.items()))
+        if form:
+            lines += ['Content-Type: application/x-www-form-urlencoded', f'Content-Length: {len(body)}']
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError('server closed the connection')
+        version, status = status_line.decode().split()[:2]
+        headers = {}
+        while True:
+            line = (await self._reader.readline()).decode().rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name = name.lower()
+            if name == 'set-cookie':
+                cookie = value.strip().split(';', 1)[0]
+                key, _, val = cookie.partition('=')
+                self.cookies[key] = val
+            headers[name] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self._reader.readline()).split(b';')[0], 16)
+                await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            await self._reader.readexactly(int(headers['content-length']))
+        else:
+            await self._reader.read()
+            self.close()
+
+        if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+            self.close()
+        return int(status)
+
+
+def sample_ids(limit=200):
+    """Artist ids, playlist ids and login emails of generated basic users"""
+    import psycopg2
+    from dotenv import load_dotenv
+    import db
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    cur = conn.cursor()
+    cur.execute('SELECT username FROM artist_user ORDER BY random() LIMIT %s', (limit,))
+    artists = [row[0] for row in cur.fetchall()]
+    cur.execute('''
+        SELECT p.playlist_id, u.email
+        FROM playlist p JOIN users u ON u.username = p.username
+        WHERE u.email LIKE 'bench%%@example.com'
+        ORDER BY random() LIMIT %s
+    ''', (limit,))
+    playlists = cur.fetchall()
+    conn.close()
+    if not artists or not playlists:
+        raise SystemExit('no generated data found; run benchmarks/generate_data.py first')
+    return artists, playlists
+
+
+async def virtual_user(base, ids, deadline, samples, errors):
+    artists, playlists = ids
+    playlist_id, email = random.choice(playlists)
+    client = HttpClient(base.hostname, base.port or 80)
+    names, weights = list(ROUTES), list(ROUTES.values())
+    try:
+        await client.request('POST', '/login', {'email': email, 'password': PASSWORD})
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            if name == 'POST /login':
+                method, path, form = 'POST', '/login', {'email': email, 'password': PASSWORD}
+            else:
+                method, form = 'GET', None
+                path = (name.replace('<username>', str(random.choice(artists)))
+                            .replace('<playlist_id>', str(playlist_id)))
+            start = time.perf_counter()
+            try:
+                status = await client.request(method, path, form)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                client.close()
+                errors[name] = errors.get(name, 0) + 1
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+            if status >= 400:
+                errors[name] = errors.get(name, 0) + 1
+            else:
+                samples.setdefault(name, []).append(elapsed)
+    finally:
+        client.close()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 2)
+
+
+def summarize(samples, errors, duration):
+    routes = {}
+    for name in ROUTES:
+        values = sorted(samples.get(name, []))
+        routes[name] = {
+            'count': len(values),
+            'errors': errors.get(name, 0),
+            'rps': round(len(values) / duration, 2),
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+        }
+    return routes
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def run(args):
+    base = urlsplit(args.base_url)
+    ids = sample_ids()
+    samples, errors = {}, {}
+    start = time.monotonic()
+    deadline = start + args.duration
+    await asyncio.gather(*(virtual_user(base, ids, deadline, samples, errors) for _ in range(args.users)))
+    duration = time.monotonic() - start
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'base_url': args.base_url,
+        'users': args.users,
+        'duration_s': round(duration, 1),
+        'routes': summarize(samples, errors, duration),
+    }
+    print(f"{'route':<26}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}")
+    for name, r in report['routes'].items():
+        print(f"{name:<26}{r['rps']:>9}{r['p50_ms'] or '-':>9}{r['p95_ms'] or '-':>9}"
+              f"{r['p99_ms'] or '-':>9}{r['errors']:>8}")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'report written to {out}')
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{'route':<26}{'p95 before':>12}{'p95 after':>12}{'change':>9}")
+    regressions = 0
+    for name, new in after['routes'].items():
+        old = before['routes'].get(name)
+        if not old or not old['p95_ms'] or not new['p95_ms']:
+            continue
+        change = new['p95_ms'] / old['p95_ms'] - 1
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:<26}{old['p95_ms']:>12}{new['p95_ms']:>12}{change:>+9.0%}{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run')
+    run_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--users', type=int, default=20)
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--out')
+    compare_parser = sub.add_parser('compare')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        asyncio.run(run(args))
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
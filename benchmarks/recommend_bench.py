@@ -0,0 +1,197 @@
+"""Song recommendation benchmark: batch top-K build and incremental recompute.
+
+    python benchmarks/recommend_bench.py [--playlists 1000000] [--songs 100000] [--top-k 20] [--queued 500]
+
+Generates synthetic playlists (Zipf-like song popularity, 5-25 songs each)
+in memory and times, with the functions recommend.py uses:
+
+* building the sparse song x playlist matrix,
+* the full top-K neighbour computation (blocked sparse products),
+* an incremental recompute after one playlist changed, and the drain of a
+  queue of ``--queued`` changed playlists in the batches recommend.refresh()
+  would take (the rows its neighbourhood query returns are cut out with
+  NumPy beforehand and not timed),
+* the naive form on a sample of the playlists: counting every song pair
+  of every playlist in Python dicts, against the same vectorized build.
+
+No database is needed; reading song_playlist with COPY and writing the
+neighbour rows come on top of the numbers.
+"""
+import argparse
+import collections
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+
+import numpy as np
+
+import recommend
+
+
+def generate_pairs(playlists, songs, seed=42):
+    """(n, 2) array of distinct (song_id, playlist_id) pairs"""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(5, 26, size=playlists)
+    weights = 1.0 / np.arange(1, songs + 1) ** 0.9
+    song_ids = rng.choice(songs, size=int(lengths.sum()), p=weights / weights.sum()) + 1
+    playlist_ids = np.repeat(np.arange(1, playlists + 1), lengths)
+    return np.unique(np.stack([song_ids, playlist_ids], axis=1), axis=0)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def full_build(matrix, top_k, block_size):
+    return sum(1 for _ in recommend.top_neighbours(matrix, top_k=top_k, block_size=block_size))
+
+
+class Index:
+    """song_playlist sorted by playlist and by song, standing in for its two indexes"""
+
+    def __init__(self, pairs, totals):
+        self.totals = totals
+        self.by_playlist = pairs[np.argsort(pairs[:, 1], kind='stable')]
+        self.by_song = pairs[np.argsort(pairs[:, 0], kind='stable')]
+        self.playlist_start = np.searchsorted(self.by_playlist[:, 1], np.arange(pairs[:, 1].max() + 2))
+        self.song_start = np.searchsorted(self.by_song[:, 0], np.arange(pairs[:, 0].max() + 2))
+
+    def songs(self, playlist_ids):
+        return np.unique(np.concatenate(
+            [self.by_playlist[self.playlist_start[p]:self.playlist_start[p + 1], 0] for p in playlist_ids]))
+
+    def playlists(self, song_ids):
+        return np.unique(np.concatenate(
+            [self.by_song[self.song_start[s]:self.song_start[s + 1], 1] for s in song_ids] + [[]])).astype(np.int64)
+
+    def rows(self, playlist_ids):
+        return np.concatenate([self.by_playlist[self.playlist_start[p]:self.playlist_start[p + 1]]
+                               for p in playlist_ids] + [np.empty((0, 2), dtype=np.int64)])
+
+
+def neighbourhood(index, playlist_ids, cap):
+    """The changed songs and the rows recommend.refresh() reads for ``playlist_ids``"""
+    changed = index.songs(playlist_ids)
+    changed = changed[index.totals[changed] <= cap]
+    playlists = index.playlists(changed)
+    return changed, playlists, index.rows(playlists)
+
+
+def drain(index, queue, cap, mean_length, top_k):
+    """Process ``queue`` like NeighbourRefresher.run_once(); one entry per committed batch"""
+    batches = []
+    retries = 0
+    batch = recommend.REFRESH_BATCH
+    while queue:
+        playlist_ids = queue[:batch]
+        changed, playlists, local = neighbourhood(index, playlist_ids, cap)
+        if len(playlist_ids) > 1 and len(changed) and len(playlists) * mean_length > recommend.REFRESH_MAX_ROWS:
+            retries += 1
+            batch = len(playlist_ids) // 2
+            continue
+        _, seconds = timed(incremental, changed, local, index.totals, top_k) if len(changed) else (0, 0.0)
+        batches.append((len(playlist_ids), len(changed), len(local), seconds))
+        queue = queue[len(playlist_ids):]
+        batch = min(recommend.REFRESH_BATCH, 2 * len(playlist_ids))
+    return batches, retries
+
+
+def incremental(changed, local, totals, top_k):
+    """What recommend.refresh() computes from those rows"""
+    matrix, song_ids = recommend.incidence_matrix(local)
+    rows = np.flatnonzero(np.isin(song_ids, changed))
+    return sum(1 for _ in recommend.top_neighbours(matrix, rows=rows, counts=totals[song_ids], top_k=top_k))
+
+
+def naive(pairs, top_k):
+    """Pair counts in dicts, then cosine and a sort per song"""
+    by_playlist = collections.defaultdict(list)
+    for song_id, playlist_id in pairs.tolist():
+        by_playlist[playlist_id].append(song_id)
+    together = collections.defaultdict(collections.Counter)
+    counts = collections.Counter()
+    for songs in by_playlist.values():
+        counts.update(songs)
+        for a in songs:
+            for b in songs:
+                if a != b:
+                    together[a][b] += 1
+    result = {}
+    for a, row in together.items():
+        scores = [(shared / math.sqrt(counts[a] * counts[b]), b) for b, shared in row.items()]
+        scores.sort(reverse=True)
+        result[a] = scores[:top_k]
+    return len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--playlists', type=int, default=1_000_000)
+    parser.add_argument('--songs', type=int, default=100_000)
+    parser.add_argument('--top-k', type=int, default=recommend.TOP_K)
+    parser.add_argument('--block-size', type=int, default=recommend.BLOCK_SIZE)
+    parser.add_argument('--naive-playlists', type=int, default=20_000)
+    parser.add_argument('--changes', type=int, default=20, help='incremental recomputes to average')
+    parser.add_argument('--queued', type=int, default=500, help='changed playlists for the queue drain')
+    args = parser.parse_args()
+
+    pairs, seconds = timed(generate_pairs, args.playlists, args.songs)
+    print(f'{len(pairs)} song_playlist rows, {args.playlists} playlists, {args.songs} songs '
+          f'(generated in {seconds:.1f}s)')
+    print()
+
+    (matrix, song_ids), build_matrix = timed(recommend.incidence_matrix, pairs)
+    songs, top_k = timed(full_build, matrix, args.top_k, args.block_size)
+    print(f"{'full build':<44}{'s':>10}")
+    print(f"{'  sparse matrix':<44}{build_matrix:>10.2f}")
+    print(f"{'  top-' + str(args.top_k) + ' neighbours of ' + str(songs) + ' songs':<44}{top_k:>10.2f}")
+
+    totals = np.zeros(int(song_ids.max()) + 1, dtype=np.int64)
+    totals[song_ids] = matrix.getnnz(axis=1)
+    mean_length = len(pairs) / args.playlists
+    cap = recommend.refresh_cap(mean_length)
+    index = Index(pairs, totals)
+    capped = song_ids[totals[song_ids] > cap]
+    print()
+    print(f'incremental: songs in more than {cap} playlists ({len(capped)} songs, '
+          f'{totals[capped].sum() / len(pairs):.0%} of the rows) are left to the full build')
+    rng = np.random.default_rng(7)
+    samples = []
+    for playlist_id in rng.integers(1, args.playlists + 1, size=args.changes):
+        changed, _, local = neighbourhood(index, [playlist_id], cap)
+        recomputed, seconds = timed(incremental, changed, local, totals, args.top_k)
+        samples.append((seconds, recomputed, len(local)))
+    print(f"{'one changed playlist (median)':<44}{'ms':>10}")
+    print(f"{'  recompute':<44}{np.median([s[0] for s in samples]) * 1000:>10.1f}")
+    print(f"{'  songs recomputed':<44}{np.median([s[1] for s in samples]):>10.0f}")
+    print(f"{'  song_playlist rows read':<44}{np.median([s[2] for s in samples]):>10.0f}")
+
+    queue = [int(p) for p in rng.choice(args.playlists, size=args.queued, replace=False) + 1]
+    batches, retries = drain(index, queue, cap, mean_length, args.top_k)
+    rows = np.array([b[2] for b in batches])
+    print(f"{str(args.queued) + ' queued playlists':<44}")
+    print(f"{'  batches (halvings)':<44}{len(batches):>10}  ({retries})")
+    print(f"{'  playlists per batch (median)':<44}{np.median([b[0] for b in batches]):>10.0f}")
+    print(f"{'  rows read per batch (median / max)':<44}{np.median(rows):>10.0f}  / {rows.max()}")
+    print(f"{'  rows read in total':<44}{rows.sum():>10}  ({rows.sum() / len(pairs):.0%} of song_playlist)")
+    print(f"{'  songs recomputed':<44}{sum(b[1] for b in batches):>10}")
+    print(f"{'  recompute, s':<44}{sum(b[3] for b in batches):>10.2f}")
+
+    sample = pairs[pairs[:, 1] <= args.naive_playlists]
+    _, naive_seconds = timed(naive, sample, args.top_k)
+    (small, _), matrix_seconds = timed(recommend.incidence_matrix, sample)
+    _, vector_seconds = timed(full_build, small, args.top_k, args.block_size)
+    vectorized = matrix_seconds + vector_seconds
+    print()
+    print(f"{'naive vs vectorized, ' + str(args.naive_playlists) + ' playlists':<44}{'s':>10}")
+    print(f"{'  Python pair counting':<44}{naive_seconds:>10.2f}")
+    print(f"{'  sparse matrix products':<44}{vectorized:>10.2f}  ({naive_seconds / vectorized:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
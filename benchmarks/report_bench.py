@@ -0,0 +1,119 @@
+"""main.xml reports: the queries as written there vs. reports.py vs. the views.
+
+    python benchmarks/report_bench.py --scale 1m [--repeat 5] [--param artist='Bench User 7']
+
+Generates a catalogue with generate_data.py (``--scale 0`` uses the data
+already in the database), refreshes the materialized views of migration
+0009 and times every report in its three forms: ``naive_sql`` (main.xml),
+``sql`` (what the app runs) and ``view_sql`` where there is one. Run it
+against a scratch database with create.sql and all migrations applied.
+
+The main.xml parameters (Chanel123, Hannah Jackson, Pink hoodie, Push it)
+do not exist in generated data; unless given with ``--param`` they are
+replaced by values picked from the generated rows.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+import db
+import generate_data
+import reports
+
+# one existing value per parameter, from rows that make the reports return something
+PICK_SQL = {
+    'artist': '''
+        SELECT u.full_name AS value
+        FROM event_artist_user ea JOIN users u ON u.username = ea.username
+        GROUP BY u.full_name ORDER BY COUNT(*) DESC LIMIT 1
+    ''',
+    'song': '''
+        SELECT s.name AS value
+        FROM song_playlist sp JOIN song s ON s.song_id = sp.song_id
+        GROUP BY s.name ORDER BY COUNT(*) DESC LIMIT 1
+    ''',
+    'product': 'SELECT product_name AS value FROM merchandise_product ORDER BY product_id DESC LIMIT 1',
+    'channel': '''
+        SELECT only_channel_name AS value
+        FROM moderator_channel
+        WHERE only_channel_name IS NOT NULL
+        ORDER BY username DESC LIMIT 1
+    ''',
+}
+
+
+def pick_params(conn, given):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    params = dict(given)
+    for name, sql in PICK_SQL.items():
+        if name not in params:
+            cur.execute(sql)
+            row = cur.fetchone()
+            if row:
+                params[name] = row['value']
+    return params
+
+
+def timed(report, conn, params, repeat, **form):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = report.run(conn, params, limit=reports.MAX_LIMIT, **form)
+        samples.append((time.perf_counter() - start) * 1000)
+    conn.rollback()
+    return statistics.median(samples), len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', default='0', help='10k, 1m, 10m or a song count (0 = use existing data)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='report parameter (channel, city, artist, song, product)')
+    args = parser.parse_args()
+    songs = generate_data.SCALES.get(args.scale.lower()) or int(args.scale)
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    if songs:
+        start = time.perf_counter()
+        generate_data.generate(conn, songs, verbose=False)
+        print(f'generated {songs} songs in {time.perf_counter() - start:.1f}s')
+
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.execute('SELECT report_refresh(make_interval(secs => 0))')
+    refreshed = cur.fetchone()[0]
+    conn.commit()
+    print(f'refreshed {refreshed} materialized views in {time.perf_counter() - start:.1f}s')
+
+    params = pick_params(conn, (p.split('=', 1) for p in args.param))
+    print('parameters: ' + ', '.join(f'{k}={v!r}' for k, v in sorted(params.items())))
+    print()
+    print(f"{'report':<26}{'main.xml ms':>13}{'reports ms':>12}{'view ms':>10}{'rows':>8}")
+    for name, report in reports.REPORTS.items():
+        naive, naive_rows = timed(report, conn, params, args.repeat, naive=True)
+        optimized, rows = timed(report, conn, params, args.repeat)
+        counts = [naive_rows, rows]
+        view = '-'
+        if report.view_sql:
+            view_ms, view_rows = timed(report, conn, params, args.repeat, use_views=True)
+            view = f'{view_ms:.1f}'
+            counts.append(view_rows)
+        # differing counts (main.xml/reports/view) mean a stale view or a wrong rewrite
+        rows = str(rows) if len(set(counts)) == 1 else '/'.join(map(str, counts))
+        print(f'{name:<26}{naive:>13.1f}{optimized:>12.1f}{view:>10}{rows:>8}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Naive ILIKE search vs. search_document (full-text + trigram).
+
+Generates songs server-side with generate_series, rebuilds search_document
+and times both search forms for a fixed set of terms. Run it against a
+scratch database that has create.sql and all migrations applied:
+
+    python benchmarks/search_bench.py --songs 1000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+import db
+import search
+
+WORDS = ['love', 'night', 'summer', 'dream', 'fire', 'heart', 'rain', 'city',
+         'blue', 'river', 'moon', 'dance', 'electric', 'golden', 'shadow', 'wild']
+
+TERMS = ['love', 'summer night', 'electrc', 'golden riv', 'moon dance', 'xyzzy']
+
+GENERATE_SONGS_SQL = '''
+    INSERT INTO song (name, lyrics)
+    SELECT initcap(w[1 + (g * 7) %% n] || ' ' || w[1 + (g * 13) %% n] || ' ' || (g %% 1000)),
+           w[1 + (g * 3) %% n] || ' ' || w[1 + (g * 5) %% n] || ' ' || w[1 + (g * 11) %% n]
+    FROM generate_series(1, %(count)s) AS g,
+         (SELECT %(words)s::text[] AS w, %(n)s AS n) words
+'''
+
+# the four-query ILIKE search that used to live in app.py, against the real columns
+NAIVE_QUERIES = [
+    '''SELECT u.username, au.genre, au.biography
+       FROM users u JOIN artist_user au ON u.username = au.username
+       WHERE u.full_name ILIKE %(p)s OR au.genre ILIKE %(p)s OR au.biography ILIKE %(p)s''',
+    '''SELECT s.song_id, s.name FROM song s WHERE s.name ILIKE %(p)s''',
+    '''SELECT e.event_id, e.description FROM event e WHERE e.description ILIKE %(p)s''',
+    '''SELECT p.playlist_id, p.description FROM playlist p WHERE p.description ILIKE %(p)s''',
+]
+
+
+def naive_search(conn, text):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    rows = []
+    for sql in NAIVE_QUERIES:
+        cur.execute(sql, {'p': f'%{text}%'})
+        rows.extend(cur.fetchall())
+    return rows
+
+
+def generate(conn, count):
+    cur = conn.cursor()
+    cur.execute('ALTER TABLE song DISABLE TRIGGER USER')
+    cur.execute(GENERATE_SONGS_SQL, {'count': count, 'words': WORDS, 'n': len(WORDS)})
+    cur.execute('ALTER TABLE song ENABLE TRIGGER USER')
+    cur.execute('SELECT search_rebuild()')
+    cur.execute('ANALYZE song')
+    cur.execute('ANALYZE search_document')
+    conn.commit()
+
+
+def timed(fn, conn, text, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(conn, text)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=1_000_000, help='songs to generate (0 = use existing data)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    if args.songs:
+        start = time.perf_counter()
+        generate(conn, args.songs)
+        print(f'generated {args.songs} songs in {time.perf_counter() - start:.1f}s')
+
+    print(f"{'term':<16}{'naive p50 ms':>14}{'search p50 ms':>15}{'naive rows':>12}{'top hit':>30}")
+    for term in TERMS:
+        naive, naive_rows = timed(naive_search, conn, term, args.repeat)
+        ranked, (hits, _) = timed(lambda c, t: search.search(c, t), conn, term, args.repeat)
+        top = hits[0]['title'] if hits else '-'
+        print(f'{term:<16}{statistics.median(naive):>14.1f}{statistics.median(ranked):>15.1f}'
+              f'{len(naive_rows):>12}{top[:28]:>30}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
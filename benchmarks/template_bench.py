@@ -0,0 +1,94 @@
+"""Template startup and render benchmark.
+
+    python benchmarks/template_bench.py [--rows 50] [--renders 2000]
+
+Compares, for every template under web-app/templates:
+
+* cold start without a bytecode cache (parse + compile everything),
+* cold start from the on-disk bytecode cache (templating.py),
+
+and the per-render cost of songs/list.html and events/list.html with
+auto_reload on (the file is stat()ed on every lookup) and off. No database
+is needed; rows are synthetic.
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web-app'))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from jinja2 import FileSystemBytecodeCache
+
+import pagination
+import templating
+from app import app
+
+
+def fresh_env(bytecode_dir=None, auto_reload=False):
+    env = app.create_jinja_environment()
+    env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else None
+    env.auto_reload = auto_reload
+    return env
+
+
+def cold_start(bytecode_dir, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        _, seconds = templating.compile_all(fresh_env(bytecode_dir))
+        best = min(best, seconds)
+    return best
+
+
+def render_cost(env, name, path, context, renders):
+    with app.test_request_context(path):
+        ctx = dict(context)
+        app.update_template_context(ctx)
+        env.get_template(name).render(ctx)  # compile outside the timing
+        start = time.perf_counter()
+        for _ in range(renders):
+            env.get_template(name).render(ctx)
+        return (time.perf_counter() - start) / renders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--renders', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    today = datetime.date.today()
+    lists = {
+        'songs/list.html': ('/songs', {'songs': [
+            {'song_id': i, 'name': f'Song {i}', 'artist_name': f'Artist {i % 7}'} for i in range(args.rows)]}),
+        'events/list.html': ('/events', {'events': [
+            {'event_id': i, 'description': f'Concert {i}', 'date': today + datetime.timedelta(days=i),
+             'conditions': '18+', 'country': 'Czech Republic', 'region': 'Prague', 'city': 'Prague',
+             'address': f'{i} Street'} for i in range(args.rows)]}),
+    }
+    for _, context in lists.values():
+        rows = next(iter(context.values()))
+        context['page'] = pagination.Page(rows, next_token='x', limit=args.rows)
+
+    with tempfile.TemporaryDirectory() as bytecode_dir:
+        templating.compile_all(fresh_env(bytecode_dir))  # fill the cache, as `templating.py build` does
+        no_cache = cold_start(None, args.repeat)
+        cached = cold_start(bytecode_dir, args.repeat)
+
+    print(f"{'cold start, all templates':<40}{'ms':>10}")
+    print(f"{'  no bytecode cache':<40}{no_cache * 1000:>10.1f}")
+    print(f"{'  bytecode cache':<40}{cached * 1000:>10.1f}  ({no_cache / cached:.1f}x)")
+    print()
+    print(f"{'render (' + str(args.rows) + ' rows)':<40}{'auto_reload':>14}{'no reload':>12}")
+    for name, (path, context) in lists.items():
+        reload_on = render_cost(fresh_env(auto_reload=True), name, path, context, args.renders)
+        reload_off = render_cost(fresh_env(auto_reload=False), name, path, context, args.renders)
+        print(f"{'  ' + name:<40}{reload_on * 1e6:>12.0f}us{reload_off * 1e6:>10.0f}us")
+
+
+if __name__ == '__main__':
+    main()
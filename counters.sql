@@ -0,0 +1,60 @@
+-- row counters for the homepage statistics (optional, run after create.sql + insert.sql)
+-- web-app reads them when STATS_USE_COUNTERS=1
+
+CREATE TABLE IF NOT EXISTS table_counter (
+    table_name VARCHAR(64) NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0
+);
+ALTER TABLE table_counter DROP CONSTRAINT IF EXISTS pk_table_counter;
+ALTER TABLE table_counter ADD CONSTRAINT pk_table_counter PRIMARY KEY (table_name);
+
+-- statement-level triggers: one counter update per statement instead of per row
+CREATE OR REPLACE FUNCTION table_counter_insert() RETURNS trigger AS $$
+BEGIN
+    UPDATE table_counter SET row_count = row_count + (SELECT COUNT(*) FROM new_rows)
+    WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION table_counter_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE table_counter SET row_count = row_count - (SELECT COUNT(*) FROM old_rows)
+    WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION table_counter_truncate() RETURNS trigger AS $$
+BEGIN
+    UPDATE table_counter SET row_count = 0 WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION install_table_counter(tbl text) RETURNS void AS $$
+BEGIN
+    EXECUTE format('LOCK TABLE %I IN SHARE MODE', tbl);
+    EXECUTE format('DROP TRIGGER IF EXISTS trg_%s_count_ins ON %I', tbl, tbl);
+    EXECUTE format('DROP TRIGGER IF EXISTS trg_%s_count_del ON %I', tbl, tbl);
+    EXECUTE format('DROP TRIGGER IF EXISTS trg_%s_count_trunc ON %I', tbl, tbl);
+    EXECUTE format('CREATE TRIGGER trg_%s_count_ins AFTER INSERT ON %I
+                    REFERENCING NEW TABLE AS new_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION table_counter_insert()', tbl, tbl);
+    EXECUTE format('CREATE TRIGGER trg_%s_count_del AFTER DELETE ON %I
+                    REFERENCING OLD TABLE AS old_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION table_counter_delete()', tbl, tbl);
+    EXECUTE format('CREATE TRIGGER trg_%s_count_trunc AFTER TRUNCATE ON %I
+                    FOR EACH STATEMENT EXECUTE FUNCTION table_counter_truncate()', tbl, tbl);
+    EXECUTE format('INSERT INTO table_counter (table_name, row_count)
+                    SELECT %L, COUNT(*) FROM %I
+                    ON CONFLICT (table_name) DO UPDATE SET row_count = EXCLUDED.row_count', tbl, tbl);
+END;
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+SELECT install_table_counter('users');
+SELECT install_table_counter('artist_user');
+SELECT install_table_counter('song');
+SELECT install_table_counter('event');
+COMMIT;
@@ -409,3 +409,17 @@ insert into song_playlist (song_id, playlist_id) values (14, 4);
 insert into song_playlist (song_id, playlist_id) values (15, 5);
 insert into song_playlist (song_id, playlist_id) values (16, 6);
 insert into song_playlist (song_id, playlist_id) values (17, 7);
+
+-- posunu všechny sekvence za vložená id, aby INSERT z aplikace (register, add_song, ...) nekolidoval
+DO $$
+DECLARE
+    rec RECORD;
+BEGIN
+    FOR rec IN SELECT table_name, column_name FROM information_schema.columns
+               WHERE table_schema = current_schema() AND column_default LIKE 'nextval%'
+    LOOP
+        EXECUTE format('SELECT setval(pg_get_serial_sequence(%L, %L), COALESCE((SELECT MAX(%I) FROM %I), 0) + 1, false)',
+                       rec.table_name, rec.column_name, rec.column_name, rec.table_name);
+    END LOOP;
+END;
+$$;
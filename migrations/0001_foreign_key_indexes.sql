@@ -0,0 +1,21 @@
+-- indexes on foreign-key and filter columns (create.sql only defines primary keys)
+
+-- login() / register(): look up users by email
+CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email ON users (email);
+
+-- artist_detail(), profile(): songs/events of one artist
+CREATE INDEX IF NOT EXISTS idx_song_artist_user_username ON song_artist_user (username);
+CREATE INDEX IF NOT EXISTS idx_event_artist_user_username ON event_artist_user (username);
+
+-- playlist_detail(): songs of one playlist
+CREATE INDEX IF NOT EXISTS idx_song_playlist_playlist_id ON song_playlist (playlist_id);
+
+CREATE INDEX IF NOT EXISTS idx_playlist_username ON playlist (username);
+CREATE INDEX IF NOT EXISTS idx_merchandise_product_username ON merchandise_product (username);
+
+-- events() / index(): join to location, order and page by date
+CREATE INDEX IF NOT EXISTS idx_event_location_id ON event (location_id);
+CREATE INDEX IF NOT EXISTS idx_event_date ON event (date, event_id);
+
+-- songs(): keyset pages by name
+CREATE INDEX IF NOT EXISTS idx_song_name ON song (name, song_id);
@@ -0,0 +1,128 @@
+-- full-text + trigram search over artists, songs, events and playlists
+-- one search_document row per entity, kept in sync by triggers
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE search_document (
+    entity_type VARCHAR(10) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    title VARCHAR(256) NOT NULL,
+    subtitle VARCHAR(256),
+    document TSVECTOR NOT NULL
+);
+ALTER TABLE search_document ADD CONSTRAINT pk_search_document PRIMARY KEY (entity_type, entity_id);
+
+CREATE INDEX idx_search_document_fts ON search_document USING GIN (document);
+CREATE INDEX idx_search_document_title_trgm ON search_document USING GIN (title gin_trgm_ops);
+
+
+-- source rows for each entity type; used by both the per-row refresh and the bulk rebuild
+CREATE OR REPLACE VIEW search_source AS
+    SELECT 'artist'::varchar AS entity_type, au.username AS entity_id,
+           COALESCE(u.full_name, au.username::text) AS title,
+           au.genre::varchar AS subtitle,
+           setweight(to_tsvector('simple', COALESCE(u.full_name, '')), 'A') ||
+           setweight(to_tsvector('simple', COALESCE(au.genre, '')), 'B') ||
+           setweight(to_tsvector('simple', COALESCE(au.biography, '')), 'C') AS document
+    FROM artist_user au
+    JOIN users u ON u.username = au.username
+    UNION ALL
+    SELECT 'song', s.song_id, s.name, a.artists,
+           setweight(to_tsvector('simple', s.name), 'A') ||
+           setweight(to_tsvector('simple', COALESCE(a.artists, '')), 'B') ||
+           setweight(to_tsvector('simple', COALESCE(s.lyrics, '')), 'D')
+    FROM song s
+    LEFT JOIN LATERAL (
+        SELECT string_agg(u.full_name, ', ' ORDER BY u.full_name) AS artists
+        FROM song_artist_user sau
+        JOIN users u ON u.username = sau.username
+        WHERE sau.song_id = s.song_id
+    ) a ON TRUE
+    UNION ALL
+    SELECT 'event', e.event_id, e.description, l.city,
+           setweight(to_tsvector('simple', e.description), 'A') ||
+           setweight(to_tsvector('simple', COALESCE(l.city, '') || ' ' || COALESCE(l.country, '')), 'B')
+    FROM event e
+    LEFT JOIN location l ON l.location_id = e.location_id
+    UNION ALL
+    SELECT 'playlist', p.playlist_id, COALESCE(p.description, p.link), p.link,
+           setweight(to_tsvector('simple', COALESCE(p.description, '')), 'A') ||
+           setweight(to_tsvector('simple', p.link), 'C')
+    FROM playlist p;
+
+
+CREATE OR REPLACE FUNCTION search_refresh(p_type varchar, p_id integer) RETURNS void AS $$
+BEGIN
+    DELETE FROM search_document WHERE entity_type = p_type AND entity_id = p_id;
+    INSERT INTO search_document (entity_type, entity_id, title, subtitle, document)
+    SELECT entity_type, entity_id, title, subtitle, document
+    FROM search_source
+    WHERE entity_type = p_type AND entity_id = p_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_rebuild() RETURNS void AS $$
+BEGIN
+    TRUNCATE search_document;
+    INSERT INTO search_document (entity_type, entity_id, title, subtitle, document)
+    SELECT entity_type, entity_id, title, subtitle, document FROM search_source;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- triggers
+CREATE OR REPLACE FUNCTION search_song_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM search_refresh('song', CASE WHEN TG_OP = 'DELETE' THEN OLD.song_id ELSE NEW.song_id END);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_artist_trigger() RETURNS trigger AS $$
+DECLARE
+    v_username integer := CASE WHEN TG_OP = 'DELETE' THEN OLD.username ELSE NEW.username END;
+BEGIN
+    PERFORM search_refresh('artist', v_username);
+    -- song documents contain the artist's name
+    IF TG_TABLE_NAME = 'users' THEN
+        PERFORM search_refresh('song', sau.song_id)
+        FROM song_artist_user sau WHERE sau.username = v_username;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_event_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'location' THEN
+        PERFORM search_refresh('event', e.event_id) FROM event e WHERE e.location_id = NEW.location_id;
+    ELSE
+        PERFORM search_refresh('event', CASE WHEN TG_OP = 'DELETE' THEN OLD.event_id ELSE NEW.event_id END);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION search_playlist_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM search_refresh('playlist', CASE WHEN TG_OP = 'DELETE' THEN OLD.playlist_id ELSE NEW.playlist_id END);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_song_search AFTER INSERT OR UPDATE OR DELETE ON song
+    FOR EACH ROW EXECUTE FUNCTION search_song_trigger();
+CREATE TRIGGER trg_song_artist_user_search AFTER INSERT OR UPDATE OR DELETE ON song_artist_user
+    FOR EACH ROW EXECUTE FUNCTION search_song_trigger();
+CREATE TRIGGER trg_artist_user_search AFTER INSERT OR UPDATE OR DELETE ON artist_user
+    FOR EACH ROW EXECUTE FUNCTION search_artist_trigger();
+CREATE TRIGGER trg_users_search AFTER UPDATE OF full_name ON users
+    FOR EACH ROW EXECUTE FUNCTION search_artist_trigger();
+CREATE TRIGGER trg_event_search AFTER INSERT OR UPDATE OR DELETE ON event
+    FOR EACH ROW EXECUTE FUNCTION search_event_trigger();
+CREATE TRIGGER trg_location_search AFTER UPDATE ON location
+    FOR EACH ROW EXECUTE FUNCTION search_event_trigger();
+CREATE TRIGGER trg_playlist_search AFTER INSERT OR UPDATE OR DELETE ON playlist
+    FOR EACH ROW EXECUTE FUNCTION search_playlist_trigger();
+
+SELECT search_rebuild();
@@ -0,0 +1,3 @@
+-- case-insensitive prefix lookups for the playlist song picker:
+-- with "C" collation the B-tree serves both lower(name) LIKE 'abc%' and ORDER BY lower(name)
+CREATE INDEX IF NOT EXISTS idx_song_name_lower_prefix ON song ((lower(name) COLLATE "C"), song_id);
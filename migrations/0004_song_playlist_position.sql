@@ -0,0 +1,16 @@
+-- ordered playlists: position of each song within its playlist
+ALTER TABLE song_playlist ADD COLUMN position INTEGER;
+
+UPDATE song_playlist sp SET position = r.rn
+FROM (
+    SELECT song_id, playlist_id, row_number() OVER (PARTITION BY playlist_id ORDER BY song_id) AS rn
+    FROM song_playlist
+) r
+WHERE sp.song_id = r.song_id AND sp.playlist_id = r.playlist_id;
+
+ALTER TABLE song_playlist ALTER COLUMN position SET NOT NULL;
+ALTER TABLE song_playlist ALTER COLUMN position SET DEFAULT 0;
+
+-- replaces idx_song_playlist_playlist_id: same leading column, also serves ORDER BY position
+CREATE INDEX IF NOT EXISTS idx_song_playlist_position ON song_playlist (playlist_id, position);
+DROP INDEX IF EXISTS idx_song_playlist_playlist_id;
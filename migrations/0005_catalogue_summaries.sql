@@ -0,0 +1,177 @@
+-- narrow summary tables for the /songs and /artists list pages, kept in sync by triggers
+-- song_summary: one row per song with its artists' names aggregated
+-- artist_summary: one row per artist with song/event/merchandise counts and the next event date
+
+CREATE TABLE song_summary (
+    song_id INTEGER NOT NULL,
+    name VARCHAR(40) NOT NULL,
+    artist_names TEXT
+);
+ALTER TABLE song_summary ADD CONSTRAINT pk_song_summary PRIMARY KEY (song_id);
+CREATE INDEX idx_song_summary_name ON song_summary (name, song_id);
+
+CREATE TABLE artist_summary (
+    username INTEGER NOT NULL,
+    full_name VARCHAR(40),
+    email VARCHAR(50),
+    genre VARCHAR(20),
+    song_count INTEGER NOT NULL DEFAULT 0,
+    event_count INTEGER NOT NULL DEFAULT 0,
+    next_event_date DATE,
+    merch_count INTEGER NOT NULL DEFAULT 0
+);
+ALTER TABLE artist_summary ADD CONSTRAINT pk_artist_summary PRIMARY KEY (username);
+-- artist_summary_expire() looks for next events that have passed
+CREATE INDEX idx_artist_summary_next_event ON artist_summary (next_event_date);
+
+
+-- source rows; used by both the per-row refresh and the bulk rebuild
+CREATE OR REPLACE VIEW song_summary_source AS
+    SELECT s.song_id, s.name, a.artist_names
+    FROM song s
+    LEFT JOIN LATERAL (
+        SELECT string_agg(u.full_name, ', ' ORDER BY u.full_name) AS artist_names
+        FROM song_artist_user sau
+        JOIN users u ON u.username = sau.username
+        WHERE sau.song_id = s.song_id
+    ) a ON TRUE;
+
+CREATE OR REPLACE VIEW artist_summary_source AS
+    SELECT au.username, u.full_name, u.email, au.genre,
+           (SELECT COUNT(*) FROM song_artist_user sau WHERE sau.username = au.username) AS song_count,
+           (SELECT COUNT(*) FROM event_artist_user eau WHERE eau.username = au.username) AS event_count,
+           (SELECT MIN(e.date)
+            FROM event_artist_user eau
+            JOIN event e ON e.event_id = eau.event_id
+            WHERE eau.username = au.username AND e.date >= CURRENT_DATE) AS next_event_date,
+           (SELECT COUNT(*) FROM merchandise_product m WHERE m.username = au.username) AS merch_count
+    FROM artist_user au
+    JOIN users u ON u.username = au.username;
+
+
+CREATE OR REPLACE FUNCTION song_summary_refresh(p_song_id integer) RETURNS void AS $$
+BEGIN
+    INSERT INTO song_summary (song_id, name, artist_names)
+    SELECT song_id, name, artist_names FROM song_summary_source WHERE song_id = p_song_id
+    ON CONFLICT (song_id) DO UPDATE
+        SET name = EXCLUDED.name, artist_names = EXCLUDED.artist_names;
+    IF NOT FOUND THEN
+        DELETE FROM song_summary WHERE song_id = p_song_id;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION artist_summary_refresh(p_username integer) RETURNS void AS $$
+BEGIN
+    INSERT INTO artist_summary (username, full_name, email, genre, song_count, event_count,
+                                next_event_date, merch_count)
+    SELECT username, full_name, email, genre, song_count, event_count, next_event_date, merch_count
+    FROM artist_summary_source WHERE username = p_username
+    ON CONFLICT (username) DO UPDATE
+        SET full_name = EXCLUDED.full_name, email = EXCLUDED.email, genre = EXCLUDED.genre,
+            song_count = EXCLUDED.song_count, event_count = EXCLUDED.event_count,
+            next_event_date = EXCLUDED.next_event_date, merch_count = EXCLUDED.merch_count;
+    IF NOT FOUND THEN
+        DELETE FROM artist_summary WHERE username = p_username;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION catalogue_summary_rebuild() RETURNS void AS $$
+BEGIN
+    TRUNCATE song_summary, artist_summary;
+    INSERT INTO song_summary (song_id, name, artist_names)
+    SELECT song_id, name, artist_names FROM song_summary_source;
+    INSERT INTO artist_summary (username, full_name, email, genre, song_count, event_count,
+                                next_event_date, merch_count)
+    SELECT username, full_name, email, genre, song_count, event_count, next_event_date, merch_count
+    FROM artist_summary_source;
+END;
+$$ LANGUAGE plpgsql;
+
+-- next_event_date depends on CURRENT_DATE, so no trigger fires when an event passes;
+-- run periodically (see summaries.SummaryRefresher) to move those artists to their next event
+CREATE OR REPLACE FUNCTION artist_summary_expire() RETURNS integer AS $$
+DECLARE
+    v_username integer;
+    v_count integer := 0;
+BEGIN
+    FOR v_username IN SELECT username FROM artist_summary WHERE next_event_date < CURRENT_DATE LOOP
+        PERFORM artist_summary_refresh(v_username);
+        v_count := v_count + 1;
+    END LOOP;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- triggers
+CREATE OR REPLACE FUNCTION summary_song_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM song_summary_refresh(OLD.song_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM song_summary_refresh(NEW.song_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- song_artist_user, event_artist_user, merchandise_product and artist_user rows carry the artist's username
+CREATE OR REPLACE FUNCTION summary_artist_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM artist_summary_refresh(OLD.username);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM artist_summary_refresh(NEW.username);
+    END IF;
+    IF TG_TABLE_NAME = 'song_artist_user' THEN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM song_summary_refresh(OLD.song_id);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM song_summary_refresh(NEW.song_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- name/email changes reach the artist row and the artist's songs
+CREATE OR REPLACE FUNCTION summary_users_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM artist_summary_refresh(NEW.username)
+    WHERE EXISTS (SELECT 1 FROM artist_user WHERE username = NEW.username);
+    PERFORM song_summary_refresh(sau.song_id)
+    FROM song_artist_user sau WHERE sau.username = NEW.username;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- a moved event can change its artists' next_event_date (deletes cascade to event_artist_user)
+CREATE OR REPLACE FUNCTION summary_event_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM artist_summary_refresh(eau.username)
+    FROM event_artist_user eau WHERE eau.event_id = NEW.event_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_song_summary AFTER INSERT OR UPDATE OR DELETE ON song
+    FOR EACH ROW EXECUTE FUNCTION summary_song_trigger();
+CREATE TRIGGER trg_song_artist_user_summary AFTER INSERT OR UPDATE OR DELETE ON song_artist_user
+    FOR EACH ROW EXECUTE FUNCTION summary_artist_trigger();
+CREATE TRIGGER trg_event_artist_user_summary AFTER INSERT OR UPDATE OR DELETE ON event_artist_user
+    FOR EACH ROW EXECUTE FUNCTION summary_artist_trigger();
+CREATE TRIGGER trg_merchandise_product_summary AFTER INSERT OR UPDATE OF username OR DELETE ON merchandise_product
+    FOR EACH ROW EXECUTE FUNCTION summary_artist_trigger();
+CREATE TRIGGER trg_artist_user_summary AFTER INSERT OR UPDATE OR DELETE ON artist_user
+    FOR EACH ROW EXECUTE FUNCTION summary_artist_trigger();
+CREATE TRIGGER trg_users_summary AFTER UPDATE OF full_name, email ON users
+    FOR EACH ROW EXECUTE FUNCTION summary_users_trigger();
+CREATE TRIGGER trg_event_summary AFTER UPDATE OF date ON event
+    FOR EACH ROW EXECUTE FUNCTION summary_event_trigger();
+
+SELECT catalogue_summary_rebuild();
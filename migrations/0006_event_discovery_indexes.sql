@@ -0,0 +1,13 @@
+-- event discovery (/api/v1/events/discover): date windows, location and artist filters
+
+-- "upcoming in <country>/<city>": find the city's locations, then each location's events in date order
+CREATE INDEX IF NOT EXISTS idx_location_country_city ON location (country, city);
+CREATE INDEX IF NOT EXISTS idx_location_country_region ON location (country, region);
+
+-- replaces idx_event_location_id: same leading column, also serves the date range and keyset order
+CREATE INDEX IF NOT EXISTS idx_event_location_date ON event (location_id, date, event_id);
+DROP INDEX IF EXISTS idx_event_location_id;
+
+-- replaces idx_event_artist_user_username: the artist filter becomes an index-only scan
+CREATE INDEX IF NOT EXISTS idx_event_artist_user_username_event ON event_artist_user (username, event_id);
+DROP INDEX IF EXISTS idx_event_artist_user_username;
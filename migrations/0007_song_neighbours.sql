@@ -0,0 +1,40 @@
+-- song recommendations from playlist co-occurrence (computed by web-app/recommend.py)
+-- song_neighbour: the top-K most similar songs of every song, rank 1 = most similar
+-- song_neighbour_queue: playlists changed since the last incremental recompute
+-- like the summary tables there are no foreign keys (bulk loads truncate song); readers join song,
+-- so rows of deleted songs are never shown and disappear with the next rebuild
+
+CREATE TABLE song_neighbour (
+    song_id INTEGER NOT NULL,
+    rank SMALLINT NOT NULL,
+    neighbour_id INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+-- "more like this" is a range scan of one song's K rows in rank order
+ALTER TABLE song_neighbour ADD CONSTRAINT pk_song_neighbour PRIMARY KEY (song_id, rank);
+
+CREATE TABLE song_neighbour_queue (
+    playlist_id INTEGER NOT NULL,
+    queued_at TIMESTAMP NOT NULL DEFAULT now()
+);
+ALTER TABLE song_neighbour_queue ADD CONSTRAINT pk_song_neighbour_queue PRIMARY KEY (playlist_id);
+
+
+-- one queue row per changed playlist, however many of its songs changed
+CREATE OR REPLACE FUNCTION song_neighbour_queue_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO song_neighbour_queue (playlist_id) VALUES (OLD.playlist_id)
+        ON CONFLICT (playlist_id) DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO song_neighbour_queue (playlist_id) VALUES (NEW.playlist_id)
+        ON CONFLICT (playlist_id) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- position changes do not affect co-occurrence
+CREATE TRIGGER trg_song_playlist_neighbour_queue AFTER INSERT OR UPDATE OF song_id, playlist_id OR DELETE ON song_playlist
+    FOR EACH ROW EXECUTE FUNCTION song_neighbour_queue_trigger();
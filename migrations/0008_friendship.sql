@@ -0,0 +1,53 @@
+-- friendship edges between basic users; replaces the single basic_user.basic_user_username link
+-- every friendship is stored in both directions, so a user's friends are one index range
+-- (username, friend_username) and friends-of-friends a join of that index with itself
+
+CREATE TABLE friendship (
+    username INTEGER NOT NULL,
+    friend_username INTEGER NOT NULL,
+    since TIMESTAMP NOT NULL DEFAULT now()
+);
+-- friend list, friend count (index-only), mutual friends, friends-of-friends
+ALTER TABLE friendship ADD CONSTRAINT pk_friendship PRIMARY KEY (username, friend_username);
+ALTER TABLE friendship ADD CONSTRAINT ck_friendship_self CHECK (username <> friend_username);
+ALTER TABLE friendship ADD CONSTRAINT fk_friendship_user FOREIGN KEY (username) REFERENCES basic_user (username) ON DELETE CASCADE;
+ALTER TABLE friendship ADD CONSTRAINT fk_friendship_friend FOREIGN KEY (friend_username) REFERENCES basic_user (username) ON DELETE CASCADE;
+-- the other direction: serves the cascade from basic_user and checks of the mirrored row
+CREATE INDEX idx_friendship_friend ON friendship (friend_username, username);
+
+
+-- basic_user.basic_user_username is kept for existing data and insert.sql; every link in it
+-- becomes a friendship (in both directions). Later changes of the column only add friendships.
+CREATE OR REPLACE FUNCTION friendship_import_legacy() RETURNS integer AS $$
+DECLARE
+    v_count integer;
+BEGIN
+    INSERT INTO friendship (username, friend_username)
+    SELECT bu.username, bu.basic_user_username
+    FROM basic_user bu
+    WHERE bu.basic_user_username IS NOT NULL AND bu.basic_user_username <> bu.username
+    UNION
+    SELECT bu.basic_user_username, bu.username
+    FROM basic_user bu
+    WHERE bu.basic_user_username IS NOT NULL AND bu.basic_user_username <> bu.username
+    ON CONFLICT DO NOTHING;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION friendship_legacy_trigger() RETURNS trigger AS $$
+BEGIN
+    IF NEW.basic_user_username IS NOT NULL AND NEW.basic_user_username <> NEW.username THEN
+        INSERT INTO friendship (username, friend_username)
+        VALUES (NEW.username, NEW.basic_user_username), (NEW.basic_user_username, NEW.username)
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_basic_user_friendship AFTER INSERT OR UPDATE OF basic_user_username ON basic_user
+    FOR EACH ROW EXECUTE FUNCTION friendship_legacy_trigger();
+
+SELECT friendship_import_legacy();
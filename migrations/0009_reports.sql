@@ -0,0 +1,73 @@
+-- analytical reports for the main.xml queries (web-app/reports.py)
+
+-- D9 events in a city, D11 events of an artist by full name, D13 artists selling a product
+CREATE INDEX IF NOT EXISTS idx_location_city ON location (city);
+CREATE INDEX IF NOT EXISTS idx_users_full_name ON users (full_name);
+CREATE INDEX IF NOT EXISTS idx_merchandise_product_name ON merchandise_product (product_name, username);
+
+
+-- precomputed results of the reports that have to scan whole tables; read with REPORTS_USE_VIEWS=1
+-- (unique indexes allow REFRESH ... CONCURRENTLY, so readers are never blocked)
+
+-- D8 relational division: artists featured in every event ((event_id, username) is the primary key,
+-- so COUNT(*) per artist counts distinct events)
+CREATE MATERIALIZED VIEW report_artists_in_all_events AS
+    SELECT au.username, u.full_name, au.genre
+    FROM (
+        SELECT username
+        FROM event_artist_user
+        GROUP BY username
+        HAVING COUNT(*) = (SELECT COUNT(*) FROM event)
+    ) d
+    JOIN artist_user au ON au.username = d.username
+    JOIN users u ON u.username = au.username;
+CREATE UNIQUE INDEX uq_report_artists_in_all_events ON report_artists_in_all_events (username);
+
+-- D11 events with exactly one artist, and that artist
+CREATE MATERIALIZED VIEW report_single_artist_events AS
+    SELECT event_id, MIN(username) AS username
+    FROM event_artist_user
+    GROUP BY event_id
+    HAVING COUNT(*) = 1;
+CREATE UNIQUE INDEX uq_report_single_artist_events ON report_single_artist_events (event_id);
+CREATE INDEX idx_report_single_artist_events_username ON report_single_artist_events (username, event_id);
+
+-- D14 anti-join: artists without songs
+CREATE MATERIALIZED VIEW report_artists_without_songs AS
+    SELECT au.username, u.full_name, au.genre
+    FROM artist_user au
+    JOIN users u ON u.username = au.username
+    WHERE NOT EXISTS (SELECT 1 FROM song_artist_user sau WHERE sau.username = au.username);
+CREATE UNIQUE INDEX uq_report_artists_without_songs ON report_artists_without_songs (username);
+
+
+CREATE TABLE report_refresh (
+    view_name VARCHAR(63) NOT NULL,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+ALTER TABLE report_refresh ADD CONSTRAINT pk_report_refresh PRIMARY KEY (view_name);
+INSERT INTO report_refresh (view_name)
+VALUES ('report_artists_in_all_events'), ('report_single_artist_events'), ('report_artists_without_songs');
+
+-- refreshes the views older than p_max_age; called by every worker (reports.ReportRefresher),
+-- but the lock and the timestamps make each view refresh once per period
+CREATE OR REPLACE FUNCTION report_refresh(p_max_age interval) RETURNS integer AS $$
+DECLARE
+    v_view varchar;
+    v_count integer := 0;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('report_refresh')) THEN
+        RETURN 0;
+    END IF;
+    FOR v_view IN
+        SELECT view_name FROM report_refresh
+        WHERE refreshed_at < clock_timestamp() - p_max_age
+        ORDER BY view_name
+    LOOP
+        EXECUTE format('REFRESH MATERIALIZED VIEW CONCURRENTLY %I', v_view);
+        UPDATE report_refresh SET refreshed_at = clock_timestamp() WHERE view_name = v_view;
+        v_count := v_count + 1;
+    END LOOP;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,11 @@
+-- merchandise storefront (web-app/merchandise.py): price-ordered keyset listings
+
+-- storefront: available products by price, optionally in a price range
+CREATE INDEX IF NOT EXISTS idx_merchandise_product_available_price
+    ON merchandise_product (availibility, product_price, product_id);
+
+-- replaces idx_merchandise_product_username: same leading column (foreign key, artist_summary counts),
+-- also serves an artist's available products and per-artist pages in keyset order
+CREATE INDEX IF NOT EXISTS idx_merchandise_product_username_price
+    ON merchandise_product (username, availibility, product_price, product_id);
+DROP INDEX IF EXISTS idx_merchandise_product_username;
@@ -0,0 +1,68 @@
+-- public channel directory and detail (web-app/channels.py, /api/v1/channels)
+
+-- filters by genre and by location (location (country, city) comes from migration 0006), in channel_id order
+CREATE INDEX IF NOT EXISTS idx_public_channel_genre ON public_channel (preferred_genre, channel_id);
+CREATE INDEX IF NOT EXISTS idx_public_channel_location ON public_channel (location_id, channel_id);
+-- a moderator's channels; also the foreign key (cascade from content_moderator_user)
+CREATE INDEX IF NOT EXISTS idx_public_channel_username ON public_channel (username, channel_id);
+
+
+-- per-moderator channel summary, maintained by triggers: "moderators of channel X and no other
+-- channel" (main.xml D7) becomes one index lookup on only_channel_name instead of an EXCEPT
+-- over two joins of public_channel with users
+CREATE TABLE moderator_channel (
+    username INTEGER NOT NULL,
+    channel_count INTEGER NOT NULL,
+    -- the name of all the moderator's named channels when it is the same for all of them, else NULL
+    -- (like D7, channels without a name are ignored)
+    only_channel_name VARCHAR(40)
+);
+ALTER TABLE moderator_channel ADD CONSTRAINT pk_moderator_channel PRIMARY KEY (username);
+ALTER TABLE moderator_channel ADD CONSTRAINT fk_moderator_channel_user FOREIGN KEY (username) REFERENCES content_moderator_user (username) ON DELETE CASCADE;
+CREATE INDEX idx_moderator_channel_only_name ON moderator_channel (only_channel_name, username);
+
+
+-- recompute one moderator's row (deleted when they no longer moderate any channel)
+CREATE OR REPLACE FUNCTION moderator_channel_refresh(p_username integer) RETURNS void AS $$
+BEGIN
+    DELETE FROM moderator_channel WHERE username = p_username;
+    INSERT INTO moderator_channel (username, channel_count, only_channel_name)
+    SELECT username, COUNT(*),
+           CASE WHEN COUNT(DISTINCT channel_name) = 1 THEN MIN(channel_name) END
+    FROM public_channel
+    WHERE username = p_username
+    GROUP BY username;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION moderator_channel_rebuild() RETURNS integer AS $$
+DECLARE
+    v_count integer;
+BEGIN
+    DELETE FROM moderator_channel;
+    INSERT INTO moderator_channel (username, channel_count, only_channel_name)
+    SELECT username, COUNT(*),
+           CASE WHEN COUNT(DISTINCT channel_name) = 1 THEN MIN(channel_name) END
+    FROM public_channel
+    GROUP BY username;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION moderator_channel_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM moderator_channel_refresh(OLD.username);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.username <> OLD.username) THEN
+        PERFORM moderator_channel_refresh(NEW.username);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_public_channel_moderator AFTER INSERT OR UPDATE OF username, channel_name OR DELETE ON public_channel
+    FOR EACH ROW EXECUTE FUNCTION moderator_channel_trigger();
+
+SELECT moderator_channel_rebuild();
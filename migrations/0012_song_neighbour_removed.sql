@@ -0,0 +1,26 @@
+-- songs removed from a queued playlist (web-app/recommend.py): they are no longer among the playlist's
+-- songs, so the incremental recompute needs them listed to drop the playlist from their neighbours
+-- rows go together with the playlist's song_neighbour_queue row (same batch, same transaction)
+
+CREATE TABLE song_neighbour_removed (
+    playlist_id INTEGER NOT NULL,
+    song_id INTEGER NOT NULL
+);
+ALTER TABLE song_neighbour_removed ADD CONSTRAINT pk_song_neighbour_removed PRIMARY KEY (playlist_id, song_id);
+
+
+CREATE OR REPLACE FUNCTION song_neighbour_queue_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO song_neighbour_queue (playlist_id) VALUES (OLD.playlist_id)
+        ON CONFLICT (playlist_id) DO NOTHING;
+        INSERT INTO song_neighbour_removed (playlist_id, song_id) VALUES (OLD.playlist_id, OLD.song_id)
+        ON CONFLICT (playlist_id, song_id) DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO song_neighbour_queue (playlist_id) VALUES (NEW.playlist_id)
+        ON CONFLICT (playlist_id) DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
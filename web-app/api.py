@@ -0,0 +1,570 @@
+"""Versioned JSON API: /api/v1/<resource>[/<id>].
+
+    GET /api/v1/songs?fields=song_id,name&limit=100&after=<token>
+    GET /api/v1/artists/12?fields=full_name,song_count
+    GET /api/v1/events/discover?window=upcoming&country=Czech Republic&city=Prague
+    GET /api/v1/users/21/friends/count
+    GET /api/v1/reports/events-in-city?city=Prague
+    GET /api/v1/merchandise?min_price=10&max_price=50
+    GET /api/v1/channels?genre=Rock&country=Czech Republic
+
+``fields`` selects columns (sparse fieldsets); only those are queried.
+Lists use the same opaque keyset tokens as the HTML pages and answer
+``{"data": [...], "next": token, "prev": token}``. Bodies are encoded with
+orjson when installed (rows, dates and decimals directly) and compressed
+with brotli or gzip when the client accepts it.
+"""
+import csv
+import datetime
+import decimal
+import gzip
+import json
+
+import psycopg2
+from flask import Blueprint, Response, current_app, request, session
+
+import channels
+import friends
+import merchandise
+import pagination
+import reports
+import roles
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is slower but produces the same output
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+API_VERSION = 'v1'
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+blueprint = Blueprint('api', __name__, url_prefix=f'/api/{API_VERSION}')
+
+
+# ==================== ENCODING ====================
+
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'cannot serialize {type(value).__name__}')
+
+
+def dumps(payload):
+    """UTF-8 JSON; RealDictRow and other dict subclasses are encoded as objects"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=_default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def error(message, status):
+    return json_response({'error': message}, status)
+
+
+@blueprint.after_request
+def compress(response):
+    """br or gzip for bodies of COMPRESS_MIN_BYTES and more"""
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+# ==================== RESOURCES ====================
+
+
+class Resource:
+    """A listable table: public field names mapped to SQL expressions.
+
+    ``source`` is the FROM clause; fields that need another table are
+    written as scalar subqueries so they cost nothing unless requested.
+    """
+
+    def __init__(self, source, fields, keyset, id_field, default_fields=None, login_required=False):
+        self.source = source
+        self.fields = fields
+        self.keyset = keyset
+        self.id_field = id_field
+        self.default_fields = default_fields or list(fields)
+        self.login_required = login_required
+
+    def parse_fields(self, value):
+        if not value:
+            return list(self.default_fields)
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ValueError(f"unknown field(s) {', '.join(unknown)}; available: {', '.join(self.fields)}")
+        return names
+
+    def _columns(self, names):
+        # keyset columns are always selected so the next-page token can be built
+        columns = {key: expr for key, expr in zip(self.keyset.keys, self.keyset.columns)}
+        columns.update((name, self.fields[name]) for name in names)
+        return ', '.join(f'{expr} AS {name}' for name, expr in columns.items())
+
+    def list_sql(self, names, conditions=()):
+        where = ' AND '.join(list(conditions) + ['{keyset}'])
+        return f'SELECT {self._columns(names)}\nFROM {self.source}\nWHERE {where}\nORDER BY {{order}}'
+
+    def detail_sql(self, names):
+        return f'SELECT {self._columns(names)}\nFROM {self.source}\nWHERE {self.fields[self.id_field]} = %s'
+
+    @staticmethod
+    def project(row, names):
+        return {name: row[name] for name in names}
+
+
+RESOURCES = {
+    'songs': Resource(
+        'song_summary s',
+        {
+            'song_id': 's.song_id',
+            'name': 's.name',
+            'artists': 's.artist_names',
+            'lyrics': '(SELECT x.lyrics FROM song x WHERE x.song_id = s.song_id)',
+        },
+        pagination.Keyset(['s.name', 's.song_id'], descending=True),
+        'song_id',
+        default_fields=['song_id', 'name', 'artists'],
+    ),
+    'artists': Resource(
+        'artist_summary au',
+        {
+            'username': 'au.username',
+            'full_name': 'au.full_name',
+            'genre': 'au.genre',
+            'song_count': 'au.song_count',
+            'event_count': 'au.event_count',
+            'next_event_date': 'au.next_event_date',
+            'merch_count': 'au.merch_count',
+            'biography': '(SELECT x.biography FROM artist_user x WHERE x.username = au.username)',
+        },
+        pagination.Keyset(['au.username']),
+        'username',
+        default_fields=['username', 'full_name', 'genre', 'song_count', 'event_count', 'next_event_date'],
+    ),
+    'events': Resource(
+        'event e LEFT JOIN location l ON e.location_id = l.location_id',
+        {
+            'event_id': 'e.event_id',
+            'description': 'e.description',
+            'date': 'e.date',
+            'conditions': 'e.conditions',
+            'location_id': 'e.location_id',
+            'country': 'l.country',
+            'region': 'l.region',
+            'city': 'l.city',
+            'address': 'l.address',
+            'artists': '''(SELECT array_agg(eau.username ORDER BY eau.username)
+                           FROM event_artist_user eau WHERE eau.event_id = e.event_id)''',
+        },
+        pagination.Keyset(['e.date', 'e.event_id']),
+        'event_id',
+        default_fields=['event_id', 'description', 'date', 'city', 'country'],
+    ),
+    'playlists': Resource(
+        'playlist p',
+        {
+            'playlist_id': 'p.playlist_id',
+            'owner': 'p.username',
+            'description': 'p.description',
+            'link': 'p.link',
+            'song_count': '(SELECT COUNT(*) FROM song_playlist sp WHERE sp.playlist_id = p.playlist_id)',
+            'songs': '''(SELECT array_agg(sp.song_id ORDER BY sp.position, sp.song_id)
+                         FROM song_playlist sp WHERE sp.playlist_id = p.playlist_id)''',
+        },
+        pagination.Keyset(['p.playlist_id'], descending=True),
+        'playlist_id',
+        default_fields=['playlist_id', 'owner', 'description', 'link', 'song_count'],
+        login_required=True,
+    ),
+    'locations': Resource(
+        'location l',
+        {
+            'location_id': 'l.location_id',
+            'country': 'l.country',
+            'region': 'l.region',
+            'city': 'l.city',
+            'address': 'l.address',
+        },
+        pagination.Keyset(['l.location_id']),
+        'location_id',
+    ),
+}
+
+
+# ==================== ROUTES ====================
+
+
+def _connection():
+    return current_app.extensions['db_router'].get_connection()
+
+
+def _primary_connection():
+    """For reads that fill a cache (see db.ReplicaRouter.primary_connection)"""
+    return current_app.extensions['db_router'].primary_connection()
+
+
+def _resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        return None, error(f"unknown resource {name!r}; available: {', '.join(RESOURCES)}", 404)
+    if resource.login_required and 'username' not in session:
+        return None, error('login required', 401)
+    return resource, None
+
+
+@blueprint.route('/')
+def index():
+    return json_response({
+        'version': API_VERSION,
+        'resources': {name: {'fields': list(r.fields), 'default_fields': r.default_fields}
+                      for name, r in RESOURCES.items()},
+    })
+
+
+@blueprint.route('/<name>')
+def list_resource(name):
+    resource, failure = _resource(name)
+    if failure:
+        return failure
+    try:
+        names = resource.parse_fields(request.args.get('fields'))
+        limit = pagination.page_size(request.args.get('limit'))
+        page = pagination.fetch_page(_connection(), resource.list_sql(names), (), resource.keyset,
+                                     request.args.get('after'), request.args.get('before'), limit)
+    except pagination.InvalidToken:
+        return error('invalid page token', 400)
+    except ValueError as e:
+        return error(str(e), 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({
+        'data': [resource.project(row, names) for row in page.rows],
+        'next': page.next_token,
+        'prev': page.prev_token,
+    })
+
+
+# query argument -> (condition, parser); values are passed as parameters
+EVENT_FILTERS = {
+    'country': ('l.country = %s', str),
+    'region': ('l.region = %s', str),
+    'city': ('l.city = %s', str),
+    'artist': ('e.event_id IN (SELECT eau.event_id FROM event_artist_user eau WHERE eau.username = %s)', int),
+    'from': ('e.date >= %s', datetime.date.fromisoformat),
+    'to': ('e.date <= %s', datetime.date.fromisoformat),
+}
+
+# window -> (condition, keyset); past events are listed most recent first
+EVENT_WINDOWS = {
+    'upcoming': ('e.date >= CURRENT_DATE', pagination.Keyset(['e.date', 'e.event_id'])),
+    'past': ('e.date < CURRENT_DATE', pagination.Keyset(['e.date', 'e.event_id'], descending=True)),
+    'all': (None, pagination.Keyset(['e.date', 'e.event_id'])),
+}
+
+
+@blueprint.route('/events/discover')
+def discover_events():
+    """Events in a date window, filtered by location and artist (indexes: migration 0006)"""
+    resource = RESOURCES['events']
+    window = request.args.get('window', 'upcoming')
+    if window not in EVENT_WINDOWS:
+        return error(f"window must be one of {', '.join(EVENT_WINDOWS)}", 400)
+    condition, keyset = EVENT_WINDOWS[window]
+    conditions = [condition] if condition else []
+    params = []
+    try:
+        for arg, (sql, parse) in EVENT_FILTERS.items():
+            value = request.args.get(arg)
+            if value:
+                conditions.append(sql)
+                params.append(parse(value))
+        names = resource.parse_fields(request.args.get('fields'))
+        limit = pagination.page_size(request.args.get('limit'))
+        page = pagination.fetch_page(_connection(), resource.list_sql(names, conditions), params, keyset,
+                                     request.args.get('after'), request.args.get('before'), limit)
+    except pagination.InvalidToken:
+        return error('invalid page token', 400)
+    except ValueError as e:
+        return error(f'invalid filter: {e}', 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({
+        'data': [resource.project(row, names) for row in page.rows],
+        'next': page.next_token,
+        'prev': page.prev_token,
+    })
+
+
+@blueprint.route('/<name>/<int:ident>')
+def get_resource(name, ident):
+    resource, failure = _resource(name)
+    if failure:
+        return failure
+    try:
+        names = resource.parse_fields(request.args.get('fields'))
+        cur = _connection().cursor()
+        cur.execute(resource.detail_sql(names), (ident,))
+        row = cur.fetchone()
+    except ValueError as e:
+        return error(str(e), 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    if row is None:
+        return error(f'{name[:-1]} {ident} not found', 404)
+    return json_response({'data': resource.project(row, names)})
+
+
+# ==================== FRIENDS ====================
+
+
+def _login_required():
+    if 'username' not in session:
+        return error('login required', 401)
+    return None
+
+
+@blueprint.route('/users/<int:username>/friends')
+def list_friends(username):
+    failure = _login_required()
+    if failure:
+        return failure
+    try:
+        limit = pagination.page_size(request.args.get('limit'))
+        page = pagination.fetch_page(_connection(), friends.FRIENDS_SQL, (username,), friends.FRIENDS_KEYSET,
+                                     request.args.get('after'), request.args.get('before'), limit)
+    except pagination.InvalidToken:
+        return error('invalid page token', 400)
+    except ValueError as e:
+        return error(str(e), 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': page.rows, 'next': page.next_token, 'prev': page.prev_token})
+
+
+@blueprint.route('/users/<int:username>/friends/count')
+def count_friends(username):
+    failure = _login_required()
+    if failure:
+        return failure
+    try:
+        count = friends.friend_count(_connection(), username)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': {'username': username, 'friends': count}})
+
+
+@blueprint.route('/users/<int:username>/friends/mutual/<int:other>')
+def mutual_friends(username, other):
+    failure = _login_required()
+    if failure:
+        return failure
+    try:
+        rows = friends.mutual_friends(_connection(), username, other)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': rows})
+
+
+@blueprint.route('/friends/suggestions')
+def friend_suggestions():
+    """Friends-of-friends of the logged-in user (cached per user)"""
+    failure = _login_required()
+    if failure:
+        return failure
+    try:
+        limit = pagination.page_size(request.args.get('limit'), default=friends.SUGGEST_LIMIT,
+                                     maximum=friends.SUGGEST_LIMIT)
+        rows = friends.suggestions(_primary_connection, current_app.extensions['friend_suggestions'],
+                                   session['username'], limit)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': rows})
+
+
+@blueprint.route('/friends/<int:username>', methods=['POST', 'DELETE'])
+def change_friendship(username):
+    failure = _login_required()
+    if failure:
+        return failure
+    if username == session['username']:
+        return error('cannot befriend yourself', 400)
+    conn = _connection()
+    try:
+        changed = friends.set_friendship(conn, current_app.extensions['friend_suggestions'],
+                                         session['username'], username, befriend=request.method == 'POST')
+    except psycopg2.Error as e:
+        conn.rollback()
+        return error(f'database error: {e}', 503)
+    if changed is None:
+        return error('friendships are between basic users', 404)
+    return json_response({'data': {'username': username, 'friend': request.method == 'POST', 'changed': changed}})
+
+
+# ==================== MERCHANDISE ====================
+
+
+@blueprint.route('/merchandise')
+def list_merchandise():
+    """Products by price; ``available`` (1, 0, all), ``artist``, ``min_price``, ``max_price``"""
+    try:
+        sql, params = merchandise.products_query(request.args)
+        limit = pagination.page_size(request.args.get('limit'))
+        page = pagination.fetch_page(_connection(), sql, params, merchandise.PRODUCTS_KEYSET,
+                                     request.args.get('after'), request.args.get('before'), limit)
+    except pagination.InvalidToken:
+        return error('invalid page token', 400)
+    except ValueError as e:
+        return error(f'invalid filter: {e}', 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': page.rows, 'next': page.next_token, 'prev': page.prev_token})
+
+
+@blueprint.route('/artists/<int:username>/merchandise')
+def artist_merchandise(username):
+    """The artist's available products (cached per artist)"""
+    try:
+        rows = merchandise.available_products(_primary_connection, current_app.extensions['merchandise_cache'], username)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': rows})
+
+
+@blueprint.route('/merchandise/import', methods=['POST'])
+def import_merchandise():
+    """Bulk insert from a CSV body (text/csv, header row) or a JSON array of products.
+
+    Columns are those of merchandise_product without product_id; artists may
+    leave out ``username``. Nothing is inserted unless every row is valid.
+    """
+    failure = _login_required()
+    if failure:
+        return failure
+    if request.mimetype not in ('text/csv', 'application/json'):
+        return error('send text/csv or application/json', 415)
+    conn = _connection()
+    try:
+        role = roles.current_role(conn)
+        if role not in ('artist', 'manager'):
+            return error('only artists and managers can import merchandise', 403)
+        owner = session['username'] if role == 'artist' else None
+        rows = merchandise.import_rows(merchandise.read_records(request.get_data(), request.mimetype), owner)
+        merchandise.check_owners(conn, rows, session['username'], role)
+        imported = merchandise.import_products(conn, current_app.extensions['merchandise_cache'], rows)
+    except merchandise.InvalidImport as e:
+        conn.rollback()
+        return json_response({'error': 'invalid import', 'errors': e.errors}, 400)
+    except (ValueError, csv.Error) as e:
+        return error(f'unreadable body: {e}', 400)
+    except psycopg2.Error as e:
+        conn.rollback()
+        return error(f'database error: {e}', 503)
+    return json_response({'data': {'imported': imported}}, 201)
+
+
+# ==================== CHANNELS ====================
+
+
+@blueprint.route('/channels')
+def list_channels():
+    """Channel directory by ``genre``, ``country`` and ``city``, from the worker's snapshot when enabled"""
+    filters = channels.filters_from(request.args)
+    limit = pagination.page_size(request.args.get('limit'))
+    try:
+        snapshot = current_app.extensions['channel_directory'].snapshot()
+        if snapshot is not None:
+            page = snapshot.page(filters, request.args.get('after'), request.args.get('before'), limit)
+        else:
+            sql, params = channels.channels_query(filters)
+            page = pagination.fetch_page(_connection(), sql, params, channels.CHANNELS_KEYSET,
+                                         request.args.get('after'), request.args.get('before'), limit)
+    except pagination.InvalidToken:
+        return error('invalid page token', 400)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({'data': page.rows, 'next': page.next_token, 'prev': page.prev_token})
+
+
+@blueprint.route('/channels/<int:channel_id>')
+def get_channel(channel_id):
+    try:
+        row = channels.channel(_connection(), channel_id)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    if row is None:
+        return error(f'channel {channel_id} not found', 404)
+    return json_response({'data': row})
+
+
+@blueprint.route('/moderators/<int:username>/channels')
+def moderator_channels(username):
+    """A moderator's channels with the per-moderator summary (migration 0011)"""
+    try:
+        summary, rows = channels.moderator_channels(_connection(), username)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    if summary is None:
+        return error(f'user {username} moderates no channel', 404)
+    return json_response({'data': {**summary, 'channels': rows}})
+
+
+# ==================== REPORTS ====================
+
+
+@blueprint.route('/reports')
+def list_reports():
+    return json_response({'data': {
+        name: {'question': r.question, 'title': r.title, 'params': r.params,
+               'materialized': r.view_sql is not None, 'login_required': r.login_required}
+        for name, r in reports.REPORTS.items()
+    }})
+
+
+@blueprint.route('/reports/<name>')
+def run_report(name):
+    """One of the main.xml reports; parameters are query arguments, defaults as in main.xml"""
+    report = reports.REPORTS.get(name)
+    if report is None:
+        return error(f"unknown report {name!r}; available: {', '.join(reports.REPORTS)}", 404)
+    if report.login_required:
+        failure = _login_required()
+        if failure:
+            return failure
+    limit = pagination.page_size(request.args.get('limit'), default=reports.DEFAULT_LIMIT,
+                                 maximum=reports.MAX_LIMIT)
+    use_views = current_app.extensions['reports_use_views']
+    try:
+        rows = report.run(_connection(), request.args, limit, use_views=use_views)
+    except psycopg2.Error as e:
+        return error(f'database error: {e}', 503)
+    return json_response({
+        'data': rows,
+        'params': {key: value for key, value in report.arguments(request.args).items() if key != 'limit'},
+        'materialized': use_views and report.view_sql is not None,
+    })
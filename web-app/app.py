@@ -1,30 +1,86 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Response, stream_template, stream_with_context
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from werkzeug.security import generate_password_hash, check_password_hash
+from psycopg2.extras import RealDictCursor, execute_values
 from datetime import datetime
 from dotenv import load_dotenv
+from markupsafe import Markup
 import os
 
+import db
+import stats as homepage_stats
+import pagination
+import search as search_engine
+import roles
+import hashing
+import instrumentation
+import page_cache as fragment_cache
+import summaries
+import templating
+import api
+import friends
+import recommend
+import reports
+import merchandise as merchandise_shop
+import channels
+
 # ==================== APP SETUP ====================
 
 app = Flask(__name__)
 load_dotenv()
 app.secret_key = os.getenv('SECRET_KEY')
+templating.init_app(app)
+
+DATABASE_CONFIG = db.config_from_env()
+
+db_pool = db.pool_from_env(DATABASE_CONFIG, connection_factory=instrumentation.InstrumentedConnection)
+db.init_app(app, db_pool)
+
+# GET requests read from DB_READ_HOSTS replicas when configured
+db_router = db.router_from_env(db_pool, connection_factory=instrumentation.InstrumentedConnection)
+db_router.init_app(app)
+
+app.register_blueprint(api.blueprint)
+friends.init_app(app, friends.cache_from_env())
+
+# available products per artist, dropped when the artist's products change
+product_cache = merchandise_shop.cache_from_env()
+merchandise_shop.init_app(app, product_cache)
+
+instrumentation.init_app(app)
 
-DATABASE_CONFIG = {
-    'host' : os.getenv('DB_HOST'),
-    'database' : os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'port': os.getenv('DB_PORT', 5432)
-}
+stats_cache = homepage_stats.stats_from_env()
+password_hasher = hashing.hasher_from_env()
+page_cache = fragment_cache.cache_from_env()
+
+summary_refresher = summaries.refresher_from_env(db_pool)
+summary_refresher.init_app(app)
+
+# recomputes "more like this" for songs of changed playlists; their cached pages are dropped
+neighbour_refresher = recommend.refresher_from_env(
+    db_pool, on_update=lambda song_ids: page_cache.invalidate('song', *song_ids))
+neighbour_refresher.init_app(app)
+
+# REPORTS_USE_VIEWS=1: reports read the materialized views of migration 0009
+report_refresher = reports.refresher_from_env(db_pool)
+reports.init_app(app, report_refresher, reports.use_views_from_env())
+
+# per-worker in-memory snapshot of the public channel directory (/api/v1/channels)
+channel_directory = channels.directory_from_env(db_pool)
+channel_directory.init_app(app)
 
 def get_db_connection():
-    """Create database connection"""
+    """Check out the request's pooled connection (a replica for reads, see db.ReplicaRouter)"""
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG, cursor_factory=RealDictCursor)
-        return conn
+        return db_router.get_connection()
+    except psycopg2.Error as e:
+        print(f"Database connection error: {e}")
+        return None
+
+def get_primary_connection():
+    """Primary connection for renders kept in the page cache (a replica may be behind)"""
+    try:
+        return db_router.primary_connection()
     except psycopg2.Error as e:
         print(f"Database connection error: {e}")
         return None
@@ -39,6 +95,36 @@ def require_login():
         return redirect(url_for('login'))
     return None
 
+def list_rows(conn, sql, keyset, params=()):
+    """Rows for a list page: one keyset page, or a row stream with ?stream=1"""
+    after = request.args.get('after')
+    before = request.args.get('before')
+    try:
+        if request.args.get('stream') == '1':
+            if after:
+                pagination.decode_token(after)  # fail before the response starts
+            return pagination.stream_rows(conn, sql, params, keyset, after=after), None
+        limit = pagination.page_size(request.args.get('limit'))
+        page = pagination.fetch_page(conn, sql, params, keyset, after, before, limit)
+    except pagination.InvalidToken:
+        flash('Invalid page link, showing the first page', 'warning')
+        page = pagination.fetch_page(conn, sql, params, keyset)
+    return page.rows, page
+
+def render_list(template, page, **context):
+    """Render a list page; streamed rows are rendered as they are fetched"""
+    if page is None:
+        return Response(stream_with_context(stream_template(template, page=None, **context)))
+    return render_template(template, page=page, **context)
+
+def render_detail(template, fragments):
+    """Detail page around a rendered fragment (``{'title', 'body'}``)"""
+    return render_template(template, title=fragments['title'], fragment=Markup(fragments['body']))
+
+def render_cached_detail(template, entry):
+    """Cached detail page with ETag / Last-Modified, 304 when the client is current"""
+    return fragment_cache.conditional_response(entry, lambda: render_detail(template, entry['fragments']))
+
 
 
 # ==================== AUTH ROUTES ====================
@@ -73,7 +159,7 @@ def register():
                 return render_template('auth/register.html')
 
             # Insert new user; username is auto-generated SERIAL
-            hashed_password = generate_password_hash(password)
+            hashed_password = password_hasher.hash(password)
             cur.execute('''
                 INSERT INTO users (full_name, email, password_hash)
                 VALUES (%s, %s, %s)
@@ -108,14 +194,16 @@ def register():
                 ''', (username, '', ''))
 
             conn.commit()
+            stats_cache.invalidate()
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('login'))
 
+        except hashing.HashingBusy:
+            flash('The server is busy, please try again in a moment', 'error')
+            conn.rollback()
         except psycopg2.Error as e:
             flash(f'Registration failed: {e}', 'error')
             conn.rollback()
-        finally:
-            conn.close()
 
     return render_template('auth/register.html')
 
@@ -132,22 +220,16 @@ def login():
             return render_template('auth/login.html')
 
         try:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute('''
-    SELECT username, full_name, email, password_hash,
-           CASE
-               WHEN EXISTS (SELECT 1 FROM artist_user WHERE username = users.username) THEN 'artist'
-               WHEN EXISTS (SELECT 1 FROM manager_user WHERE username = users.username) THEN 'manager'
-               WHEN EXISTS (SELECT 1 FROM content_moderator_user WHERE username = users.username) THEN 'content_moderator'
-               ELSE 'basic'
-           END AS user_type
-    FROM users
-    WHERE email = %s
-''', (email,))
-            user = cur.fetchone()
-
-
-            if user and check_password_hash(user['password_hash'], password):
+            user = roles.find_login(conn, email)
+
+            if user and password_hasher.verify(user['password_hash'], password):
+                # Upgrade hashes made with older work-factor settings
+                if password_hasher.needs_rehash(user['password_hash']):
+                    cur = conn.cursor()
+                    cur.execute('UPDATE users SET password_hash = %s WHERE username = %s',
+                                (password_hasher.hash(password), user['username']))
+                    conn.commit()
+                    password_hasher.note_rehash()
                 session['username'] = user['username']
                 session['full_name'] = user['full_name']
                 session['email'] = user['email']
@@ -157,10 +239,11 @@ def login():
             else:
                 flash('Invalid email or password', 'error')
 
+        except hashing.HashingBusy:
+            flash('The server is busy, please try again in a moment', 'error')
+            return render_template('auth/login.html'), 503
         except psycopg2.Error as e:
             flash(f'Login failed: {e}', 'error')
-        finally:
-            conn.close()
 
     return render_template('auth/login.html')
 
@@ -182,6 +265,13 @@ def logout():
 
 
 
+RECENT_EVENTS_SQL = '''
+    SELECT e.*, l.address, l.city, l.region, l.country
+    FROM event e
+    LEFT JOIN location l ON e.location_id = l.location_id
+    ORDER BY e.date DESC LIMIT 5
+'''
+
 @app.route('/')
 def index():
     conn = get_db_connection()
@@ -189,35 +279,17 @@ def index():
         return render_template('index.html', stats=None)
     
     try:
-        cur = conn.cursor()
-        stats = {}
-        cur.execute('SELECT COUNT(*) as count FROM users')
-        stats['users'] = cur.fetchone()['count']
-        
-        cur.execute('SELECT COUNT(*) as count FROM artist_user')
-        stats['artists'] = cur.fetchone()['count']
-        
-        cur.execute('SELECT COUNT(*) as count FROM song')
-        stats['songs'] = cur.fetchone()['count']
-        
-        cur.execute('SELECT COUNT(*) as count FROM event')
-        stats['events'] = cur.fetchone()['count']
-        
+        stats = stats_cache.get(db_router.primary_connection)
+
         # Get recent events
-        cur.execute('''
-            SELECT e.*, l.address, l.city, l.region, l.country 
-            FROM event e 
-            LEFT JOIN location l ON e.location_id = l.location_id 
-            ORDER BY e.date DESC LIMIT 5
-        ''')
+        cur = conn.cursor()
+        cur.execute(RECENT_EVENTS_SQL)
         recent_events = cur.fetchall()
         
-        conn.close()
         return render_template('index.html', stats=stats, recent_events=recent_events)
         
     except psycopg2.Error as e:
         flash(f'Database error: {e}', 'error')
-        conn.close()
         return render_template('index.html', stats=None)
 
 
@@ -228,38 +300,22 @@ def profile():
         flash('You must be logged in to view your profile.', 'error')
         return redirect(url_for('login'))
 
-    user_type = session.get('user_type')
     username = session['username']
 
     conn = get_db_connection()
+    if not conn:
+        flash('Database connection failed', 'error')
+        return redirect(url_for('index'))
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    # Fetch main user info
-    cur.execute('SELECT * FROM users WHERE username = %s', (username,))
-    user = cur.fetchone()
-
-    # Fetch type-specific info
-    type_info = {}
-    artist_songs = []
-    if user_type == 'artist':
-        cur.execute('SELECT * FROM artist_user WHERE username = %s', (username,))
-        type_info = cur.fetchone() or {}
-        cur.execute('''
-            SELECT s.song_id, s.name 
-            FROM song s
-            JOIN song_artist_user sau ON s.song_id = sau.song_id
-            WHERE sau.username = %s
-        ''', (username,))
-        artist_songs = cur.fetchall()
-    elif user_type == 'manager':
-        cur.execute('SELECT * FROM manager_user WHERE username = %s', (username,))
-        type_info = cur.fetchone() or {}
-    elif user_type == 'basic':
-        cur.execute('SELECT * FROM basic_user WHERE username = %s', (username,))
-        type_info = cur.fetchone() or {}
-    elif user_type == 'moderator':
-        cur.execute('SELECT * FROM content_moderator_user WHERE username = %s', (username,))
-        type_info = cur.fetchone() or {}
+    # User, role and type-specific info in one query
+    profile_row = roles.load_profile(conn, username)
+    if not profile_row:
+        session.clear()
+        flash('Your account no longer exists.', 'error')
+        return redirect(url_for('login'))
+    user, user_type, type_info, artist_songs = profile_row
+    session['user_type'] = user_type
 
     # Handle profile update
     if request.method == 'POST':
@@ -279,12 +335,17 @@ def profile():
         old_password = request.form.get('old_password')
         new_password = request.form.get('new_password')
         if old_password and new_password:
-            if check_password_hash(user['password_hash'], old_password):
-                hashed_password = generate_password_hash(new_password)
-                cur.execute('UPDATE users SET password_hash=%s WHERE username=%s', (hashed_password, username))
-                messages.append('Password updated successfully!')
-            else:
-                messages.append('Old password is incorrect.')
+            try:
+                if password_hasher.verify(user['password_hash'], old_password):
+                    hashed_password = password_hasher.hash(new_password)
+                    cur.execute('UPDATE users SET password_hash=%s WHERE username=%s', (hashed_password, username))
+                    messages.append('Password updated successfully!')
+                else:
+                    messages.append('Old password is incorrect.')
+            except hashing.HashingBusy:
+                conn.rollback()
+                flash('The server is busy, please try again in a moment', 'error')
+                return redirect(url_for('profile'))
 
         # Update type-specific info
         if user_type == 'artist':
@@ -297,6 +358,9 @@ def profile():
                 SET discography=%s, biography=%s, genre=%s, photos=%s
                 WHERE username=%s
             ''', (discography, biography, genre, photos, username))
+            # song pages show the artist's name
+            cur.execute('SELECT song_id FROM song_artist_user WHERE username = %s', (username,))
+            artist_song_ids = [row['song_id'] for row in cur.fetchall()]
         elif user_type == 'manager':
             role_for_artist = request.form.get('role_for_artist')
             tasks = request.form.get('tasks')
@@ -328,7 +392,7 @@ def profile():
             ''', (birth_date, preferences, profile_description, credit_card,
                   subscription_type, subscription_price, subscription_date,
                   bank_information, username))
-        elif user_type == 'moderator':
+        elif user_type == 'content_moderator':
             tasks = request.form.get('tasks')
             moderation_history = request.form.get('moderation_history')
             cur.execute('''
@@ -338,7 +402,10 @@ def profile():
             ''', (tasks, moderation_history, username))
 
         conn.commit()
-        conn.close()
+        roles.invalidate_role()
+        if user_type == 'artist':
+            page_cache.invalidate('artist', username)
+            page_cache.invalidate('song', *artist_song_ids)
 
         # Flash all messages at once
         for msg in messages:
@@ -348,7 +415,6 @@ def profile():
 
         return redirect(url_for('profile'))  # <- redirect prevents duplicates
 
-    conn.close()
     return render_template(
         'auth/profile.html',
         user=user,
@@ -365,6 +431,16 @@ def profile():
 
 
 
+# artist_summary (migration 0005) is kept current by triggers
+ARTISTS_SQL = '''
+    SELECT au.username, au.full_name, au.email, au.genre,
+           au.song_count, au.event_count, au.next_event_date, au.merch_count
+    FROM artist_summary au
+    WHERE {keyset}
+    ORDER BY {order}
+'''
+ARTISTS_KEYSET = pagination.Keyset(['au.username'])
+
 @app.route('/artists')
 def artists():
     conn = get_db_connection()
@@ -372,72 +448,75 @@ def artists():
         return render_template('artists/list.html', artists=[])
     
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT u.username, u.full_name, u.email, au.genre
-            FROM users u
-            JOIN artist_user au ON u.username = au.username
-            ORDER BY u.username
-        ''')
-        artists = cur.fetchall()
-        conn.close()
-        return render_template('artists/list.html', artists=artists)
+        artists, page = list_rows(conn, ARTISTS_SQL, ARTISTS_KEYSET)
+        return render_list('artists/list.html', page, artists=artists)
         
     except psycopg2.Error as e:
         flash(f'Error loading artists: {e}', 'error')
-        conn.close()
         return render_template('artists/list.html', artists=[])
 
+ARTIST_SQL = '''
+    SELECT u.username, u.full_name, u.email, au.genre, au.biography
+    FROM users u
+    JOIN artist_user au ON u.username = au.username
+    WHERE au.username = %s
+'''
+
+ARTIST_SONGS_SQL = '''
+    SELECT s.*
+    FROM song s
+    JOIN song_artist_user sau ON s.song_id = sau.song_id
+    WHERE sau.username = %s
+'''
+
+ARTIST_EVENTS_SQL = '''
+    SELECT e.*, l.city as location_name
+    FROM event e
+    LEFT JOIN location l ON e.location_id = l.location_id
+    JOIN event_artist_user eau ON e.event_id = eau.event_id
+    WHERE eau.username = %s
+    ORDER BY e.date DESC
+'''
+
 @app.route('/artist/<username>')
 def artist_detail(username):
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for('artists'))
-
-    try:
+    def render():
+        conn = get_primary_connection()
+        if not conn:
+            raise psycopg2.OperationalError('database connection failed')
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Get artist info
-        cur.execute('''
-            SELECT u.username, u.full_name, u.email, au.genre, au.biography
-            FROM users u
-            JOIN artist_user au ON u.username = au.username
-            WHERE au.username = %s
-        ''', (username,))
+        cur.execute(ARTIST_SQL, (username,))
         artist = cur.fetchone()
 
         if not artist:
-            flash('Artist not found', 'error')
-            return redirect(url_for('artists'))
+            return None
 
         # Get artist's songs
-        cur.execute('''
-            SELECT s.*
-            FROM song s
-            JOIN song_artist_user sau ON s.song_id = sau.song_id
-            WHERE sau.username = %s
-        ''', (username,))
+        cur.execute(ARTIST_SONGS_SQL, (username,))
         songs = cur.fetchall()
 
         # Get artist's events
-        cur.execute('''
-            SELECT e.*, l.city as location_name
-            FROM event e
-            LEFT JOIN location l ON e.location_id = l.location_id
-            JOIN event_artist_user eau ON e.event_id = eau.event_id
-            WHERE eau.username = %s
-            ORDER BY e.date DESC
-        ''', (username,))
+        cur.execute(ARTIST_EVENTS_SQL, (username,))
         events = cur.fetchall()
 
-        conn.close()
-        return render_template('artists/detail.html', artist=artist, songs=songs, events=events)
+        return {
+            'title': artist['full_name'],
+            'body': render_template('artists/_detail.html', artist=artist, songs=songs, events=events),
+        }
 
+    try:
+        entry = page_cache.get_or_render('artist', username, render)
     except psycopg2.Error as e:
         flash(f'Error loading artist: {e}', 'error')
-        conn.close()
         return redirect(url_for('artists'))
 
+    if entry is None:
+        flash('Artist not found', 'error')
+        return redirect(url_for('artists'))
+    return render_cached_detail('artists/detail.html', entry)
+
 
 
 
@@ -449,6 +528,15 @@ def artist_detail(username):
 
 
 
+# One row per song with its artists aggregated, maintained by triggers (migration 0005)
+SONGS_SQL = '''
+    SELECT s.song_id, s.name, s.artist_names AS artist_name
+    FROM song_summary s
+    WHERE {keyset}
+    ORDER BY {order}
+'''
+SONGS_KEYSET = pagination.Keyset(['s.name', 's.song_id'], descending=True)
+
 @app.route('/songs')
 def songs():
     conn = get_db_connection()
@@ -456,51 +544,62 @@ def songs():
         return render_template('songs/list.html', songs=[])
     
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)  # Use RealDictCursor for dict rows
-        cur.execute('''
-            SELECT s.song_id, s.name, u.full_name AS artist_name 
-            FROM song s 
-            LEFT JOIN song_artist_user sau ON s.song_id = sau.song_id 
-            LEFT JOIN artist_user au ON sau.username = au.username 
-            LEFT JOIN users u ON au.username = u.username
-            ORDER BY s.name DESC
-        ''')
-        songs = cur.fetchall()
-        conn.close()
-        return render_template('songs/list.html', songs=songs)
+        songs, page = list_rows(conn, SONGS_SQL, SONGS_KEYSET)
+        return render_list('songs/list.html', page, songs=songs)
         
     except psycopg2.Error as e:
         flash(f'Error loading songs: {e}', 'error')
-        conn.close()
         return render_template('songs/list.html', songs=[])
 
 
+SONG_SQL = 'SELECT song_id, name, lyrics FROM song WHERE song_id = %s'
+
+SONG_ARTISTS_SQL = '''
+    SELECT u.full_name AS artist_name, au.username AS artist_username
+    FROM song_artist_user sau
+    JOIN artist_user au ON sau.username = au.username
+    JOIN users u ON au.username = u.username
+    WHERE sau.song_id = %s
+'''
+
 @app.route('/song/<int:song_id>')
 def song_detail(song_id):
-    conn = get_db_connection()
-    try:
+    def render():
+        conn = get_primary_connection()
+        if not conn:
+            raise psycopg2.OperationalError('database connection failed')
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # Get song info
-        cur.execute('SELECT song_id, name, lyrics FROM song WHERE song_id = %s', (song_id,))
+        cur.execute(SONG_SQL, (song_id,))
         song = cur.fetchone()
+        if not song:
+            return None
 
         # Get artists
-        cur.execute('''
-            SELECT u.full_name AS artist_name, au.username AS artist_username
-            FROM song_artist_user sau
-            JOIN artist_user au ON sau.username = au.username
-            JOIN users u ON au.username = u.username
-            WHERE sau.song_id = %s
-        ''', (song_id,))
+        cur.execute(SONG_ARTISTS_SQL, (song_id,))
         artists = cur.fetchall()
 
-        conn.close()
-        return render_template('songs/detail.html', song=song, artists=artists)
+        # More like this: the song's precomputed neighbours
+        cur.execute(recommend.SIMILAR_SONGS_SQL, (song_id, recommend.SHOW_SIMILAR))
+        similar = cur.fetchall()
+
+        return {
+            'title': song['name'],
+            'body': render_template('songs/_detail.html', song=song, artists=artists, similar=similar),
+        }
+
+    try:
+        entry = page_cache.get_or_render('song', song_id, render)
     except psycopg2.Error as e:
         flash(f'Error loading song: {e}', 'error')
-        conn.close()
-        return render_template('songs/detail.html', song=None, artists=[])
+        entry = None
+
+    if entry is None:
+        return render_detail('songs/detail.html', {
+            'title': 'Song', 'body': render_template('songs/_detail.html', song=None, artists=[]),
+        })
+    return render_cached_detail('songs/detail.html', entry)
 
 
 
@@ -538,14 +637,14 @@ def add_song():
                         (song_id, session['username']))
 
             conn.commit()
+            stats_cache.invalidate()
+            page_cache.invalidate('artist', session['username'])
             flash('Song added successfully!', 'success')
             return redirect(url_for('songs'))
 
         except psycopg2.Error as e:
             flash(f'Error adding song: {e}', 'error')
             conn.rollback()
-        finally:
-            conn.close()
 
     return render_template('songs/add.html')
 
@@ -558,6 +657,15 @@ def add_song():
 
 
 
+PLAYLISTS_SQL = '''
+    SELECT p.*, bu.basic_user_username AS owner_name
+    FROM playlist p
+    JOIN basic_user bu ON p.username = bu.username
+    WHERE {keyset}
+    ORDER BY {order}
+'''
+PLAYLISTS_KEYSET = pagination.Keyset(['p.playlist_id'], descending=True)
+
 @app.route('/playlists')
 def playlists():
     login_check = require_login()
@@ -566,22 +674,14 @@ def playlists():
 
     conn = get_db_connection()
     playlists = []
+    page = pagination.Page([])
     if conn:
         try:
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
             # Show all playlists
-            cur.execute('''
-                SELECT p.*, bu.basic_user_username AS owner_name
-                FROM playlist p
-                JOIN basic_user bu ON p.username = bu.username
-                ORDER BY p.playlist_id DESC
-            ''')
-            playlists = cur.fetchall()
+            playlists, page = list_rows(conn, PLAYLISTS_SQL, PLAYLISTS_KEYSET)
         except psycopg2.Error as e:
             flash(f'Error loading playlists: {e}', 'danger')
-        finally:
-            conn.close()
-    return render_template('playlists/list.html', playlists=playlists)
+    return render_list('playlists/list.html', page, playlists=playlists)
 
 
 @app.route('/create_playlist', methods=['GET', 'POST'])
@@ -623,12 +723,25 @@ def create_playlist():
 
         except psycopg2.Error as e:
             flash(f'Error creating playlist: {e}', 'danger')
-        finally:
-            conn.close()
 
     return render_template('playlists/create.html')
 
 
+PLAYLIST_SQL = '''
+    SELECT p.*, bu.basic_user_username AS owner_name
+    FROM playlist p
+    JOIN basic_user bu ON p.username = bu.username
+    WHERE p.playlist_id = %s
+'''
+
+PLAYLIST_SONGS_SQL = '''
+    SELECT s.*
+    FROM song s
+    JOIN song_playlist sp ON s.song_id = sp.song_id
+    WHERE sp.playlist_id = %s
+    ORDER BY sp.position, s.song_id
+'''
+
 @app.route('/playlist/<int:playlist_id>')
 def playlist_detail(playlist_id):
     login_check = require_login()
@@ -642,18 +755,13 @@ def playlist_detail(playlist_id):
 
     playlist = None
     songs_in_playlist = []
-    songs_available = []
+    suggestions = []
 
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # Get playlist info
-        cur.execute('''
-            SELECT p.*, bu.basic_user_username AS owner_name
-            FROM playlist p
-            JOIN basic_user bu ON p.username = bu.username
-            WHERE p.playlist_id = %s
-        ''', (playlist_id,))
+        cur.execute(PLAYLIST_SQL, (playlist_id,))
         playlist = cur.fetchone()
 
         if not playlist:
@@ -661,38 +769,72 @@ def playlist_detail(playlist_id):
             return redirect(url_for('playlists'))
 
         # Songs already in playlist
-        cur.execute('''
-            SELECT s.*
-            FROM song s
-            JOIN song_playlist sp ON s.song_id = sp.song_id
-            WHERE sp.playlist_id = %s
-        ''', (playlist_id,))
+        cur.execute(PLAYLIST_SONGS_SQL, (playlist_id,))
         songs_in_playlist = cur.fetchall()
 
-        # Songs NOT in playlist (to show in dropdown for adding)
-        cur.execute('''
-            SELECT *
-            FROM song
-            WHERE song_id NOT IN (
-                SELECT song_id FROM song_playlist WHERE playlist_id = %s
-            )
-        ''', (playlist_id,))
-        songs_available = cur.fetchall()
+        # Suggested additions: neighbours of the most recently added songs
+        cur.execute(recommend.SUGGESTED_SONGS_SQL, {
+            'playlist_id': playlist_id, 'seeds': recommend.SUGGEST_SEEDS, 'limit': recommend.SHOW_SUGGESTED,
+        })
+        suggestions = cur.fetchall()
 
     except psycopg2.Error as e:
         flash(f'Error loading playlist: {e}', 'danger')
         return redirect(url_for('playlists'))
-    finally:
-        conn.close()
 
     return render_template(
         'playlists/detail.html',
         playlist=playlist,
         songs_in_playlist=songs_in_playlist,
-        songs_available=songs_available
+        suggestions=suggestions
     )
 
 
+# Songs not yet in the playlist, by case-insensitive name prefix (anti-join)
+AVAILABLE_SONGS_SQL = '''
+    SELECT s.song_id, s.name, lower(s.name) COLLATE "C" AS sort_name
+    FROM song s
+    WHERE lower(s.name) COLLATE "C" LIKE %s
+      AND NOT EXISTS (
+          SELECT 1 FROM song_playlist sp
+          WHERE sp.playlist_id = %s AND sp.song_id = s.song_id
+      )
+      AND {keyset}
+    ORDER BY {order}
+'''
+AVAILABLE_SONGS_KEYSET = pagination.Keyset(['lower(s.name) COLLATE "C"', 's.song_id'],
+                                           keys=['sort_name', 'song_id'])
+
+@app.route('/playlist/<int:playlist_id>/available_songs')
+def playlist_available_songs(playlist_id):
+    """JSON song picker for playlist_detail(): ?q=<prefix>&after=<token>&limit=<n>"""
+    if not is_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+
+    prefix = request.args.get('q', '').strip().lower()
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    limit = pagination.page_size(request.args.get('limit'), default=20, maximum=100)
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'success': False, 'message': 'Database connection failed'}), 503
+
+    try:
+        page = pagination.fetch_page(conn, AVAILABLE_SONGS_SQL, (pattern, playlist_id),
+                                     AVAILABLE_SONGS_KEYSET, after=request.args.get('after'),
+                                     limit=limit)
+    except pagination.InvalidToken:
+        return jsonify({'success': False, 'message': 'Invalid page token'}), 400
+    except psycopg2.Error as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+    return jsonify({
+        'success': True,
+        'songs': [{'song_id': row['song_id'], 'name': row['name']} for row in page.rows],
+        'next': page.next_token,
+    })
+
+
 
 @app.route('/add_song_to_playlist', methods=['POST'])
 def add_song_to_playlist():
@@ -709,20 +851,121 @@ def add_song_to_playlist():
 
     try:
         cur = conn.cursor()
-        # Check if song is already in playlist
-        cur.execute('SELECT 1 FROM song_playlist WHERE playlist_id = %s AND song_id = %s', (playlist_id, song_id))
-        if cur.fetchone():
+        # Same row lock as edit_playlist_songs: concurrent appends get distinct positions
+        cur.execute('SELECT 1 FROM playlist WHERE playlist_id = %s FOR UPDATE', (playlist_id,))
+        if not cur.fetchone():
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Playlist not found'})
+        # Append at the end; the primary key makes a duplicate a no-op
+        cur.execute('''
+            INSERT INTO song_playlist (song_id, playlist_id, position)
+            SELECT %s, %s, COALESCE(MAX(position), 0) + 1
+            FROM song_playlist WHERE playlist_id = %s
+            ON CONFLICT DO NOTHING
+        ''', (song_id, playlist_id, playlist_id))
+        if cur.rowcount == 0:
+            conn.rollback()
             return jsonify({'success': False, 'message': 'Song already in playlist'})
-
-        # Insert song into playlist
-        cur.execute('INSERT INTO song_playlist (song_id, playlist_id) VALUES (%s, %s)', (song_id, playlist_id))
         conn.commit()
         return jsonify({'success': True, 'message': 'Song added to playlist'})
 
     except psycopg2.Error as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        conn.close()
+
+
+MAX_BULK_SONGS = 5000
+
+def _song_id_list(value):
+    """Validate a JSON list of song ids, dropping duplicates but keeping order"""
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(v, int) for v in value):
+        raise ValueError('song id lists must be arrays of integers')
+    return list(dict.fromkeys(value))
+
+@app.route('/playlist/<int:playlist_id>/songs', methods=['POST'])
+def edit_playlist_songs(playlist_id):
+    """Bulk edit in one transaction: {"add": [...], "remove": [...], "order": [...]}
+
+    ``add`` appends songs in the given order (already present ones are
+    skipped), ``remove`` drops songs and ``order`` moves the listed songs to
+    the top in that order; positions are renumbered 1..n afterwards.
+    """
+    if not is_logged_in():
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        add = _song_id_list(data.get('add'))
+        remove = _song_id_list(data.get('remove'))
+        order = _song_id_list(data.get('order'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if max(len(add), len(remove), len(order)) > MAX_BULK_SONGS:
+        return jsonify({'success': False, 'message': f'At most {MAX_BULK_SONGS} songs per request'}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'success': False, 'message': 'Database connection failed'}), 503
+
+    try:
+        cur = conn.cursor()
+        # Row lock serializes concurrent edits of the same playlist's positions
+        cur.execute('SELECT username FROM playlist WHERE playlist_id = %s FOR UPDATE', (playlist_id,))
+        playlist = cur.fetchone()
+        if not playlist:
+            return jsonify({'success': False, 'message': 'Playlist not found'}), 404
+        if playlist['username'] != session['username']:
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Only the owner can edit this playlist'}), 403
+
+        removed = added = 0
+        if remove:
+            cur.execute('DELETE FROM song_playlist WHERE playlist_id = %s AND song_id = ANY(%s)',
+                        (playlist_id, remove))
+            removed = cur.rowcount
+
+        if add:
+            cur.execute('SELECT COALESCE(MAX(position), 0) AS last FROM song_playlist WHERE playlist_id = %s',
+                        (playlist_id,))
+            last = cur.fetchone()['last']
+            # Unknown song ids are skipped by the join instead of failing the FK
+            inserted = execute_values(cur, '''
+                INSERT INTO song_playlist (song_id, playlist_id, position)
+                SELECT v.song_id, %s, v.position
+                FROM (VALUES %%s) AS v(song_id, position)
+                JOIN song s ON s.song_id = v.song_id
+                ON CONFLICT DO NOTHING
+                RETURNING song_id
+            ''' % int(playlist_id), [(song_id, last + i) for i, song_id in enumerate(add, 1)],
+                page_size=1000, fetch=True)
+            added = len(inserted)
+
+        if order:
+            execute_values(cur, '''
+                UPDATE song_playlist sp SET position = v.position - %s
+                FROM (VALUES %%s) AS v(song_id, position)
+                WHERE sp.playlist_id = %s AND sp.song_id = v.song_id
+            ''' % (len(order) + 1, int(playlist_id)), list(zip(order, range(1, len(order) + 1))),
+                page_size=1000)
+
+        if remove or order:
+            cur.execute('''
+                UPDATE song_playlist sp SET position = r.rn
+                FROM (
+                    SELECT song_id, row_number() OVER (ORDER BY position, song_id) AS rn
+                    FROM song_playlist WHERE playlist_id = %s
+                ) r
+                WHERE sp.playlist_id = %s AND sp.song_id = r.song_id AND sp.position <> r.rn
+            ''', (playlist_id, playlist_id))
+
+        conn.commit()
+        return jsonify({'success': True, 'added': added, 'removed': removed,
+                        'message': f'{added} added, {removed} removed'})
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 
 
@@ -733,6 +976,16 @@ def add_song_to_playlist():
 
 
 
+EVENTS_SQL = '''
+    SELECT e.event_id, e.description, e.date, e.conditions,
+           l.country, l.region, l.city, l.address
+    FROM event e
+    LEFT JOIN location l ON e.location_id = l.location_id
+    WHERE {keyset}
+    ORDER BY {order}
+'''
+EVENTS_KEYSET = pagination.Keyset(['e.date', 'e.event_id'])
+
 @app.route('/events')
 def events():
     conn = get_db_connection()
@@ -740,27 +993,24 @@ def events():
         return render_template('events/list.html', events=[])
     
     try:
-        cur = conn.cursor()
-        # Fix: Use correct column names from your schema
-        cur.execute('''
-            SELECT e.event_id, e.description, e.date, e.conditions,
-                   l.country, l.region, l.city, l.address
-            FROM event e
-            LEFT JOIN location l ON e.location_id = l.location_id
-            ORDER BY e.date ASC
-        ''')
-        events = cur.fetchall()
-        conn.close()
-        return render_template('events/list.html', events=events)
+        events, page = list_rows(conn, EVENTS_SQL, EVENTS_KEYSET)
+        return render_list('events/list.html', page, events=events)
         
     except psycopg2.Error as e:
         flash(f'Error loading events: {e}', 'error')
-        conn.close()
         return render_template('events/list.html', events=[])
 
 
 
 
+EVENT_SQL = '''
+    SELECT e.event_id, e.description, e.date, e.conditions,
+           l.country, l.region, l.city, l.address
+    FROM event e
+    LEFT JOIN location l ON e.location_id = l.location_id
+    WHERE e.event_id = %s
+'''
+
 @app.route('/events/<int:event_id>')
 def event_detail(event_id):
     conn = get_db_connection()
@@ -770,15 +1020,8 @@ def event_detail(event_id):
 
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('''
-            SELECT e.event_id, e.description, e.date, e.conditions,
-                   l.country, l.region, l.city, l.address
-            FROM event e
-            LEFT JOIN location l ON e.location_id = l.location_id
-            WHERE e.event_id = %s
-        ''', (event_id,))
+        cur.execute(EVENT_SQL, (event_id,))
         event = cur.fetchone()
-        conn.close()
 
         if not event:
             flash("Event not found", "error")
@@ -788,7 +1031,6 @@ def event_detail(event_id):
 
     except psycopg2.Error as e:
         flash(f"Error loading event: {e}", "error")
-        conn.close()
         return redirect(url_for('events'))
 
 
@@ -841,11 +1083,14 @@ def create_event():
             # Associate event with artist if current user is an artist
             if session.get('user_type') == 'artist':
                 cur.execute('''
-                    INSERT INTO event_artist_user (event_id, artist_user_id) 
+                    INSERT INTO event_artist_user (event_id, username)
                     SELECT %s, username FROM artist_user WHERE username = %s
                 ''', (event_id, session['username']))
 
             conn.commit()
+            stats_cache.invalidate()
+            if session.get('user_type') == 'artist':
+                page_cache.invalidate('artist', session['username'])
             flash('Event created successfully!', 'success')
             return redirect(url_for('events'))
 
@@ -856,154 +1101,177 @@ def create_event():
         flash(f'Error creating event: {e}', 'error')
         return render_template('events/create.html', locations=locations)
 
-    finally:
-        if conn:
-            conn.close()
 
 
 
 
 
-# # ==================== MERCHANDISE ROUTES ====================
+# ==================== MERCHANDISE ROUTES ====================
 
 
-# @app.route('/merchandise')
-# def merchandise():
-#     conn = get_db_connection()
-#     if not conn:
-#         return render_template('merchandise/list.html', products=[])
-    
-#     try:
-#         cur = conn.cursor(cursor_factory=RealDictCursor)
-#         cur.execute('SELECT * FROM merchandise_product ORDER BY name')
-#         products = cur.fetchall()
-#         conn.close()
-#         return render_template('merchandise/list.html', products=products)
-        
-#     except psycopg2.Error as e:
-#         flash(f'Error loading merchandise: {e}', 'error')
-#         conn.close()
-#         return render_template('merchandise/list.html', products=[])
+@app.route('/merchandise')
+def merchandise():
+    """Storefront: available products by price, filtered by artist and price range"""
+    conn = get_db_connection()
+    if not conn:
+        return render_template('merchandise/list.html', products=[], filters={})
 
+    filters = {arg: request.args[arg] for arg in merchandise_shop.FILTER_ARGS if request.args.get(arg)}
+    try:
+        sql, params = merchandise_shop.products_query(filters)
+    except ValueError as e:
+        flash(f'Invalid filter: {e}', 'warning')
+        filters = {}
+        sql, params = merchandise_shop.products_query(filters)
 
-# @app.route('/add_merchandise', methods=['GET', 'POST'])
-# def add_merchandise():
-#     login_check = require_login()
-#     if login_check:
-#         return login_check
-    
-#     if session.get('user_type') not in ['artist', 'manager']:
-#         flash('Only artists and managers can add merchandise', 'error')
-#         return redirect(url_for('merchandise'))
-    
-#     if request.method == 'POST':
-#         name = request.form['name']
-#         description = request.form.get('description', '')
-#         price = request.form['price']
-#         stock_quantity = request.form['stock_quantity']
-#         category = request.form.get('category', '')
-
-#         conn = get_db_connection()
-#         if not conn:
-#             flash('Database connection failed', 'error')
-#             return render_template('merchandise/add.html')
-        
-#         try:
-#             cur = conn.cursor()
-#             cur.execute('''
-#                 INSERT INTO merchandise_product (name, description, price, stock_quantity, category, created_at)
-#                 VALUES (%s, %s, %s, %s, %s, %s)
-#             ''', (name, description, price, stock_quantity, category, datetime.now()))
-            
-#             conn.commit()
-#             conn.close()
-            
-#             flash('Merchandise added successfully!', 'success')
-#             return redirect(url_for('merchandise'))
-            
-#         except psycopg2.Error as e:
-#             flash(f'Error adding merchandise: {e}', 'error')
-#             conn.close()
-    
-#     return render_template('merchandise/add.html')
-
-
-
-# # ==================== SEARCH ROUTE ====================
-
-
-
-
-# @app.route('/search')
-# def search():
-#     query = request.args.get('q', '').strip()
-#     if not query:
-#         return render_template('search.html', results=None, query='')
-
-#     conn = get_db_connection()
-#     if not conn:
-#         flash('Database connection failed', 'error')
-#         return render_template('search.html', results=None, query=query)
-
-#     try:
-#         cur = conn.cursor(cursor_factory=RealDictCursor)
-#         search_pattern = f'%{query}%'
-#         results = {
-#             'artists': [],
-#             'songs': [],
-#             'events': [],
-#             'playlists': []
-#         }
-
-#         # Search artists
-#         cur.execute('''
-#             SELECT u.username, au.genre, au.biography 
-#             FROM users u
-#             JOIN artist_user au ON u.username = au.username
-#             WHERE u.username ILIKE %s OR au.genre ILIKE %s OR au.biography ILIKE %s
-#         ''', (search_pattern, search_pattern, search_pattern))
-#         results['artists'] = cur.fetchall()
-
-#         # Search songs
-#         cur.execute('''
-#             SELECT s.name AS title, u.username AS artist_name
-#             FROM song s
-#             JOIN song_artist_user sau ON s.song_id = sau.song_id
-#             JOIN artist_user au ON sau.username = au.username
-#             JOIN users u ON au.username = u.username
-#             WHERE s.name ILIKE %s
-#         ''', (search_pattern,))
-#         results['songs'] = cur.fetchall()
-
-#         # Search events
-#         cur.execute('''
-#             SELECT e.event_id, e.description, e.date, l.city AS location_name
-#             FROM event e
-#             LEFT JOIN location l ON e.location_id = l.location_id
-#             WHERE e.description ILIKE %s
-#         ''', (search_pattern,))
-#         results['events'] = cur.fetchall()
-
-#         # Search playlists (public only)
-#         cur.execute('''
-#             SELECT p.playlist_id, p.name, u.username AS owner_name
-#             FROM playlist p
-#             JOIN basic_user bu ON p.basic_user_id = bu.basic_user_id
-#             JOIN users u ON bu.username = u.username
-#             WHERE p.is_public = TRUE AND p.name ILIKE %s
-#         ''', (search_pattern,))
-#         results['playlists'] = cur.fetchall()
-
-#         conn.close()
-#         return render_template('search.html', results=results, query=query)
-
-#     except psycopg2.Error as e:
-#         flash(f'Search error: {e}', 'error')
-#         conn.close()
-#         return render_template('search.html', results=None, query=query)
+    try:
+        products, page = list_rows(conn, sql, merchandise_shop.PRODUCTS_KEYSET, params)
+        return render_list('merchandise/list.html', page, products=products, filters=filters)
+
+    except psycopg2.Error as e:
+        flash(f'Error loading merchandise: {e}', 'error')
+        return render_template('merchandise/list.html', products=[], filters=filters)
+
+
+@app.route('/artist/<int:username>/merchandise')
+def artist_merchandise(username):
+    conn = get_db_connection()
+    if not conn:
+        flash('Database connection failed', 'error')
+        return redirect(url_for('merchandise'))
+
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(ARTIST_SQL, (username,))
+        artist = cur.fetchone()
+        if not artist:
+            flash('Artist not found', 'error')
+            return redirect(url_for('merchandise'))
+        products = merchandise_shop.available_products(db_router.primary_connection, product_cache, username)
+        return render_template('merchandise/artist.html', artist=artist, products=products)
+
+    except psycopg2.Error as e:
+        flash(f'Error loading merchandise: {e}', 'error')
+        return redirect(url_for('merchandise'))
+
+
+@app.route('/add_merchandise', methods=['GET', 'POST'])
+def add_merchandise():
+    login_check = require_login()
+    if login_check:
+        return login_check
+
+    role = session.get('user_type')
+    if role not in ['artist', 'manager']:
+        flash('Only artists and managers can add merchandise', 'error')
+        return redirect(url_for('merchandise'))
+
+    conn = get_db_connection()
+    if not conn:
+        flash('Database connection failed', 'error')
+        return render_template('merchandise/add.html', artists=[])
+
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        # Managers pick one of their artists (needed for both GET and POST)
+        artists = []
+        if role == 'manager':
+            cur.execute(merchandise_shop.MANAGER_ARTISTS_SQL, (session['username'],))
+            artists = cur.fetchall()
+
+        if request.method == 'POST':
+            try:
+                owner = session['username'] if role == 'artist' else request.form.get('username')
+                row = merchandise_shop.product_row({**request.form, 'username': owner})
+                merchandise_shop.check_owners(conn, [row], session['username'], role)
+            except ValueError as e:
+                flash(f'Invalid product: {e}', 'error')
+                return render_template('merchandise/add.html', artists=artists)
+
+            merchandise_shop.add_product(conn, product_cache, row)
+            flash('Merchandise added successfully!', 'success')
+            return redirect(url_for('artist_merchandise', username=row[0]))
+
+        return render_template('merchandise/add.html', artists=artists)
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        flash(f'Error adding merchandise: {e}', 'error')
+        return render_template('merchandise/add.html', artists=[])
+
+
+
+# ==================== SEARCH ROUTE ====================
+
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return render_template('search.html', results=None, query='')
+
+    entity_type = request.args.get('type') or None
+    page = request.args.get('page', 1, type=int)
+
+    conn = get_db_connection()
+    if not conn:
+        flash('Database connection failed', 'error')
+        return render_template('search.html', results=None, query=query)
+
+    try:
+        results, has_more = search_engine.search(conn, query, entity_type, page)
+        return render_template('search.html', results=results, query=query,
+                               entity_type=entity_type, page=page, has_more=has_more)
+
+    except psycopg2.Error as e:
+        flash(f'Search error: {e}', 'error')
+        return render_template('search.html', results=None, query=query)
+
+
+
+
+# ==================== DEBUG ROUTES ====================
+
+# pool/routing state, metrics, slow statements and hashing timings are internal:
+# the routes exist only with DEBUG_ROUTES=1 (behind the firewall or a scraper allowlist)
+DEBUG_ROUTES = os.getenv('DEBUG_ROUTES') == '1'
+
+
+def debug_route(rule):
+    def register(view):
+        return app.route(rule)(view) if DEBUG_ROUTES else view
+    return register
+
+
+@debug_route('/debug/pool')
+def debug_pool():
+    """Connection pool counters, used to size DB_POOL_MIN/DB_POOL_MAX per worker"""
+    return jsonify(dict(db_pool.stats(), routing=db_router.stats()))
+
+
+@debug_route('/debug/metrics')
+def debug_metrics():
+    """Per-endpoint request/SQL counters and pool gauges in Prometheus text format"""
+    gauges = {f'app_db_pool_{k}': v for k, v in db_pool.stats().items()}
+    gauges.update({f'app_db_route_{k}': v for k, v in db_router.stats().items()})
+    gauges.update({f'app_password_{k}': v for k, v in password_hasher.stats().items()})
+    gauges.update({f'app_page_cache_{k}': v for k, v in page_cache.stats().items()})
+    return Response(instrumentation.render_prometheus(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@debug_route('/debug/slow_queries')
+def debug_slow_queries():
+    """Most recent statements slower than SLOW_QUERY_MS, with EXPLAIN plans"""
+    return jsonify(list(instrumentation.slow_queries))
 
 
+@debug_route('/debug/hashing')
+def debug_hashing():
+    """Password hashing counters and timings, used to tune PASSWORD_HASH_*"""
+    return jsonify(password_hasher.stats())
 
 
+# development server; run serve.py (gunicorn) or asgi.py in production
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
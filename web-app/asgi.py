@@ -0,0 +1,462 @@
+"""ASGI entry point: catalogue pages as async handlers on psycopg 3.
+
+    hypercorn asgi:application --workers 4        # or: uvicorn asgi:application
+
+The read-only pages (index, songs, artists, events, playlists and the
+artist/song/event/playlist detail pages) are served by a Quart app with its
+own ``AsyncConnectionPool``; independent queries of a page run concurrently
+on separate pooled connections, so a worker keeps serving other requests
+while it waits on PostgreSQL. Every other route (login, forms, POST
+handlers, search, debug) is passed to the Flask app from app.py, which runs
+in a thread pool. Both share the templates, the session cookie, the SQL and
+the page / stats caches.
+
+With DB_READ_HOSTS set, reads go to async replica pools under the rules of
+:class:`db.ReplicaRouter` (sticky after a write, lagging or failing replicas
+skipped); page fragments are rendered from the primary. Statements are
+timed into the same per-endpoint metrics, ``Server-Timing`` header and slow
+log as the Flask app's (the slow log has no EXPLAIN plan for them).
+
+Needs ``quart``, ``hypercorn``, ``psycopg`` and ``psycopg_pool`` (requirements-asgi.txt). hypercorn
+workers are daemonic processes: password hashing runs in the request threads
+there (hashing.py).
+"""
+import asyncio
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from markupsafe import Markup
+from quart import Quart, Response, flash, g, make_response, redirect, render_template, request, session, url_for
+from werkzeug.exceptions import HTTPException
+
+import app as wsgi
+import db
+import instrumentation
+import page_cache as fragment_cache
+import pagination
+import recommend
+import templating
+
+app = Quart(__name__, template_folder='templates', static_folder='static')
+app.secret_key = wsgi.app.secret_key
+templating.init_app(app)
+
+
+def conninfo_from_config(config):
+    """libpq connection string for a db.config_from_env() dict"""
+    return make_conninfo(host=config.get('host'), dbname=config.get('database'), user=config.get('user'),
+                         password=config.get('password'), port=str(config.get('port') or 5432))
+
+
+def async_pool_from_config(config):
+    return AsyncConnectionPool(
+        conninfo_from_config(config),
+        min_size=int(os.getenv('ASYNC_DB_POOL_MIN', 1)),
+        max_size=int(os.getenv('ASYNC_DB_POOL_MAX', 20)),
+        timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+        max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+        kwargs={'row_factory': dict_row},
+        open=False,
+    )
+
+
+class AsyncReplicaRouter:
+    """:class:`db.ReplicaRouter` for the async pages: reads from replica pools, else the primary.
+
+    Every handler here is a read. A session that wrote through the Flask app
+    in the last ``sticky_seconds`` reads the primary; a replica more than
+    ``max_lag`` seconds behind or failing to connect is skipped for
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, primary, replicas=(), sticky_seconds=5.0, max_lag=10.0,
+                 lag_check_interval=5.0, retry_after=30.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_after = retry_after
+        self._next = itertools.count()
+        self._state = [{'down_until': 0.0, 'lag': None, 'lag_checked': 0.0} for _ in self.replicas]
+
+    async def open(self):
+        for pool in [self.primary] + self.replicas:
+            await pool.open()
+
+    async def close(self):
+        for pool in [self.primary] + self.replicas:
+            await pool.close()
+
+    def _read_from_replica(self):
+        if not self.replicas:
+            return False
+        wrote_at = session.get('db_write_at')
+        return wrote_at is None or time.time() - wrote_at >= self.sticky_seconds
+
+    async def _lag_ok(self, index, conn):
+        state = self._state[index]
+        if time.monotonic() - state['lag_checked'] < self.lag_check_interval:
+            return True
+        state['lag_checked'] = time.monotonic()
+        cur = await conn.execute(db.REPLICA_LAG_SQL)
+        state['lag'] = float((await cur.fetchone())['lag'])
+        await conn.rollback()
+        return state['lag'] <= self.max_lag
+
+    async def _replica_connection(self):
+        now = time.monotonic()
+        start = next(self._next)
+        for index in ((start + i) % len(self.replicas) for i in range(len(self.replicas))):
+            if self._state[index]['down_until'] > now:
+                continue
+            pool = self.replicas[index]
+            try:
+                conn = await pool.getconn()
+            except psycopg.Error:
+                self._state[index]['down_until'] = time.monotonic() + self.retry_after
+                continue
+            try:
+                if await self._lag_ok(index, conn):
+                    return pool, conn
+            except psycopg.Error:
+                pass
+            self._state[index]['down_until'] = time.monotonic() + self.retry_after
+            await pool.putconn(conn)
+        return None, None
+
+    @asynccontextmanager
+    async def connection(self, primary=False):
+        """A replica connection for this request's reads; ``primary=True`` for cached renders"""
+        pool = conn = None
+        if not primary and self._read_from_replica():
+            pool, conn = await self._replica_connection()
+        if conn is None:
+            async with self.primary.connection() as conn:
+                yield conn
+            return
+        try:
+            # ends the transaction like pool.connection() does (a pooled connection is not closed)
+            async with conn:
+                yield conn
+        finally:
+            await pool.putconn(conn)
+
+
+db_router = AsyncReplicaRouter(
+    async_pool_from_config(wsgi.DATABASE_CONFIG),
+    [async_pool_from_config(config) for config in db.replica_configs_from_env(wsgi.DATABASE_CONFIG)],
+    sticky_seconds=float(os.getenv('DB_READ_STICKY_SECONDS', 5)),
+    max_lag=float(os.getenv('DB_READ_MAX_LAG', 10)),
+    lag_check_interval=float(os.getenv('DB_READ_LAG_CHECK_INTERVAL', 5)),
+    retry_after=float(os.getenv('DB_READ_RETRY_AFTER', 30)),
+)
+
+
+@app.before_serving
+async def open_pool():
+    await db_router.open()
+    wsgi.summary_refresher.start()
+    wsgi.neighbour_refresher.start()
+    wsgi.report_refresher.start()
+    wsgi.channel_directory.start()
+
+
+@app.after_serving
+async def close_pool():
+    await db_router.close()
+
+
+@app.before_request
+async def start_timer():
+    g.request_start = time.perf_counter()
+    g.sql = instrumentation.new_request_stats()
+
+
+@app.after_request
+async def add_server_timing(response):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    instrumentation.metrics.observe(request.endpoint or 'unknown', duration, g.sql)
+    response.headers['Server-Timing'] = instrumentation.server_timing(g.sql, duration)
+    return response
+
+
+async def execute(conn, sql, params=()):
+    """``conn.execute`` timed into the request's SQL totals like the Flask app's cursors"""
+    start = time.perf_counter()
+    try:
+        return await conn.execute(sql, params)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = getattr(g, 'sql', None)
+        statement = ' '.join(sql.split())
+        if stats is not None:
+            stats['queries'] += 1
+            stats['seconds'] += elapsed
+            if len(stats['statements']) < instrumentation.MAX_STATEMENTS_PER_REQUEST:
+                stats['statements'].append((statement, elapsed))
+        if elapsed * 1000 >= instrumentation.SLOW_QUERY_MS:
+            instrumentation.note_slow(statement, elapsed, request.endpoint)
+
+
+def count_rows(rows):
+    stats = getattr(g, 'sql', None)
+    if stats is not None:
+        stats['rows'] += len(rows)
+    return rows
+
+
+async def fetch_all(sql, params=(), primary=False):
+    """Rows of one statement, on a connection of its own"""
+    async with db_router.connection(primary) as conn:
+        cur = await execute(conn, sql, params)
+        return count_rows(await cur.fetchall())
+
+
+async def fetch_one(sql, params=(), primary=False):
+    async with db_router.connection(primary) as conn:
+        cur = await execute(conn, sql, params)
+        row = await cur.fetchone()
+        count_rows([row] if row is not None else [])
+        return row
+
+
+async def require_login():
+    if 'username' not in session:
+        await flash('Please log in to access this page', 'error')
+        return redirect(url_for('login'))
+    return None
+
+
+async def list_page(sql, keyset, params=()):
+    """One keyset page of a list query (``?stream=1`` is served as a normal page)"""
+    after = request.args.get('after')
+    before = request.args.get('before')
+    limit = pagination.page_size(request.args.get('limit'))
+    try:
+        query, args, reverse, token = pagination.page_query(sql, params, keyset, after, before, limit)
+    except pagination.InvalidToken:
+        await flash('Invalid page link, showing the first page', 'warning')
+        query, args, reverse, token = pagination.page_query(sql, params, keyset, limit=limit)
+    async with db_router.connection() as conn:
+        cur = await execute(conn, query, args)
+        return pagination.make_page(count_rows(await cur.fetchall()), keyset, limit, reverse, token)
+
+
+async def render_detail(template, fragments):
+    return await render_template(template, title=fragments['title'], fragment=Markup(fragments['body']))
+
+
+async def render_cached_detail(template, entry):
+    etag, modified, fresh = fragment_cache.validators(entry, request, session)
+    if fresh:
+        response = Response('', status=304)
+    else:
+        response = await make_response(await render_detail(template, entry['fragments']))
+    return fragment_cache.set_validators(response, etag, modified)
+
+
+# ==================== ROUTES ====================
+
+
+@app.route('/')
+async def index():
+    stats = wsgi.stats_cache.cached()
+    try:
+        if stats is None:
+            # the counts are cached until the next write invalidates them: read them from the primary
+            recent_events, row = await asyncio.gather(fetch_all(wsgi.RECENT_EVENTS_SQL),
+                                                      fetch_one(wsgi.stats_cache.sql, primary=True))
+            stats = wsgi.stats_cache.store(row)
+        else:
+            recent_events = await fetch_all(wsgi.RECENT_EVENTS_SQL)
+        return await render_template('index.html', stats=stats, recent_events=recent_events)
+    except psycopg.Error as e:
+        await flash(f'Database error: {e}', 'error')
+        return await render_template('index.html', stats=None)
+
+
+@app.route('/artists')
+async def artists():
+    try:
+        page = await list_page(wsgi.ARTISTS_SQL, wsgi.ARTISTS_KEYSET)
+        return await render_template('artists/list.html', page=page, artists=page.rows)
+    except psycopg.Error as e:
+        await flash(f'Error loading artists: {e}', 'error')
+        return await render_template('artists/list.html', artists=[])
+
+
+@app.route('/artist/<username>')
+async def artist_detail(username):
+    async def render():
+        # the three queries are independent: run them on three connections at once; the
+        # fragment is cached, so from the primary (a replica may be behind the invalidation)
+        artist, songs, events = await asyncio.gather(
+            fetch_one(wsgi.ARTIST_SQL, (username,), primary=True),
+            fetch_all(wsgi.ARTIST_SONGS_SQL, (username,), primary=True),
+            fetch_all(wsgi.ARTIST_EVENTS_SQL, (username,), primary=True),
+        )
+        if not artist:
+            return None
+        return {
+            'title': artist['full_name'],
+            'body': await render_template('artists/_detail.html', artist=artist, songs=songs, events=events),
+        }
+
+    try:
+        entry = await wsgi.page_cache.get_or_render_async('artist', username, render)
+    except psycopg.Error as e:
+        await flash(f'Error loading artist: {e}', 'error')
+        return redirect(url_for('artists'))
+
+    if entry is None:
+        await flash('Artist not found', 'error')
+        return redirect(url_for('artists'))
+    return await render_cached_detail('artists/detail.html', entry)
+
+
+@app.route('/songs')
+async def songs():
+    try:
+        page = await list_page(wsgi.SONGS_SQL, wsgi.SONGS_KEYSET)
+        return await render_template('songs/list.html', page=page, songs=page.rows)
+    except psycopg.Error as e:
+        await flash(f'Error loading songs: {e}', 'error')
+        return await render_template('songs/list.html', songs=[])
+
+
+@app.route('/song/<int:song_id>')
+async def song_detail(song_id):
+    async def render():
+        song, artists, similar = await asyncio.gather(
+            fetch_one(wsgi.SONG_SQL, (song_id,), primary=True),
+            fetch_all(wsgi.SONG_ARTISTS_SQL, (song_id,), primary=True),
+            fetch_all(recommend.SIMILAR_SONGS_SQL, (song_id, recommend.SHOW_SIMILAR), primary=True),
+        )
+        if not song:
+            return None
+        return {
+            'title': song['name'],
+            'body': await render_template('songs/_detail.html', song=song, artists=artists, similar=similar),
+        }
+
+    try:
+        entry = await wsgi.page_cache.get_or_render_async('song', song_id, render)
+    except psycopg.Error as e:
+        await flash(f'Error loading song: {e}', 'error')
+        entry = None
+
+    if entry is None:
+        return await render_detail('songs/detail.html', {
+            'title': 'Song', 'body': await render_template('songs/_detail.html', song=None, artists=[]),
+        })
+    return await render_cached_detail('songs/detail.html', entry)
+
+
+@app.route('/playlists')
+async def playlists():
+    login_check = await require_login()
+    if login_check:
+        return login_check
+
+    page = pagination.Page([])
+    try:
+        page = await list_page(wsgi.PLAYLISTS_SQL, wsgi.PLAYLISTS_KEYSET)
+    except psycopg.Error as e:
+        await flash(f'Error loading playlists: {e}', 'danger')
+    return await render_template('playlists/list.html', page=page, playlists=page.rows)
+
+
+@app.route('/playlist/<int:playlist_id>')
+async def playlist_detail(playlist_id):
+    login_check = await require_login()
+    if login_check:
+        return login_check
+
+    try:
+        playlist, songs_in_playlist, suggestions = await asyncio.gather(
+            fetch_one(wsgi.PLAYLIST_SQL, (playlist_id,)),
+            fetch_all(wsgi.PLAYLIST_SONGS_SQL, (playlist_id,)),
+            fetch_all(recommend.SUGGESTED_SONGS_SQL, {
+                'playlist_id': playlist_id, 'seeds': recommend.SUGGEST_SEEDS, 'limit': recommend.SHOW_SUGGESTED,
+            }),
+        )
+    except psycopg.Error as e:
+        await flash(f'Error loading playlist: {e}', 'danger')
+        return redirect(url_for('playlists'))
+
+    if not playlist:
+        await flash('Playlist not found', 'warning')
+        return redirect(url_for('playlists'))
+
+    return await render_template('playlists/detail.html', playlist=playlist,
+                                 songs_in_playlist=songs_in_playlist, suggestions=suggestions)
+
+
+@app.route('/events')
+async def events():
+    try:
+        page = await list_page(wsgi.EVENTS_SQL, wsgi.EVENTS_KEYSET)
+        return await render_template('events/list.html', page=page, events=page.rows)
+    except psycopg.Error as e:
+        await flash(f'Error loading events: {e}', 'error')
+        return await render_template('events/list.html', events=[])
+
+
+@app.route('/events/<int:event_id>')
+async def event_detail(event_id):
+    try:
+        event = await fetch_one(wsgi.EVENT_SQL, (event_id,))
+    except psycopg.Error as e:
+        await flash(f'Error loading event: {e}', 'error')
+        return redirect(url_for('events'))
+
+    if not event:
+        await flash('Event not found', 'error')
+        return redirect(url_for('events'))
+    return await render_template('events/detail.html', event=event)
+
+
+# Rules of the Flask-only routes, so url_for('login') etc. work in templates rendered here
+for rule in wsgi.app.url_map.iter_rules():
+    if rule.endpoint not in app.view_functions:
+        app.add_url_rule(rule.rule, endpoint=rule.endpoint, methods=rule.methods)
+
+
+# ==================== DISPATCH ====================
+
+
+class Dispatcher:
+    """Sends requests for async views to Quart and all others to the WSGI app"""
+
+    def __init__(self, async_app, wsgi_app):
+        self.async_app = async_app
+        self.wsgi_app = AsyncioWSGIMiddleware(wsgi_app)
+
+    def _is_async(self, scope):
+        adapter = self.async_app.url_map.bind('')
+        try:
+            endpoint, _ = adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return False
+        return self.async_app.view_functions.get(endpoint) is not None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and not self._is_async(scope):
+            await self.wsgi_app(scope, receive, send)
+        else:
+            await self.async_app(scope, receive, send)
+
+
+application = Dispatcher(app, wsgi.app)
@@ -0,0 +1,185 @@
+"""Public channel directory: channels by genre and location.
+
+The directory is read far more often than channels change, so every worker
+keeps a snapshot of it in memory (:class:`ChannelDirectory`): one query
+loads all channels with their location and moderator, and lists of
+positions per genre, country and city answer the filters
+without touching the database. A daemon thread reloads the snapshot every
+``CHANNEL_DIRECTORY_INTERVAL`` seconds. With the interval set to 0 the
+filters run as SQL on the composite indexes of migration 0011
+(:func:`channels_query`).
+
+Channel detail and a moderator's channels always read the tables.
+"""
+import bisect
+import logging
+import os
+import time
+
+import psycopg2
+
+import db
+import pagination
+
+log = logging.getLogger(__name__)
+
+CHANNEL_COLUMNS = '''c.channel_id, c.channel_name, c.description, c.preferred_genre AS genre, c.link,
+           c.location_id, l.country, l.city, c.username AS moderator, u.full_name AS moderator_name'''
+
+CHANNEL_SOURCE = '''public_channel c
+    LEFT JOIN location l ON l.location_id = c.location_id
+    JOIN users u ON u.username = c.username'''
+
+DIRECTORY_SQL = f'SELECT {CHANNEL_COLUMNS}\nFROM {CHANNEL_SOURCE}\nORDER BY c.channel_id'
+
+CHANNELS_KEYSET = pagination.Keyset(['c.channel_id'])
+
+# query argument -> condition; genre uses idx_public_channel_genre, country/city
+# idx_location_country_city and then idx_public_channel_location
+CHANNEL_FILTERS = {
+    'genre': 'c.preferred_genre = %s',
+    'country': 'l.country = %s',
+    'city': 'l.city = %s',
+}
+
+CHANNEL_SQL = f'''
+    SELECT {CHANNEL_COLUMNS}, l.region, l.address
+    FROM {CHANNEL_SOURCE}
+    WHERE c.channel_id = %s
+'''
+
+MODERATOR_SQL = '''
+    SELECT mc.username, u.full_name, mc.channel_count, mc.only_channel_name
+    FROM moderator_channel mc
+    JOIN users u ON u.username = mc.username
+    WHERE mc.username = %s
+'''
+
+MODERATOR_CHANNELS_SQL = f'''
+    SELECT {CHANNEL_COLUMNS}
+    FROM {CHANNEL_SOURCE}
+    WHERE c.username = %s
+    ORDER BY c.channel_id
+'''
+
+
+def filters_from(args):
+    """The non-empty directory filters of ``args`` (a mapping of query arguments)"""
+    return {name: args[name] for name in CHANNEL_FILTERS if args.get(name)}
+
+
+def channels_query(filters):
+    """``(sql, params)`` of a keyset listing for :func:`pagination.fetch_page`"""
+    where = ' AND '.join([CHANNEL_FILTERS[name] for name in filters] + ['{keyset}'])
+    sql = f'SELECT {CHANNEL_COLUMNS}\nFROM {CHANNEL_SOURCE}\nWHERE {where}\nORDER BY {{order}}'
+    return sql, list(filters.values())
+
+
+def channel(conn, channel_id):
+    cur = conn.cursor()
+    cur.execute(CHANNEL_SQL, (channel_id,))
+    return cur.fetchone()
+
+
+def moderator_channels(conn, username):
+    """``(summary, channels)`` of a content moderator; summary is None without channels"""
+    cur = conn.cursor()
+    cur.execute(MODERATOR_SQL, (username,))
+    summary = cur.fetchone()
+    if summary is None:
+        return None, []
+    cur.execute(MODERATOR_CHANNELS_SQL, (username,))
+    return summary, cur.fetchall()
+
+
+class Snapshot:
+    """All channels in channel_id order with row positions per filter value"""
+
+    def __init__(self, rows):
+        self.rows = [dict(row) for row in rows]
+        self.loaded_at = time.time()
+        self._ids = [row['channel_id'] for row in self.rows]
+        self._facets = {name: {} for name in CHANNEL_FILTERS}
+        for position, row in enumerate(self.rows):
+            for name in CHANNEL_FILTERS:
+                if row[name] is not None:
+                    self._facets[name].setdefault(row[name], []).append(position)
+
+    def page(self, filters, after=None, before=None, limit=pagination.DEFAULT_PAGE_SIZE):
+        """:class:`pagination.Page` following ``after`` or preceding ``before``, with the
+        tokens :func:`pagination.fetch_page` gives for the same listing in SQL.
+
+        Scans the shortest list of the given filters and checks the others
+        on each row, so a page costs about ``limit`` row checks.
+        """
+        reverse = before is not None and after is None
+        token = before if reverse else after
+        last = pagination.decode_token(token) if token else None
+        if last is not None and (len(last) != 1 or not isinstance(last[0], int)):
+            raise pagination.InvalidToken('token does not match this listing')
+        candidates = [self._facets[name].get(value, []) for name, value in filters.items()]
+        positions = min(candidates, key=len) if candidates else range(len(self.rows))
+        # positions follow channel_id order, so the token's place in them is a bisection
+        if reverse:
+            end = bisect.bisect_left(positions, bisect.bisect_left(self._ids, last[0]))
+            scan = reversed(positions[:end])
+        else:
+            start = bisect.bisect_left(positions, bisect.bisect_right(self._ids, last[0])) if last else 0
+            scan = positions[start:]
+        # limit + 1 rows in scan order, like the SQL query
+        rows = []
+        for position in scan:
+            row = self.rows[position]
+            if all(row[name] == value for name, value in filters.items()):
+                rows.append(row)
+                if len(rows) > limit:
+                    break
+        return pagination.make_page(rows, CHANNELS_KEYSET, limit, reverse, token)
+
+
+class ChannelDirectory(db.Refresher):
+    """In-memory directory snapshot, reloaded every ``interval`` seconds in a daemon thread.
+
+    ``interval`` 0 disables the snapshot; :meth:`snapshot` then returns None
+    and callers query the database.
+    """
+
+    name = 'channel-directory'
+
+    def __init__(self, pool, interval=300.0):
+        super().__init__(pool, interval)
+        self._snapshot = None
+
+    def run_once(self):
+        """Read all channels and replace the snapshot"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(DIRECTORY_SQL)
+            snapshot = Snapshot(cur.fetchall())
+            conn.rollback()
+        self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self):
+        """The current snapshot, loaded on first use; None when disabled"""
+        if not self.interval:
+            return None
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.run_once()
+        if snapshot.loaded_at < time.time() - 2 * self.interval:
+            # the thread is not running here (or failing): reload, else keep serving the old one
+            try:
+                return self.run_once()
+            except psycopg2.Error as e:
+                log.warning('channel directory reload failed, serving the old snapshot: %s', e)
+        return snapshot
+
+    def init_app(self, app):
+        app.extensions['channel_directory'] = self
+        super().init_app(app)
+
+
+def directory_from_env(pool):
+    """CHANNEL_DIRECTORY_INTERVAL in seconds, 0 disables the snapshot"""
+    return ChannelDirectory(pool, interval=float(os.getenv('CHANNEL_DIRECTORY_INTERVAL', 300)))
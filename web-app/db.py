@@ -0,0 +1,545 @@
+"""Pooled PostgreSQL connections for the web app.
+
+Connections are checked out once per request (stored on ``flask.g``) and
+returned to the pool when the app context is torn down. With read replicas
+configured, :class:`ReplicaRouter` picks the pool per request. Periodic
+maintenance threads subclass :class:`Refresher`.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from flask import g, request, session
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Raised when no connection becomes available in time"""
+
+
+class ConnectionPool:
+    """Thread-safe connection pool with health checks and metrics.
+
+    ``minconn`` connections are kept open, at most ``maxconn`` exist at once.
+    Checkouts block for up to ``timeout`` seconds when the pool is exhausted.
+    Idle connections older than ``max_idle`` seconds and any connection older
+    than ``max_lifetime`` seconds are recycled on checkout.
+
+    Connecting and the ``SELECT 1`` health check run outside the lock on a
+    reserved slot, so a slow or unreachable server only holds up the
+    threads that need a new connection.
+    """
+
+    def __init__(self, config, minconn=1, maxconn=10, timeout=5.0,
+                 max_idle=300.0, max_lifetime=3600.0, check_interval=30.0,
+                 connection_factory=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('invalid pool size: min=%s max=%s' % (minconn, maxconn))
+        self.config = dict(config)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.connection_factory = connection_factory
+
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []          # [(conn, created_at, last_used)]
+        self._in_use = {}        # id(conn) -> created_at
+        self._reserved = 0       # slots of connections being opened or health-checked
+        self._metrics = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'broken': 0,
+        }
+
+    # ---------- connection lifecycle ----------
+
+    def _connect(self):
+        return psycopg2.connect(**self.config, cursor_factory=RealDictCursor,
+                                connection_factory=self.connection_factory)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _check_fork(self):
+        # Connections must never be shared across forked workers.
+        if self._pid != os.getpid():
+            self._reset()
+
+    # ---------- public API ----------
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds"""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                self._check_fork()
+                conn, created, last_used, waited = self._reserve(deadline, waited)
+            # the slot is ours; connect or health-check without blocking other checkouts
+            try:
+                if conn is None:
+                    conn, created = self._connect(), time.monotonic()
+                elif not self._is_healthy(conn, last_used):
+                    self._close_quietly(conn)
+                    conn = None
+            except BaseException:
+                with self._cond:
+                    self._release_slot()
+                raise
+            with self._cond:
+                if conn is None:
+                    self._release_slot()
+                    self._metrics['broken'] += 1
+                    continue
+                self._reserved = max(self._reserved - 1, 0)
+                if last_used is None:
+                    self._metrics['created'] += 1
+                return self._checkout(conn, created, waited, deadline)
+
+    def _reserve(self, deadline, waited):
+        """``(conn, created, last_used, waited)`` of an idle connection, or a free
+        slot (conn None) to connect in; call with the lock held"""
+        while True:
+            while self._idle:
+                conn, created, last_used = self._idle.pop()
+                now = time.monotonic()
+                if now - created > self.max_lifetime or now - last_used > self.max_idle:
+                    self._metrics['recycled'] += 1
+                    self._close_quietly(conn)
+                    continue
+                self._reserved += 1
+                return conn, created, last_used, waited
+
+            if len(self._in_use) + self._reserved < self.maxconn:
+                self._reserved += 1
+                return None, None, None, waited
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._metrics['timeouts'] += 1
+                raise PoolTimeout('no database connection available after %.1fs' % self.timeout)
+            if not waited:
+                waited = True
+                self._metrics['waits'] += 1
+            self._cond.wait(remaining)
+
+    def _release_slot(self):
+        # a fork in between reset the counters; the slot belonged to the parent
+        if self._reserved:
+            self._reserved -= 1
+        self._cond.notify()
+
+    def _checkout(self, conn, created, waited, deadline):
+        self._in_use[id(conn)] = created
+        self._metrics['checkouts'] += 1
+        if waited:
+            self._metrics['wait_seconds'] += self.timeout - max(deadline - time.monotonic(), 0)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, closing it if it is unusable"""
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            created = self._in_use.pop(id(conn), None)
+            if created is None:
+                return
+            if not discard and not conn.closed:
+                try:
+                    if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            if discard or conn.closed:
+                self._metrics['broken'] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, created, time.monotonic()))
+            self._cond.notify()
+
+    def prefill(self):
+        """Open connections until ``minconn`` are available"""
+        with self._cond:
+            self._check_fork()
+            missing = self.minconn - len(self._idle) - len(self._in_use) - self._reserved
+            if missing <= 0:
+                return
+            self._reserved += missing
+        opened = []
+        try:
+            for _ in range(missing):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self._reserved = max(self._reserved - missing, 0)
+                now = time.monotonic()
+                self._idle.extend((conn, now, now) for conn in opened)
+                self._metrics['created'] += len(opened)
+                self._cond.notify_all()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _, _ in self._idle:
+                self._close_quietly(conn)
+            self._idle = []
+
+    def stats(self):
+        """Snapshot of pool size and counters"""
+        with self._cond:
+            self._check_fork()
+            stats = dict(self._metrics)
+            stats.update({
+                'min': self.minconn,
+                'max': self.maxconn,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+            })
+            return stats
+
+
+def config_from_env():
+    """psycopg2.connect() arguments from the DB_* environment variables"""
+    return {
+        'host' : os.getenv('DB_HOST'),
+        'database' : os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'port': os.getenv('DB_PORT', 5432)
+    }
+
+
+def pool_from_env(config, connection_factory=None):
+    """Build a pool sized by the DB_POOL_* environment variables"""
+    return ConnectionPool(
+        config,
+        connection_factory=connection_factory,
+        minconn=int(os.getenv('DB_POOL_MIN', 1)),
+        maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+        timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+        max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+        check_interval=float(os.getenv('DB_POOL_CHECK_INTERVAL', 30)),
+    )
+
+
+def replica_configs_from_env(primary):
+    """Connection configs for DB_READ_HOSTS (``host[:port],...``).
+
+    DB_READ_NAME / DB_READ_USER / DB_READ_PASSWORD default to the primary's.
+    """
+    configs = []
+    for entry in filter(None, (h.strip() for h in os.getenv('DB_READ_HOSTS', '').split(','))):
+        host, _, port = entry.partition(':')
+        configs.append(dict(primary,
+                            host=host,
+                            port=port or primary.get('port', 5432),
+                            database=os.getenv('DB_READ_NAME', primary.get('database')),
+                            user=os.getenv('DB_READ_USER', primary.get('user')),
+                            password=os.getenv('DB_READ_PASSWORD', primary.get('password'))))
+    return configs
+
+
+# ==================== READ REPLICAS ====================
+
+
+# Seconds the replica is behind; 0 when it has replayed everything it received
+# (an idle primary does not make a caught-up standby look stale) and on a primary.
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+'''
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaRouter:
+    """Routes GET requests to replica pools and everything else to the primary.
+
+    A session that wrote (any non-GET request that used the database) keeps
+    reading from the primary for ``sticky_seconds``, so it sees its own
+    writes. Replicas are used round-robin; one whose lag exceeds
+    ``max_lag`` seconds (checked at most every ``lag_check_interval``) or
+    whose connection fails is skipped for ``retry_after`` seconds. When no
+    replica is usable the request falls back to the primary.
+
+    Results kept in a cache past the request (page fragments, per-user
+    suggestions, per-artist products) are read with
+    :meth:`primary_connection`: a render from a lagging replica right after
+    an invalidation would be cached as the new version.
+    """
+
+    def __init__(self, primary, replicas=(), sticky_seconds=5.0, max_lag=10.0,
+                 lag_check_interval=5.0, retry_after=30.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._state = [{'down_until': 0.0, 'lag': None, 'lag_checked': 0.0} for _ in self.replicas]
+        self._metrics = {'primary_reads': 0, 'replica_reads': 0, 'writes': 0,
+                         'sticky_reads': 0, 'fallbacks': 0, 'replica_errors': 0, 'lagging': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def _usable_replicas(self):
+        now = time.monotonic()
+        start = next(self._next)
+        order = [(start + i) % len(self.replicas) for i in range(len(self.replicas))]
+        with self._lock:
+            return [i for i in order if self._state[i]['down_until'] <= now]
+
+    def _mark_down(self, index, reason):
+        with self._lock:
+            self._state[index]['down_until'] = time.monotonic() + self.retry_after
+            self._metrics[reason] += 1
+
+    def _lag_ok(self, index, conn):
+        with self._lock:
+            state = self._state[index]
+            if time.monotonic() - state['lag_checked'] < self.lag_check_interval:
+                return True
+            state['lag_checked'] = time.monotonic()
+        cur = conn.cursor()
+        cur.execute(REPLICA_LAG_SQL)
+        lag = float(cur.fetchone()['lag'])
+        cur.close()
+        conn.rollback()
+        with self._lock:
+            self._state[index]['lag'] = lag
+        return lag <= self.max_lag
+
+    def _read_from_replica(self):
+        if not self.replicas or request.method not in SAFE_METHODS:
+            return False
+        wrote_at = session.get('db_write_at')
+        if wrote_at is not None and time.time() - wrote_at < self.sticky_seconds:
+            self._count('sticky_reads')
+            return False
+        return True
+
+    def _replica_connection(self):
+        for index in self._usable_replicas():
+            pool = self.replicas[index]
+            try:
+                conn = pool.getconn()
+            except psycopg2.Error:
+                self._mark_down(index, 'replica_errors')
+                continue
+            try:
+                if self._lag_ok(index, conn):
+                    return conn, pool
+                self._mark_down(index, 'lagging')
+                pool.putconn(conn)
+            except psycopg2.Error:
+                self._mark_down(index, 'replica_errors')
+                pool.putconn(conn, discard=True)
+        self._count('fallbacks')
+        return None, None
+
+    def get_connection(self):
+        """Request-scoped connection from the pool this request is routed to"""
+        if 'db_conn' in g:
+            return g.db_conn
+        conn = pool = None
+        if self._read_from_replica():
+            conn, pool = self._replica_connection()
+        if conn is not None:
+            self._count('replica_reads')
+        else:
+            pool = self.primary
+            conn = pool.getconn()
+            self._count('primary_reads' if request.method in SAFE_METHODS else 'writes')
+        g.db_conn, g.db_conn_pool = conn, pool
+        return conn
+
+    def primary_connection(self):
+        """Request-scoped primary connection, for reads whose result is cached.
+
+        Becomes the request's connection when none is checked out yet;
+        a request already reading a replica gets a second connection,
+        returned on teardown.
+        """
+        if 'db_conn' not in g:
+            g.db_conn, g.db_conn_pool = self.primary.getconn(), self.primary
+            self._count('primary_reads' if request.method in SAFE_METHODS else 'writes')
+        if g.db_conn_pool is self.primary:
+            return g.db_conn
+        if 'db_primary_conn' not in g:
+            g.db_primary_conn = self.primary.getconn()
+            self._count('primary_reads')
+        return g.db_primary_conn
+
+    def init_app(self, app):
+        app.extensions['db_router'] = self
+
+        @app.teardown_appcontext
+        def release_primary_connection(exc):
+            conn = g.pop('db_primary_conn', None)
+            if conn is not None:
+                self.primary.putconn(conn, discard=conn.closed != 0)
+
+        @app.after_request
+        def remember_write(response):
+            if request.method not in SAFE_METHODS and g.get('db_conn_pool') is self.primary:
+                session['db_write_at'] = time.time()
+            return response
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            now = time.monotonic()
+            replicas = [{
+                'host': pool.config.get('host'),
+                'port': pool.config.get('port'),
+                'lag': state['lag'],
+                'available': state['down_until'] <= now,
+                'pool': pool.stats(),
+            } for pool, state in zip(self.replicas, self._state)]
+        stats['replicas'] = replicas
+        return stats
+
+
+def router_from_env(primary, connection_factory=None):
+    """Router over ``primary`` and one pool per DB_READ_HOSTS entry"""
+    replicas = [pool_from_env(config, connection_factory=connection_factory)
+                for config in replica_configs_from_env(primary.config)]
+    return ReplicaRouter(
+        primary,
+        replicas,
+        sticky_seconds=float(os.getenv('DB_READ_STICKY_SECONDS', 5)),
+        max_lag=float(os.getenv('DB_READ_MAX_LAG', 10)),
+        lag_check_interval=float(os.getenv('DB_READ_LAG_CHECK_INTERVAL', 5)),
+        retry_after=float(os.getenv('DB_READ_RETRY_AFTER', 30)),
+    )
+
+
+# ==================== BACKGROUND REFRESHERS ====================
+
+
+class Refresher:
+    """Calls :meth:`run_once` every ``interval`` seconds in a daemon thread.
+
+    Subclasses implement ``run_once()``, taking connections from
+    :meth:`connection`; its last result is kept in ``last_result``. There is
+    one thread per process: forked workers start their own, and ``interval``
+    0 disables it.
+    """
+
+    name = 'refresher'
+
+    def __init__(self, pool, interval):
+        self.pool = pool
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self.last_result = None
+
+    @contextmanager
+    def connection(self):
+        """A connection from the pool, rolled back on errors and discarded when broken"""
+        conn = self.pool.getconn()
+        discard = False
+        try:
+            yield conn
+        except psycopg2.Error:
+            discard = conn.closed != 0
+            if not discard:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, discard=discard)
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def can_start(self):
+        """False to keep the thread from starting (checked once per process)"""
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_result = self.run_once()
+            except psycopg2.Error as e:
+                log.warning('%s failed: %s', self.name, e)
+
+    def start(self):
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if not self.can_start():
+                return
+            self._stop = threading.Event()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def init_app(self, app):
+        app.before_request(self.start)
+
+
+# ==================== FLASK INTEGRATION ====================
+
+
+def init_app(app, pool):
+    """Attach ``pool`` to ``app`` and return connections on teardown"""
+    app.extensions['db_pool'] = pool
+
+    @app.teardown_appcontext
+    def release_connection(exc):
+        conn = g.pop('db_conn', None)
+        owner = g.pop('db_conn_pool', pool)
+        if conn is not None:
+            owner.putconn(conn, discard=conn.closed != 0)
+
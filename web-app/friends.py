@@ -0,0 +1,168 @@
+"""Friendship graph queries on the ``friendship`` edge table (migration 0008).
+
+Friendships are stored in both directions, so a user's friends are one
+range of the primary key (username, friend_username): counting them is an
+index-only scan and mutual friends a merge of two ranges.
+
+Friends-of-friends suggestions walk the graph with a recursive CTE that
+is bounded twice: by depth (``SUGGEST_DEPTH``) and by the number of
+friends followed from every user (``SUGGEST_FANOUT``), so a user with
+thousands of friends costs at most fanout ** depth rows. The result is
+cached per user (:class:`page_cache.VersionedCache`, kind ``fof``); adding
+or removing a friendship drops the suggestions of both users and of their
+friends.
+"""
+import os
+
+import pagination
+from page_cache import LocalBackend, RedisBackend, VersionedCache
+
+SUGGEST_DEPTH = 2
+SUGGEST_FANOUT = 200
+SUGGEST_LIMIT = 20
+
+FRIEND_COUNT_SQL = 'SELECT COUNT(*) AS friends FROM friendship WHERE username = %s'
+
+FRIENDS_SQL = '''
+    SELECT f.friend_username AS username, u.full_name, f.since
+    FROM friendship f
+    JOIN users u ON u.username = f.friend_username
+    WHERE f.username = %s AND {keyset}
+    ORDER BY {order}
+'''
+FRIENDS_KEYSET = pagination.Keyset(['f.friend_username'], keys=['username'])
+
+MUTUAL_FRIENDS_SQL = '''
+    SELECT a.friend_username AS username, u.full_name
+    FROM friendship a
+    JOIN friendship b ON b.username = %s AND b.friend_username = a.friend_username
+    JOIN users u ON u.username = a.friend_username
+    WHERE a.username = %s
+    ORDER BY a.friend_username
+    LIMIT %s
+'''
+
+# paths of length 2..depth from the user; at depth 2 ``mutual`` is the number of mutual friends
+SUGGESTIONS_SQL = '''
+    WITH RECURSIVE walk (username, depth) AS (
+        (SELECT friend_username, 1
+         FROM friendship
+         WHERE username = %(username)s
+         ORDER BY friend_username
+         LIMIT %(fanout)s)
+        UNION ALL
+        SELECT step.friend_username, walk.depth + 1
+        FROM walk
+        CROSS JOIN LATERAL (
+            SELECT f.friend_username
+            FROM friendship f
+            WHERE f.username = walk.username
+            ORDER BY f.friend_username
+            LIMIT %(fanout)s
+        ) step
+        WHERE walk.depth < %(depth)s
+    )
+    SELECT walk.username, u.full_name, COUNT(*) AS mutual
+    FROM walk
+    JOIN users u ON u.username = walk.username
+    WHERE walk.depth > 1
+      AND walk.username <> %(username)s
+      AND NOT EXISTS (
+          SELECT 1 FROM friendship x
+          WHERE x.username = %(username)s AND x.friend_username = walk.username
+      )
+    GROUP BY walk.username, u.full_name
+    ORDER BY mutual DESC, walk.username
+    LIMIT %(limit)s
+'''
+
+BASIC_USERS_SQL = 'SELECT COUNT(*) AS found FROM basic_user WHERE username IN (%s, %s)'
+
+ADD_FRIENDSHIP_SQL = '''
+    INSERT INTO friendship (username, friend_username)
+    VALUES (%(a)s, %(b)s), (%(b)s, %(a)s)
+    ON CONFLICT DO NOTHING
+'''
+
+REMOVE_FRIENDSHIP_SQL = '''
+    DELETE FROM friendship
+    WHERE (username, friend_username) IN ((%(a)s, %(b)s), (%(b)s, %(a)s))
+'''
+
+# the legacy single link would bring the friendship back (friendship_import_legacy(), load_data.py)
+CLEAR_LEGACY_FRIEND_SQL = '''
+    UPDATE basic_user SET basic_user_username = NULL
+    WHERE (username = %(a)s AND basic_user_username = %(b)s)
+       OR (username = %(b)s AND basic_user_username = %(a)s)
+'''
+
+# users whose suggestions change when a and b become (or stop being) friends
+AFFECTED_USERS_SQL = '''
+    SELECT DISTINCT friend_username AS username
+    FROM friendship
+    WHERE username IN (%(a)s, %(b)s)
+'''
+
+
+def friend_count(conn, username):
+    cur = conn.cursor()
+    cur.execute(FRIEND_COUNT_SQL, (username,))
+    return cur.fetchone()['friends']
+
+
+def mutual_friends(conn, username, other, limit=pagination.MAX_PAGE_SIZE):
+    cur = conn.cursor()
+    cur.execute(MUTUAL_FRIENDS_SQL, (other, username, limit))
+    return cur.fetchall()
+
+
+def suggestions(connect, cache, username, limit=SUGGEST_LIMIT):
+    """Friends-of-friends who are not friends yet, most mutual friends first.
+
+    ``connect()`` gives the connection for a cache miss: the primary, since a
+    replica may not have the friendship change that dropped the entry yet.
+    """
+    def compute():
+        cur = connect().cursor()
+        cur.execute(SUGGESTIONS_SQL, {'username': username, 'depth': SUGGEST_DEPTH,
+                                      'fanout': SUGGEST_FANOUT, 'limit': SUGGEST_LIMIT})
+        return [{'username': row['username'], 'full_name': row['full_name'], 'mutual': row['mutual']}
+                for row in cur.fetchall()]
+
+    return cache.get_or_compute(username, compute)[:limit]
+
+
+def set_friendship(conn, cache, username, friend, befriend=True):
+    """Add (or remove) the friendship in both directions and commit.
+
+    Returns False when nothing changed and None when either user is not a
+    basic user.
+    """
+    cur = conn.cursor()
+    cur.execute(BASIC_USERS_SQL, (username, friend))
+    if cur.fetchone()['found'] < 2:
+        conn.rollback()
+        return None
+    params = {'a': username, 'b': friend}
+    cur.execute(AFFECTED_USERS_SQL, params)
+    affected = {row['username'] for row in cur.fetchall()}
+    cur.execute(ADD_FRIENDSHIP_SQL if befriend else REMOVE_FRIENDSHIP_SQL, params)
+    changed = cur.rowcount > 0
+    if not befriend:
+        cur.execute(CLEAR_LEGACY_FRIEND_SQL, params)
+    conn.commit()
+    if changed:
+        cache.invalidate(username, friend, *affected)
+    return changed
+
+
+def init_app(app, cache):
+    app.extensions['friend_suggestions'] = cache
+
+
+def cache_from_env():
+    """Shares PAGE_CACHE_URL when set; FRIEND_SUGGESTIONS_TTL, FRIEND_SUGGESTIONS_CACHE_SIZE"""
+    url = os.getenv('PAGE_CACHE_URL')
+    backend = (RedisBackend(url, prefix='friends:') if url
+               else LocalBackend(int(os.getenv('FRIEND_SUGGESTIONS_CACHE_SIZE', 10000))))
+    return VersionedCache(backend, 'fof', ttl=float(os.getenv('FRIEND_SUGGESTIONS_TTL', 300)))
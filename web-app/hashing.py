@@ -0,0 +1,116 @@
+"""Password hashing offloaded to a bounded process pool.
+
+Key derivation is CPU-bound and holds the GIL, so running it in request
+threads starves cheap page views during a login storm. Hashes are computed
+in worker processes instead; at most ``max_pending`` jobs may be queued and
+callers wait up to ``queue_timeout`` seconds for a slot before getting
+:class:`HashingBusy`.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+log = logging.getLogger(__name__)
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue stays full for ``queue_timeout`` seconds"""
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=2, max_pending=32, queue_timeout=2.0):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._prefix = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._metrics = {
+            'hash_count': 0, 'hash_seconds': 0.0,
+            'verify_count': 0, 'verify_seconds': 0.0,
+            'queue_wait_seconds': 0.0, 'rejected': 0, 'rehashed': 0,
+        }
+
+    def _pool(self):
+        # The pool is created lazily and per process, so forked workers get their own
+        with self._lock:
+            if self._pid != os.getpid():
+                workers = self.workers
+                if workers and multiprocessing.current_process().daemon:
+                    # hypercorn runs its workers as daemonic processes, which may not have children
+                    log.warning('daemonic worker process: password hashing runs in the request threads')
+                    workers = 0
+                self._executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, kind, fn, *args):
+        pool = self._pool()
+        start = time.perf_counter()
+        if pool is None:
+            result = fn(*args)
+        else:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                with self._lock:
+                    self._metrics['rejected'] += 1
+                raise HashingBusy('password hashing queue is full')
+            waited = time.perf_counter() - start
+            try:
+                result = pool.submit(fn, *args).result()
+            finally:
+                self._slots.release()
+            with self._lock:
+                self._metrics['queue_wait_seconds'] += waited
+        with self._lock:
+            self._metrics[kind + '_count'] += 1
+            self._metrics[kind + '_seconds'] += time.perf_counter() - start
+        return result
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when ``pwhash`` was made with other parameters than ``method``"""
+        if self._prefix is None:
+            # werkzeug fills in missing parameters ('scrypt', 'pbkdf2:sha256'), so take its full prefix
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def note_rehash(self):
+        with self._lock:
+            self._metrics['rehashed'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+        stats.update({'method': self.method, 'workers': self.workers, 'max_pending': self.max_pending})
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._pid = None
+
+
+def hasher_from_env():
+    """PASSWORD_HASH_METHOD uses werkzeug's syntax, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000"""
+    return PasswordHasher(
+        method=os.getenv('PASSWORD_HASH_METHOD', 'scrypt'),
+        workers=int(os.getenv('PASSWORD_HASH_WORKERS', 2)),
+        max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', 32)),
+        queue_timeout=float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', 2)),
+    )
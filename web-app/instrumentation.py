@@ -0,0 +1,355 @@
+"""Per-request SQL instrumentation, slow-query log and Prometheus metrics.
+
+Connections are created with :class:`InstrumentedConnection`, whose cursors
+time every ``execute`` and count fetched rows into ``flask.g.sql``. After
+each request the totals are added to per-endpoint counters, sent back as a
+``Server-Timing`` header and served in Prometheus text format by
+:func:`render_prometheus`. Statements slower than ``SLOW_QUERY_MS`` are
+logged together with their EXPLAIN plan.
+
+Only the statement as passed to ``execute`` is kept, never its parameters
+(password hashes, card numbers, emails): the plan of a parameterized
+statement is a generic one (``EXPLAIN (GENERIC_PLAN)``, PostgreSQL 16+).
+Statements executed without parameters may carry their values inline
+(``execute_values`` does): their VALUES lists are kept as
+``VALUES (...) /* n rows */`` and they are not explained.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.sql import Composable
+from flask import g, has_app_context, has_request_context, request
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+MAX_STATEMENTS_PER_REQUEST = 200
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+slow_log = logging.getLogger('sql.slow')
+slow_queries = deque(maxlen=50)
+
+
+# ==================== CURSORS ====================
+
+
+class InstrumentedCursorMixin:
+    """Times ``execute`` and counts fetched rows for the current request"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record(self, query, vars, time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+
+_cursor_classes = {}
+_cursor_lock = threading.Lock()
+
+def instrumented(cursor_class):
+    """Subclass of ``cursor_class`` with :class:`InstrumentedCursorMixin`"""
+    with _cursor_lock:
+        if cursor_class not in _cursor_classes:
+            _cursor_classes[cursor_class] = type(
+                'Instrumented' + cursor_class.__name__, (InstrumentedCursorMixin, cursor_class), {})
+        return _cursor_classes[cursor_class]
+
+
+class InstrumentedConnection(extensions.connection):
+    """psycopg2 connection whose cursors, whatever their factory, are instrumented"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or extensions.cursor
+        kwargs['cursor_factory'] = instrumented(factory)
+        return super().cursor(*args, **kwargs)
+
+
+def _request_stats():
+    if not has_app_context():
+        return None
+    if 'sql' not in g:
+        g.sql = new_request_stats()
+    return g.sql
+
+
+def _count_rows(count):
+    stats = _request_stats()
+    if stats is not None:
+        stats['rows'] += count
+
+
+def _record(cursor, query, vars, elapsed):
+    stats = _request_stats()
+    if stats is not None:
+        stats['queries'] += 1
+        stats['seconds'] += elapsed
+        if len(stats['statements']) < MAX_STATEMENTS_PER_REQUEST:
+            stats['statements'].append((_statement(cursor, query, vars), elapsed))
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        _log_slow(cursor, query, vars, elapsed)
+
+
+def _query_text(cursor, query):
+    """``query`` as passed to ``execute``: placeholders, not values"""
+    if isinstance(query, Composable):
+        query = query.as_string(cursor)
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return query or ''
+
+
+def _statement(cursor, query, vars):
+    statement = ' '.join(_query_text(cursor, query).split())
+    return _elide_values(statement) if vars is None else statement
+
+
+_VALUES = re.compile(r'\bVALUES\s*(?=\()', re.IGNORECASE)
+_NEXT_ROW = re.compile(r'\s*,\s*(?=\()')
+
+def _skip_group(text, pos):
+    """Index just past the parenthesized group opening at ``text[pos]``, skipping quoted text"""
+    depth = 0
+    while pos < len(text):
+        char = text[pos]
+        if char in '\'"':
+            backslashes = char == "'" and text[pos - 1:pos] in ('e', 'E')
+            pos += 1
+            while pos < len(text):
+                if backslashes and text[pos] == '\\':
+                    pos += 1
+                elif text[pos] == char:
+                    if text[pos + 1:pos + 2] != char:
+                        break
+                    pos += 1
+                pos += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+    return pos
+
+
+def _elide_values(statement):
+    """``statement`` with every VALUES list replaced by ``VALUES (...) /* n rows */``"""
+    parts = []
+    pos = 0
+    for match in _VALUES.finditer(statement):
+        if match.start() < pos:
+            continue
+        end = _skip_group(statement, match.end())
+        rows = 1
+        while True:
+            more = _NEXT_ROW.match(statement, end)
+            if more is None:
+                break
+            end = _skip_group(statement, more.end())
+            rows += 1
+        parts.append(statement[pos:match.end()])
+        parts.append(f'(...) /* {rows} row{"" if rows == 1 else "s"} */')
+        pos = end
+    parts.append(statement[pos:])
+    return ''.join(parts)
+
+
+_PLACEHOLDER = re.compile(r'%%|%\((\w+)\)s|%s')
+
+def _numbered(statement):
+    """``statement`` with psycopg2 placeholders turned into $1, $2, ... for GENERIC_PLAN"""
+    numbers = {}
+    count = 0
+
+    def number(match):
+        nonlocal count
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None or name not in numbers:
+            count += 1
+            if name is not None:
+                numbers[name] = count
+            return f'${count}'
+        return f'${numbers[name]}'
+
+    return _PLACEHOLDER.sub(number, statement)
+
+
+def _explain(cursor, query, vars):
+    conn = cursor.connection
+    if vars is None:
+        text = 'EXPLAIN ' + _query_text(cursor, query)
+    elif conn.server_version >= 160000:
+        text = 'EXPLAIN (GENERIC_PLAN) ' + _numbered(_query_text(cursor, query))
+    else:
+        return None
+    # plain cursor: not instrumented, so this EXPLAIN is not recorded itself; the
+    # savepoint keeps a failing EXPLAIN from aborting the caller's transaction
+    explain = extensions.cursor(conn)
+    savepoint = not conn.autocommit
+    try:
+        if savepoint:
+            explain.execute('SAVEPOINT slow_query_explain')
+        try:
+            explain.execute(text)
+            return '\n'.join(row[0] for row in explain.fetchall())
+        except psycopg2.Error as e:
+            if savepoint:
+                explain.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return f'EXPLAIN failed: {e}'
+        finally:
+            if savepoint:
+                explain.execute('RELEASE SAVEPOINT slow_query_explain')
+    finally:
+        explain.close()
+
+
+def _log_slow(cursor, query, vars, elapsed):
+    statement = _statement(cursor, query, vars)
+    plan = None
+    keyword = statement.split(None, 1)[0].upper() if statement else ''
+    # inlined rows (execute_values) are not sent to EXPLAIN either
+    inlined = vars is None and _VALUES.search(statement) is not None
+    if keyword in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH') and not inlined:
+        conn = cursor.connection
+        if conn.get_transaction_status() in (extensions.TRANSACTION_STATUS_IDLE,
+                                             extensions.TRANSACTION_STATUS_INTRANS):
+            try:
+                plan = _explain(cursor, query, vars)
+            except psycopg2.Error as e:
+                plan = f'EXPLAIN failed: {e}'
+    note_slow(statement, elapsed, request.endpoint if has_request_context() else None, plan)
+
+
+def note_slow(statement, elapsed, endpoint, plan=None):
+    """Log and list a slow statement (its text as passed to execute, without values)"""
+    entry = {
+        'ms': round(elapsed * 1000, 1),
+        'endpoint': endpoint,
+        'query': statement,
+        'plan': plan,
+        'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    slow_queries.append(entry)
+    slow_log.warning('slow query (%.1f ms) in %s: %s\n%s', entry['ms'], entry['endpoint'],
+                     entry['query'], plan or '')
+
+
+# ==================== FLASK INTEGRATION ====================
+
+
+class Metrics:
+    """Per-endpoint request and database counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def observe(self, endpoint, duration, sql):
+        with self._lock:
+            m = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'seconds': 0.0, 'db_queries': 0, 'db_seconds': 0.0, 'db_rows': 0,
+                'slow_queries': 0, 'buckets': [0] * len(DURATION_BUCKETS),
+            })
+            m['requests'] += 1
+            m['seconds'] += duration
+            m['db_queries'] += sql['queries']
+            m['db_seconds'] += sql['seconds']
+            m['db_rows'] += sql['rows']
+            m['slow_queries'] += sum(1 for _, s in sql['statements'] if s * 1000 >= SLOW_QUERY_MS)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    m['buckets'][i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {k: dict(v, buckets=list(v['buckets'])) for k, v in self.endpoints.items()}
+
+
+metrics = Metrics()
+
+
+def new_request_stats():
+    return {'queries': 0, 'seconds': 0.0, 'rows': 0, 'statements': []}
+
+
+def server_timing(sql, duration):
+    """``Server-Timing`` header value for a request's SQL totals"""
+    return (f'db;dur={sql["seconds"] * 1000:.1f};desc="{sql["queries"]} queries, {sql["rows"]} rows", '
+            f'app;dur={duration * 1000:.1f}')
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        sql = g.get('sql') or new_request_stats()
+        metrics.observe(request.endpoint or 'unknown', duration, sql)
+        response.headers['Server-Timing'] = server_timing(sql, duration)
+        return response
+
+
+def render_prometheus(gauges=None):
+    """Prometheus text exposition of the endpoint counters plus ``gauges``"""
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    snapshot = metrics.snapshot()
+    counters = [
+        ('app_requests_total', 'requests', 'Requests handled'),
+        ('app_db_queries_total', 'db_queries', 'SQL statements executed'),
+        ('app_db_seconds_total', 'db_seconds', 'Time spent in SQL statements'),
+        ('app_db_rows_total', 'db_rows', 'Rows fetched from the database'),
+        ('app_db_slow_queries_total', 'slow_queries', f'Statements slower than {SLOW_QUERY_MS:g} ms'),
+    ]
+    for name, key, help_text in counters:
+        family(name, 'counter', help_text)
+        for endpoint, m in sorted(snapshot.items()):
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {m[key]}')
+
+    family('app_request_duration_seconds', 'histogram', 'Request duration')
+    for endpoint, m in sorted(snapshot.items()):
+        for bound, count in zip(DURATION_BUCKETS, m['buckets']):
+            lines.append(f'app_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+        lines.append(f'app_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {m["requests"]}')
+        lines.append(f'app_request_duration_seconds_sum{{endpoint="{endpoint}"}} {m["seconds"]}')
+        lines.append(f'app_request_duration_seconds_count{{endpoint="{endpoint}"}} {m["requests"]}')
+
+    for name, value in sorted((gauges or {}).items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        family(name, 'gauge', name.replace('_', ' '))
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,237 @@
+"""Bulk loader: CSV / JSONL files into the create.sql tables via COPY.
+
+    python load_data.py DIR [--truncate]
+
+DIR holds one ``<table>.csv`` (with a header row) or ``<table>.jsonl``
+(one object per line) per table; missing tables are skipped. Everything
+runs in one transaction:
+
+1. secondary indexes and foreign keys of the loaded tables are dropped
+   and user triggers disabled, so rows are not checked or indexed one by one;
+2. files are streamed with COPY FROM STDIN in dependency order;
+3. indexes are recreated, foreign keys re-added NOT VALID and then
+   validated (one scan per constraint), triggers re-enabled;
+4. every SERIAL sequence is set past the loaded ids, and the search
+   documents / catalogue summaries / moderator channel summaries / row
+   counters from the migrations are rebuilt and, when basic_user was
+   loaded, its basic_user_username links are copied into friendship.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+# parents before children (see the FOREIGN KEY list in create.sql)
+LOAD_ORDER = [
+    'users', 'manager_user', 'artist_user', 'basic_user', 'content_moderator_user',
+    'location', 'song', 'event', 'playlist', 'merchandise_product', 'public_channel',
+    'event_artist_user', 'song_artist_user', 'song_playlist', 'friendship',
+]
+
+SECONDARY_INDEXES_SQL = '''
+    SELECT i.relname AS name, pg_get_indexdef(x.indexrelid) AS definition
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class t ON t.oid = x.indrelid
+    WHERE t.relname = ANY(%s) AND t.relnamespace = current_schema()::regnamespace
+      AND NOT x.indisprimary
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+'''
+
+FOREIGN_KEYS_SQL = '''
+    SELECT c.conrelid::regclass::text AS table_name, c.conname AS name,
+           pg_get_constraintdef(c.oid) AS definition
+    FROM pg_constraint c
+    WHERE c.contype = 'f'
+      AND (c.conrelid::regclass::text = ANY(%s) OR c.confrelid::regclass::text = ANY(%s))
+'''
+
+SERIAL_COLUMNS_SQL = '''
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND column_default LIKE 'nextval%'
+'''
+
+
+NULL_MARKER = '\\N'
+
+
+class JsonlAsCsv(io.RawIOBase):
+    """Streams a JSONL file as CSV text (no header) for copy_expert.
+
+    JSON nulls become ``\\N`` so they stay distinct from empty strings.
+    """
+
+    def __init__(self, lines, columns):
+        self._rows = self._encode(lines, columns)
+        self._buffer = b''
+
+    @staticmethod
+    def _encode(lines, columns):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            writer.writerow([NULL_MARKER if obj.get(c) is None else obj[c] for c in columns])
+            yield out.getvalue().encode('utf-8')
+            out.seek(0)
+            out.truncate()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._rows, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def find_sources(directory):
+    """{table: (path, format)} for the files present in ``directory``"""
+    sources = {}
+    for table in LOAD_ORDER:
+        for fmt in ('csv', 'jsonl'):
+            path = os.path.join(directory, f'{table}.{fmt}')
+            if os.path.exists(path):
+                sources[table] = (path, fmt)
+                break
+    return sources
+
+
+def copy_table(cur, table, path, fmt):
+    """COPY one file into ``table``; returns the number of rows loaded"""
+    with open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            columns = next(csv.reader([f.readline()]))
+            source, null = f, ''
+        else:
+            first = f.readline()
+            columns = list(json.loads(first).keys())
+            source, null = JsonlAsCsv(_chain(first, f), columns), NULL_MARKER
+        column_list = ', '.join(f'"{c.strip()}"' for c in columns)
+        cur.copy_expert(f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{null}')", source)
+    return cur.rowcount
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def resync_sequences(cur):
+    cur.execute(SERIAL_COLUMNS_SQL)
+    for table, column in cur.fetchall():
+        cur.execute(f'''
+            SELECT setval(pg_get_serial_sequence(%s, %s),
+                          COALESCE((SELECT MAX("{column}") FROM "{table}"), 0) + 1, false)
+        ''', (table, column))
+
+
+def load(conn, directory, truncate=False, verbose=True):
+    sources = find_sources(directory)
+    if not sources:
+        raise SystemExit(f'no <table>.csv or <table>.jsonl files in {directory}')
+    tables = [t for t in LOAD_ORDER if t in sources]
+    cur = conn.cursor()
+
+    def log(message):
+        if verbose:
+            print(message)
+
+    if truncate:
+        # before the foreign keys are dropped: CASCADE also empties the tables referencing these
+        # (e.g. friendship), whose rows would otherwise fail validation after the load
+        cur.execute('TRUNCATE ' + ', '.join(tables) + ' CASCADE')
+
+    cur.execute(SECONDARY_INDEXES_SQL, (tables,))
+    indexes = cur.fetchall()
+    cur.execute(FOREIGN_KEYS_SQL, (tables, tables))
+    foreign_keys = cur.fetchall()
+
+    for table_name, name, _ in foreign_keys:
+        cur.execute(f'ALTER TABLE {table_name} DROP CONSTRAINT "{name}"')
+    for name, _ in indexes:
+        cur.execute(f'DROP INDEX "{name}"')
+    for table in tables:
+        cur.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+    log(f'dropped {len(indexes)} indexes and {len(foreign_keys)} foreign keys')
+
+    for table in tables:
+        start = time.perf_counter()
+        rows = copy_table(cur, table, *sources[table])
+        log(f'{table:<24}{rows:>12} rows {time.perf_counter() - start:>8.1f}s')
+
+    start = time.perf_counter()
+    for _, definition in indexes:
+        cur.execute(definition)
+    for table_name, name, definition in foreign_keys:
+        cur.execute(f'ALTER TABLE {table_name} ADD CONSTRAINT "{name}" {definition} NOT VALID')
+    for table_name, name, _ in foreign_keys:
+        cur.execute(f'ALTER TABLE {table_name} VALIDATE CONSTRAINT "{name}"')
+    for table in tables:
+        cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+    log(f'indexes and foreign keys restored in {time.perf_counter() - start:.1f}s')
+
+    resync_sequences(cur)
+    cur.execute('''
+        SELECT proname FROM pg_proc
+        WHERE proname IN ('search_rebuild', 'catalogue_summary_rebuild', 'install_table_counter',
+                          'friendship_import_legacy', 'moderator_channel_rebuild')
+    ''')
+    functions = {row[0] for row in cur.fetchall()}
+    if 'friendship_import_legacy' in functions and 'basic_user' in tables:
+        cur.execute('SELECT friendship_import_legacy()')
+    if 'search_rebuild' in functions:
+        cur.execute('SELECT search_rebuild()')
+    if 'catalogue_summary_rebuild' in functions:
+        cur.execute('SELECT catalogue_summary_rebuild()')
+    if 'moderator_channel_rebuild' in functions:
+        cur.execute('SELECT moderator_channel_rebuild()')
+    if 'install_table_counter' in functions:
+        for table in ('users', 'artist_user', 'song', 'event'):
+            cur.execute('SELECT install_table_counter(%s)', (table,))
+    conn.commit()
+
+    cur.execute('ANALYZE')
+    conn.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--truncate', action='store_true', help='empty the loaded tables first')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    start = time.perf_counter()
+    try:
+        load(conn, args.directory, truncate=args.truncate)
+    except (psycopg2.Error, ValueError) as e:
+        conn.rollback()
+        print(f'load failed, nothing was changed: {e}')
+        return 1
+    finally:
+        conn.close()
+    print(f'done in {time.perf_counter() - start:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Merchandise storefront on ``merchandise_product`` (create.sql columns).
+
+Listings are keyset pages ordered by (product_price, product_id). The
+storefront shows available products only, so the common query is a range
+of idx_merchandise_product_available_price (availibility, product_price,
+product_id, migration 0010), optionally cut to a price range; per-artist
+listings are a range of idx_merchandise_product_username_price (username,
+availibility, product_price, product_id), which migration 0010 puts in
+place of idx_merchandise_product_username (migration 0001).
+
+An artist's available products are small and read on every shop page, so
+they are cached per artist (:class:`page_cache.VersionedCache`, kind
+``merch``) and dropped whenever that artist's products change.
+
+Bulk imports take CSV or a JSON array, validate every row first and then
+insert in batches of ``IMPORT_BATCH_SIZE`` rows per statement, all in one
+transaction.
+"""
+import csv
+import io
+import json
+import math
+import os
+
+from psycopg2.extras import execute_values
+
+import pagination
+from page_cache import LocalBackend, RedisBackend, VersionedCache
+
+ARTIST_PRODUCTS_LIMIT = 500
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ROWS = 50_000
+MAX_ERRORS = 20
+
+PRODUCT_COLUMNS = '''mp.product_id, mp.username, u.full_name AS artist_name, mp.product_name,
+           mp.shipping, mp.description, mp.product_price, mp.availibility'''
+
+PRODUCTS_KEYSET = pagination.Keyset(['mp.product_price', 'mp.product_id'])
+
+# query argument -> (condition, parser); values are passed as parameters
+PRODUCT_FILTERS = {
+    'artist': ('mp.username = %s', int),
+    'min_price': ('mp.product_price >= %s', float),
+    'max_price': ('mp.product_price <= %s', float),
+}
+FILTER_ARGS = ('available',) + tuple(PRODUCT_FILTERS)
+
+ARTIST_PRODUCTS_SQL = f'''
+    SELECT {PRODUCT_COLUMNS}
+    FROM merchandise_product mp
+    JOIN users u ON u.username = mp.username
+    WHERE mp.username = %s AND mp.availibility
+    ORDER BY mp.product_price, mp.product_id
+    LIMIT %s
+'''
+
+# order of the tuples built by product_row()
+PRODUCT_FIELDS = ('username', 'product_name', 'shipping', 'description', 'product_price', 'availibility')
+
+ADD_PRODUCT_SQL = f'''
+    INSERT INTO merchandise_product ({', '.join(PRODUCT_FIELDS)})
+    VALUES ({', '.join(['%s'] * len(PRODUCT_FIELDS))})
+    RETURNING product_id
+'''
+
+IMPORT_SQL = f'''
+    INSERT INTO merchandise_product ({', '.join(PRODUCT_FIELDS)})
+    VALUES %s
+'''
+
+MANAGER_ARTISTS_SQL = '''
+    SELECT au.username, u.full_name
+    FROM artist_user au
+    JOIN users u ON u.username = au.username
+    WHERE au.manager_user_username = %s
+    ORDER BY u.full_name
+'''
+
+# artists a manager may add products for
+MANAGED_ARTISTS_SQL = '''
+    SELECT username FROM artist_user
+    WHERE username = ANY(%s) AND manager_user_username = %s
+'''
+
+# column sizes of create.sql
+MAX_LENGTHS = {'product_name': 50, 'shipping': 256, 'description': 256}
+
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'f', 'no', 'n'}
+
+
+class InvalidImport(ValueError):
+    """Raised with the row errors of a rejected import (``errors``: list of strings)"""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def products_query(args):
+    """``(sql, params)`` for a listing filtered by ``args`` (a mapping of query arguments).
+
+    ``available`` is ``1`` (default), ``0`` or ``all``. Raises ValueError for
+    a malformed filter value.
+    """
+    available = args.get('available') or '1'
+    if available not in ('1', '0', 'all'):
+        raise ValueError('available must be 1, 0 or all')
+    conditions = [] if available == 'all' else ['mp.availibility' if available == '1' else 'NOT mp.availibility']
+    params = []
+    for arg, (sql, parse) in PRODUCT_FILTERS.items():
+        value = args.get(arg)
+        if value:
+            conditions.append(sql)
+            params.append(parse(value))
+    where = ' AND '.join(conditions + ['{keyset}'])
+    return (f'SELECT {PRODUCT_COLUMNS}\nFROM merchandise_product mp\nJOIN users u ON u.username = mp.username\n'
+            f'WHERE {where}\nORDER BY {{order}}'), params
+
+
+def available_products(connect, cache, username):
+    """The artist's available products, cheapest first (cached).
+
+    ``connect()`` gives the connection for a cache miss, the primary (see
+    :meth:`db.ReplicaRouter.primary_connection`).
+    """
+    def compute():
+        cur = connect().cursor()
+        cur.execute(ARTIST_PRODUCTS_SQL, (username, ARTIST_PRODUCTS_LIMIT))
+        return [dict(row) for row in cur.fetchall()]
+
+    return cache.get_or_compute(username, compute)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f'{value!r} is not a boolean')
+
+
+def parse_price(value):
+    price = float(value)
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f'{value!r} is not a price')
+    return price
+
+
+def product_row(record, username=None):
+    """Validated insert tuple (PRODUCT_FIELDS order) from a form or import record.
+
+    ``username`` fills a missing ``username`` field. Raises ValueError.
+    """
+    values = {}
+    for field, limit in MAX_LENGTHS.items():
+        value = record.get(field)
+        value = '' if value is None else str(value).strip()
+        if len(value) > limit:
+            raise ValueError(f'{field} is longer than {limit} characters')
+        values[field] = value
+    if not values['product_name']:
+        raise ValueError('product_name is required')
+    if not values['shipping']:
+        raise ValueError('shipping is required')
+    owner = record.get('username') or username
+    if owner in (None, ''):
+        raise ValueError('username is required')
+    if record.get('product_price') in (None, ''):
+        raise ValueError('product_price is required')
+    availibility = record.get('availibility')
+    return (
+        int(owner),
+        values['product_name'],
+        values['shipping'],
+        values['description'] or None,
+        parse_price(record['product_price']),
+        True if availibility in (None, '') else parse_bool(availibility),
+    )
+
+
+def read_records(body, content_type):
+    """Records (dicts) of a CSV body with a header row, or of a JSON array"""
+    if content_type == 'text/csv':
+        return list(csv.DictReader(io.StringIO(body.decode('utf-8-sig'))))
+    records = json.loads(body)
+    if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+        raise ValueError('expected a JSON array of objects')
+    return records
+
+
+def import_rows(records, username):
+    """Insert tuples for ``records``; raises :class:`InvalidImport` listing invalid rows"""
+    if len(records) > IMPORT_MAX_ROWS:
+        raise InvalidImport([f'at most {IMPORT_MAX_ROWS} rows per import'])
+    rows, errors = [], []
+    for number, record in enumerate(records, start=1):
+        try:
+            rows.append(product_row(record, username))
+        except (ValueError, TypeError) as e:
+            errors.append(f'row {number}: {e}')
+            if len(errors) >= MAX_ERRORS:
+                break
+    if errors:
+        raise InvalidImport(errors)
+    return rows
+
+
+def check_owners(conn, rows, username, role):
+    """Artists import their own products, managers those of the artists they manage"""
+    owners = {row[0] for row in rows}
+    if role == 'artist':
+        foreign = owners - {username}
+    else:
+        cur = conn.cursor()
+        cur.execute(MANAGED_ARTISTS_SQL, (list(owners), username))
+        foreign = owners - {row['username'] for row in cur.fetchall()}
+    if foreign:
+        raise InvalidImport([f"not allowed to add products for {', '.join(map(str, sorted(foreign)))}"])
+
+
+def import_products(conn, cache, rows):
+    """Insert ``rows`` in batches and commit; returns the number of rows inserted"""
+    cur = conn.cursor()
+    execute_values(cur, IMPORT_SQL, rows, page_size=IMPORT_BATCH_SIZE)
+    conn.commit()
+    cache.invalidate(*{row[0] for row in rows})
+    return len(rows)
+
+
+def add_product(conn, cache, row):
+    """Insert one product tuple and commit; returns its product_id"""
+    cur = conn.cursor()
+    cur.execute(ADD_PRODUCT_SQL, row)
+    product_id = cur.fetchone()['product_id']
+    conn.commit()
+    cache.invalidate(row[0])
+    return product_id
+
+
+def init_app(app, cache):
+    app.extensions['merchandise_cache'] = cache
+
+
+def cache_from_env():
+    """Shares PAGE_CACHE_URL when set; MERCHANDISE_CACHE_TTL, MERCHANDISE_CACHE_SIZE"""
+    url = os.getenv('PAGE_CACHE_URL')
+    backend = (RedisBackend(url, prefix='merch:') if url
+               else LocalBackend(int(os.getenv('MERCHANDISE_CACHE_SIZE', 1000))))
+    return VersionedCache(backend, 'merch', ttl=float(os.getenv('MERCHANDISE_CACHE_TTL', 300)))
@@ -0,0 +1,190 @@
+"""Versioned schema migrations and index checker.
+
+Migrations are the ``NNNN_name.sql`` files in ``../migrations``; each one runs
+in its own transaction and is recorded in ``schema_migrations``.
+
+    python migrate.py            apply pending migrations
+    python migrate.py status     list applied / pending migrations
+    python migrate.py check      report indexes missing for app.py queries
+"""
+import hashlib
+import os
+import re
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+MIGRATION_LOCK_ID = 0x6d696772  # pg_advisory_xact_lock key
+
+# (table, leading index columns, queries in app.py that need them)
+EXPECTED_INDEXES = [
+    ('users', ('email',), 'login(), register()'),
+    ('song_artist_user', ('username',), 'artist_detail(), profile()'),
+    ('event_artist_user', ('username',), 'artist_detail()'),
+    ('song_playlist', ('playlist_id',), 'playlist_detail()'),
+    ('playlist', ('username',), 'playlists by owner'),
+    ('merchandise_product', ('username',), 'merchandise by artist'),
+    ('event', ('location_id',), 'events() location join'),
+    ('event', ('date',), 'events(), index() recent events'),
+    ('event', ('location_id', 'date'), 'api events/discover by location'),
+    ('location', ('country', 'city'), 'api events/discover by country/city'),
+    ('song_summary', ('name', 'song_id'), 'songs() keyset pages'),
+    ('artist_summary', ('next_event_date',), 'summaries.SummaryRefresher'),
+    ('song_neighbour', ('song_id', 'rank'), 'song_detail() more like this, playlist_detail() suggestions'),
+    ('song_playlist', ('song_id',), 'recommend.refresh() neighbourhood'),
+    ('friendship', ('username', 'friend_username'), 'api friends list/count/mutual/suggestions'),
+    ('friendship', ('friend_username',), 'friendship cascade from basic_user'),
+    ('location', ('city',), 'reports events-in-city'),
+    ('users', ('full_name',), 'reports single-artist-events'),
+    ('merchandise_product', ('product_name',), 'reports artists-selling-product'),
+    ('merchandise_product', ('availibility', 'product_price'), 'merchandise() storefront by price'),
+    ('merchandise_product', ('username', 'availibility', 'product_price'), 'artist_merchandise() available products'),
+    ('public_channel', ('preferred_genre', 'channel_id'), 'api channels by genre'),
+    ('public_channel', ('location_id', 'channel_id'), 'api channels by country/city'),
+    ('public_channel', ('username',), 'api moderator channels, moderator_channel triggers'),
+    ('moderator_channel', ('only_channel_name',), 'reports channel-only-moderators'),
+]
+
+INDEX_COLUMNS_SQL = '''
+    SELECT t.relname AS table_name, i.relname AS index_name,
+           array_agg(a.attname::text ORDER BY k.ord) AS columns
+    FROM pg_index x
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(x.indkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = current_schema() AND x.indisvalid
+    GROUP BY t.relname, i.relname
+'''
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def sql(self):
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+    def checksum(self):
+        return hashlib.sha256(self.sql().encode('utf-8')).hexdigest()
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """Migration files sorted by version"""
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2),
+                                        os.path.join(directory, filename)))
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError('duplicate migration version in %s' % directory)
+    return migrations
+
+
+def ensure_table(conn):
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            checksum VARCHAR(64) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    ''')
+    conn.commit()
+
+
+def applied(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT version, checksum FROM schema_migrations')
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+
+def migrate(conn, directory=MIGRATIONS_DIR):
+    """Apply pending migrations in version order; returns the applied ones"""
+    ensure_table(conn)
+    done = applied(conn)
+    ran = []
+    for migration in discover(directory):
+        if migration.version in done:
+            if done[migration.version] != migration.checksum():
+                print(f'warning: {os.path.basename(migration.path)} changed after it was applied')
+            continue
+        cur = conn.cursor()
+        try:
+            # serialize concurrent runners (e.g. several workers starting at once)
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+            cur.execute('SELECT 1 FROM schema_migrations WHERE version = %s', (migration.version,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+            cur.execute(migration.sql())
+            cur.execute('''
+                INSERT INTO schema_migrations (version, name, checksum)
+                VALUES (%s, %s, %s)
+            ''', (migration.version, migration.name, migration.checksum()))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        ran.append(migration)
+    return ran
+
+
+def missing_indexes(conn):
+    """EXPECTED_INDEXES entries not served by a valid index in the live schema"""
+    cur = conn.cursor()
+    cur.execute(INDEX_COLUMNS_SQL)
+    live = {}
+    for table, _, columns in cur.fetchall():
+        live.setdefault(table, []).append(tuple(columns))
+
+    missing = []
+    for table, columns, used_by in EXPECTED_INDEXES:
+        if not any(index[:len(columns)] == columns for index in live.get(table, [])):
+            missing.append((table, columns, used_by))
+    return missing
+
+
+def main(argv):
+    load_dotenv()
+    command = argv[1] if len(argv) > 1 else 'up'
+    conn = psycopg2.connect(**db.config_from_env())
+    try:
+        if command == 'up':
+            for migration in migrate(conn):
+                print(f'applied {migration.version:04d}_{migration.name}')
+        elif command == 'status':
+            ensure_table(conn)
+            done = applied(conn)
+            for migration in discover():
+                state = 'applied' if migration.version in done else 'pending'
+                print(f'{migration.version:04d}_{migration.name}: {state}')
+        elif command == 'check':
+            missing = missing_indexes(conn)
+            for table, columns, used_by in missing:
+                print(f"missing index on {table}({', '.join(columns)}) used by {used_by}")
+            if missing:
+                return 1
+            print('all expected indexes present')
+        else:
+            print(__doc__)
+            return 2
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
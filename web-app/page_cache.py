@@ -0,0 +1,250 @@
+"""Rendered-fragment cache for the artist and song detail pages.
+
+Fragments are stored under keys versioned by entity (``artist:<username>:v3``);
+:meth:`PageCache.invalidate` bumps the version, so stale fragments are never
+read again and simply age out. The default backend is an in-process LRU with
+a TTL; with PAGE_CACHE_URL=redis://... all workers share one store (and one
+set of versions), so a write in one process invalidates the page everywhere.
+
+Each entry carries an ETag and a modification time, which
+:func:`conditional_response` turns into ETag / Last-Modified headers and
+304 answers without rendering or touching the database.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import Response, make_response, request, session
+
+log = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    """In-process LRU store with per-entry expiry"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # versions are not evicted: forgetting one would bring back an old page
+        self._versions = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisBackend:
+    """Shared store; needs the ``redis`` package and a Redis-compatible server"""
+
+    def __init__(self, url, prefix='page:'):
+        import redis  # optional dependency, only needed with PAGE_CACHE_URL
+
+        self._client = redis.Redis.from_url(url)
+        self._errors = (redis.RedisError,)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def version(self, key):
+        return int(self._client.get(self.prefix + 'version:' + key) or 0)
+
+    def bump(self, key):
+        return self._client.incr(self.prefix + 'version:' + key)
+
+    def size(self):
+        return None
+
+
+class VersionedCache:
+    """JSON-serialisable values per ident for ``ttl`` seconds.
+
+    Keys are versioned per ident (``<kind>:<ident>:v<n>``) like the page
+    cache, so with a shared backend an invalidation reaches every worker. A
+    failing backend is logged and bypassed: values are then computed on
+    every call.
+    """
+
+    def __init__(self, backend, kind, ttl=300.0):
+        self.backend = backend
+        self.kind = kind
+        self.ttl = ttl
+
+    def get_or_compute(self, ident, compute):
+        entity = f'{self.kind}:{ident}'
+        try:
+            key = f'{entity}:v{self.backend.version(entity)}'
+            value = self.backend.get(key)
+        except Exception as e:
+            log.warning('%s cache unavailable: %s', self.kind, e)
+            return compute()
+        if value is None:
+            value = compute()
+            try:
+                self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                log.warning('%s cache unavailable: %s', self.kind, e)
+        return value
+
+    def invalidate(self, *idents):
+        for ident in idents:
+            try:
+                self.backend.bump(f'{self.kind}:{ident}')
+            except Exception as e:
+                log.warning('%s cache invalidation failed for %s: %s', self.kind, ident, e)
+
+
+class PageCache:
+    def __init__(self, backend, ttl=300.0):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._metrics = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._metrics[name] += n
+
+    def lookup(self, kind, ident):
+        """``(key, entry)`` for the current version; entry is None on a miss"""
+        entity = f'{kind}:{ident}'
+        try:
+            key = f'{entity}:v{self.backend.version(entity)}'
+            entry = self.backend.get(key)
+        except Exception as e:  # a broken shared cache must not take pages down
+            log.warning('page cache read failed for %s: %s', entity, e)
+            self._count('errors')
+            return None, None
+        self._count('hits' if entry is not None else 'misses')
+        return key, entry
+
+    def store(self, key, fragments):
+        """Entry for freshly rendered ``fragments``, saved under ``key`` when given"""
+        digest = hashlib.sha1(json.dumps(fragments, sort_keys=True).encode('utf-8')).hexdigest()
+        entry = {'fragments': fragments, 'etag': digest[:20], 'modified': int(time.time())}
+        if key is not None:
+            try:
+                self.backend.set(key, entry, self.ttl)
+            except Exception as e:
+                log.warning('page cache write failed for %s: %s', key, e)
+                self._count('errors')
+        return entry
+
+    def get_or_render(self, kind, ident, render):
+        """Cached entry for ``kind``/``ident``, calling ``render()`` on a miss.
+
+        ``render`` returns a dict of strings (the fragments) or None when the
+        page must not be cached, e.g. for a missing entity. The entry is
+        ``{'fragments': ..., 'etag': ..., 'modified': unix seconds}``.
+        """
+        key, entry = self.lookup(kind, ident)
+        if entry is not None:
+            return entry
+        fragments = render()
+        return self.store(key, fragments) if fragments is not None else None
+
+    async def get_or_render_async(self, kind, ident, render):
+        """:meth:`get_or_render` with a coroutine function ``render``"""
+        key, entry = self.lookup(kind, ident)
+        if entry is not None:
+            return entry
+        fragments = await render()
+        return self.store(key, fragments) if fragments is not None else None
+
+    def invalidate(self, kind, *idents):
+        """Call after commit for every entity whose page changed"""
+        for ident in idents:
+            try:
+                self.backend.bump(f'{kind}:{ident}')
+            except Exception as e:
+                log.warning('page cache invalidation failed for %s:%s: %s', kind, ident, e)
+                self._count('errors')
+        self._count('invalidations', len(idents))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+        stats['ttl'] = self.ttl
+        size = self.backend.size()
+        if size is not None:
+            stats['entries'] = size
+        return stats
+
+
+def validators(entry, req, sess):
+    """``(etag, last_modified, fresh)`` for ``entry`` as seen by this request.
+
+    The navbar depends on the session, so the ETag mixes in the logged-in
+    user. Pending flash messages always get a full page.
+    """
+    viewer = sess.get('username') or ''
+    etag = hashlib.sha1(f"{entry['etag']}:{viewer}".encode('utf-8')).hexdigest()[:20]
+    modified = datetime.fromtimestamp(entry['modified'], timezone.utc)
+
+    if '_flashes' in sess:
+        fresh = False
+    elif req.if_none_match:
+        fresh = req.if_none_match.contains_weak(etag)
+    else:
+        fresh = req.if_modified_since is not None and modified <= req.if_modified_since
+    return etag, modified, fresh
+
+
+def set_validators(response, etag, modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def conditional_response(entry, render_page):
+    """Full response from ``render_page()``, or 304 when the client's copy is current"""
+    etag, modified, fresh = validators(entry, request, session)
+    response = Response(status=304) if fresh else make_response(render_page())
+    return set_validators(response, etag, modified)
+
+
+def cache_from_env():
+    url = os.getenv('PAGE_CACHE_URL')
+    backend = RedisBackend(url) if url else LocalBackend(int(os.getenv('PAGE_CACHE_SIZE', 1000)))
+    return PageCache(backend, ttl=float(os.getenv('PAGE_CACHE_TTL', 300)))
@@ -0,0 +1,155 @@
+"""Keyset (cursor) pagination and server-side streaming for list pages.
+
+List queries are written with two placeholders::
+
+    SELECT ... FROM song s WHERE {keyset} ORDER BY {order}
+
+``{keyset}`` becomes a row comparison against the last row of the previous
+page, e.g. ``(s.name, s.song_id) < (%s, %s)``, and ``{order}`` the matching
+ORDER BY list, so every page is an index range scan instead of an OFFSET.
+"""
+import base64
+import binascii
+import datetime
+import json
+import uuid
+
+from psycopg2.extras import RealDictCursor
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+STREAM_ITERSIZE = 500
+
+
+class InvalidToken(ValueError):
+    """Raised for a malformed ``after``/``before`` token"""
+
+
+class Keyset:
+    """Ordering of a list query; all columns are sorted in one direction"""
+
+    def __init__(self, columns, keys=None, descending=False):
+        self.columns = list(columns)                     # SQL expressions
+        self.keys = list(keys or [c.split('.')[-1] for c in columns])  # row keys
+        self.descending = descending
+
+    def order_by(self, reverse=False):
+        desc = self.descending != reverse
+        return ', '.join(f"{col} {'DESC' if desc else 'ASC'}" for col in self.columns)
+
+    def condition(self, reverse=False):
+        desc = self.descending != reverse
+        cols = ', '.join(self.columns)
+        marks = ', '.join(['%s'] * len(self.columns))
+        return f"({cols}) {'<' if desc else '>'} ({marks})"
+
+    def values(self, row):
+        return [row[key] for key in self.keys]
+
+
+class Page:
+    def __init__(self, rows, next_token=None, prev_token=None, limit=DEFAULT_PAGE_SIZE):
+        self.rows = rows
+        self.next_token = next_token
+        self.prev_token = prev_token
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'cannot encode {type(value).__name__} in a page token')
+
+
+def encode_token(values):
+    raw = json.dumps(values, default=_json_default, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_token(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidToken(str(e)) from None
+    if not isinstance(values, list):
+        raise InvalidToken('token must encode a list')
+    return values
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Clamp a ``limit`` query argument to 1..maximum"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
+
+
+def page_query(sql, params, keyset, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """``(query, args, reverse, token)`` for one page of ``sql``; see :func:`fetch_page`"""
+    reverse = before is not None and after is None
+    token = before if reverse else after
+    values = decode_token(token) if token else []
+    if token and len(values) != len(keyset.columns):
+        raise InvalidToken('token does not match this listing')
+
+    query = sql.format(
+        keyset=keyset.condition(reverse) if token else 'TRUE',
+        order=keyset.order_by(reverse),
+    ) + '\nLIMIT %s'
+    return query, tuple(params) + tuple(values) + (limit + 1,), reverse, token
+
+
+def make_page(rows, keyset, limit, reverse, token):
+    """:class:`Page` from the ``limit + 1`` rows fetched for :func:`page_query`"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if reverse:
+        rows.reverse()
+
+    next_token = prev_token = None
+    if rows:
+        if has_more or reverse:
+            next_token = encode_token(keyset.values(rows[-1]))
+        if token and (has_more or not reverse):
+            prev_token = encode_token(keyset.values(rows[0]))
+    return Page(rows, next_token, prev_token, limit)
+
+
+def fetch_page(conn, sql, params, keyset, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Fetch one page of ``sql`` following or preceding a token.
+
+    Returns a :class:`Page` whose tokens are ``None`` at either end.
+    """
+    query, args, reverse, token = page_query(sql, params, keyset, after, before, limit)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(query, args)
+    return make_page(cur.fetchall(), keyset, limit, reverse, token)
+
+
+def stream_rows(conn, sql, params, keyset, after=None, itersize=STREAM_ITERSIZE):
+    """Yield every row after ``after`` through a server-side named cursor.
+
+    Only ``itersize`` rows are held in memory at a time. The connection must
+    stay checked out until the generator is exhausted.
+    """
+    values = decode_token(after) if after else []
+    query = sql.format(
+        keyset=keyset.condition() if after else 'TRUE',
+        order=keyset.order_by(),
+    )
+    cur = conn.cursor(name=f'stream_{uuid.uuid4().hex}', cursor_factory=RealDictCursor)
+    cur.itersize = itersize
+    try:
+        cur.execute(query, tuple(params) + tuple(values))
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
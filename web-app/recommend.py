@@ -0,0 +1,405 @@
+"""Song recommendations from playlist co-occurrence.
+
+Every song is a row of a sparse song x playlist matrix built from
+``song_playlist``; two songs are similar when they appear in the same
+playlists (cosine similarity of their rows). The top ``RECOMMEND_TOP_K``
+neighbours of each song are computed in batch with NumPy/SciPy and stored in
+``song_neighbour`` (migration 0007), so serving reads at most K rows:
+
+* :data:`SIMILAR_SONGS_SQL` - "more like this" on song_detail()
+* :data:`SUGGESTED_SONGS_SQL` - "suggested additions" on playlist_detail():
+  neighbours of the playlist's most recent songs that it does not contain yet
+
+A trigger queues every playlist whose songs change (add_song_to_playlist(),
+bulk edits) and the songs removed from it (migration 0012);
+:class:`NeighbourRefresher` recomputes only those songs and the songs still
+in the queued playlists. Neighbour lists of other songs keep their old scores for
+the changed songs, and songs in more playlists than :func:`refresh_cap`
+keep their lists, until the next full build. A recompute reads every
+playlist that shares a song with its batch, so batches are halved until
+that neighbourhood is within ``REFRESH_MAX_ROWS`` rows of song_playlist.
+
+    python recommend.py build       full recompute (after bulk loads)
+    python recommend.py refresh     process the queue once
+
+NumPy and SciPy are only needed to compute; pages only read the table.
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger(__name__)
+
+TOP_K = 20
+BLOCK_SIZE = 1000  # songs per sparse matrix product
+REFRESH_BATCH = 100  # queued playlists per incremental recompute, at most
+REFRESH_MAX_ROWS = 100_000  # song_playlist rows one incremental recompute should read
+SHOW_SIMILAR = 10
+SHOW_SUGGESTED = 10
+SUGGEST_SEEDS = 20  # most recently added songs of a playlist used for suggestions
+LOCK_ID = 0x72656373  # pg_advisory_xact_lock key: one writer of song_neighbour at a time
+
+SIMILAR_SONGS_SQL = '''
+    SELECT s.song_id, s.name, n.score
+    FROM song_neighbour n
+    JOIN song s ON s.song_id = n.neighbour_id
+    WHERE n.song_id = %s
+    ORDER BY n.rank
+    LIMIT %s
+'''
+
+SUGGESTED_SONGS_SQL = '''
+    SELECT s.song_id, s.name, SUM(n.score) AS score
+    FROM (
+        SELECT song_id FROM song_playlist
+        WHERE playlist_id = %(playlist_id)s
+        ORDER BY position DESC
+        LIMIT %(seeds)s
+    ) seed
+    JOIN song_neighbour n ON n.song_id = seed.song_id
+    JOIN song s ON s.song_id = n.neighbour_id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM song_playlist sp
+        WHERE sp.playlist_id = %(playlist_id)s AND sp.song_id = n.neighbour_id
+    )
+    GROUP BY s.song_id, s.name
+    ORDER BY score DESC, s.song_id
+    LIMIT %(limit)s
+'''
+
+DEQUEUE_SQL = '''
+    DELETE FROM song_neighbour_queue
+    WHERE playlist_id IN (SELECT playlist_id FROM song_neighbour_queue ORDER BY queued_at LIMIT %s)
+    RETURNING playlist_id
+'''
+
+# songs removed from the dequeued playlists
+DEQUEUE_REMOVED_SQL = '''
+    DELETE FROM song_neighbour_removed
+    WHERE playlist_id = ANY(%s)
+    RETURNING song_id
+'''
+
+# songs of the changed playlists and songs removed from them, except very popular ones;
+# a removed song in no playlist any more is included (its list is dropped)
+CHANGED_SONGS_SQL = '''
+    SELECT c.song_id
+    FROM (
+        SELECT song_id FROM song_playlist WHERE playlist_id = ANY(%(playlists)s)
+        UNION
+        SELECT unnest(%(removed)s::integer[])
+    ) c
+    LEFT JOIN song_playlist sp ON sp.song_id = c.song_id
+    GROUP BY c.song_id
+    HAVING COUNT(sp.song_id) <= %(max_playlists)s
+'''
+
+# every (song, playlist) pair of the playlists that contain one of the songs
+NEIGHBOURHOOD_SQL = '''
+    SELECT sp.song_id, sp.playlist_id
+    FROM song_playlist sp
+    WHERE sp.playlist_id IN (SELECT playlist_id FROM song_playlist WHERE song_id = ANY(%s))
+'''
+
+# playlists NEIGHBOURHOOD_SQL reads (index-only scan of pk_song_playlist)
+NEIGHBOURHOOD_SIZE_SQL = '''
+    SELECT COUNT(DISTINCT playlist_id) FROM song_playlist WHERE song_id = ANY(%s)
+'''
+
+# songs per playlist, from the planner's row estimates
+MEAN_PLAYLIST_LENGTH_SQL = '''
+    SELECT sp.reltuples / NULLIF(p.reltuples, 0)
+    FROM pg_class sp, pg_class p
+    WHERE sp.oid = 'song_playlist'::regclass AND p.oid = 'playlist'::regclass
+'''
+
+PLAYLIST_COUNTS_SQL = '''
+    SELECT song_id, COUNT(*) AS playlists
+    FROM song_playlist
+    WHERE song_id = ANY(%s)
+    GROUP BY song_id
+'''
+
+
+def _numeric():
+    import numpy
+    from scipy import sparse
+    return numpy, sparse
+
+
+def available():
+    try:
+        _numeric()
+    except ImportError:
+        return False
+    return True
+
+
+# ==================== SIMILARITY ====================
+
+
+def incidence_matrix(pairs):
+    """CSR song x playlist matrix of an (n, 2) array of (song_id, playlist_id).
+
+    Returns ``(matrix, song_ids)``; row ``i`` of the matrix is ``song_ids[i]``.
+    """
+    np, sparse = _numeric()
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    song_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    playlist_ids, cols = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.float32), (rows, cols)),
+                               shape=(len(song_ids), len(playlist_ids)))
+    return matrix, song_ids
+
+
+def top_neighbours(matrix, rows=None, counts=None, top_k=TOP_K, min_shared=1, block_size=BLOCK_SIZE):
+    """Yield ``(row, neighbour_rows, scores)`` for ``rows`` (default: all), best first.
+
+    cosine(a, b) = shared playlists / sqrt(playlists of a * playlists of b).
+    ``counts`` overrides the playlists per song when ``matrix`` only holds
+    part of the playlists (incremental recompute). Pairs sharing fewer
+    than ``min_shared`` playlists are ignored.
+    """
+    np, _ = _numeric()
+    if counts is None:
+        counts = matrix.getnnz(axis=1)
+    inverse_norms = 1.0 / np.sqrt(np.maximum(np.asarray(counts, dtype=np.float64), 1.0))
+    if rows is None:
+        rows = np.arange(matrix.shape[0])
+    transposed = matrix.T.tocsr()
+
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        # shared playlist counts of the block's songs with every song, still sparse
+        shared = (matrix[block] @ transposed).tocsr()
+        for i, row in enumerate(block):
+            lo, hi = shared.indptr[i], shared.indptr[i + 1]
+            neighbours, together = shared.indices[lo:hi], shared.data[lo:hi]
+            keep = (neighbours != row) & (together >= min_shared)
+            neighbours, together = neighbours[keep], together[keep]
+            if not len(neighbours):
+                continue
+            scores = together * inverse_norms[row] * inverse_norms[neighbours]
+            if len(neighbours) > top_k:
+                # everything scoring at least the K-th best, ties included, so the
+                # cut below follows (-score, neighbour) and not the partition order
+                kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+                best = scores >= kth
+                neighbours, scores = neighbours[best], scores[best]
+            order = np.lexsort((neighbours, -scores))[:top_k]
+            yield row, neighbours[order], scores[order]
+
+
+def neighbour_rows(matrix, song_ids, **kwargs):
+    """(song_id, rank, neighbour_id, score) tuples ready for song_neighbour"""
+    for row, neighbours, scores in top_neighbours(matrix, **kwargs):
+        song_id = int(song_ids[row])
+        for rank, (neighbour, score) in enumerate(zip(neighbours, scores), 1):
+            yield song_id, rank, int(song_ids[neighbour]), float(score)
+
+
+# ==================== DATABASE ====================
+
+
+def _cursor(conn):
+    # tuple rows, also on pool connections (their default is RealDictCursor)
+    return conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+
+
+def _read_pairs(cur, sql, params=()):
+    """(n, 2) int64 array of the (song_id, playlist_id) rows of ``sql``, via COPY"""
+    np, _ = _numeric()
+    buffer = io.StringIO()
+    cur.copy_expert(f'COPY ({cur.mogrify(sql, params).decode()}) TO STDOUT', buffer)
+    return np.fromstring(buffer.getvalue(), dtype=np.int64, sep=' ').reshape(-1, 2)
+
+
+def _write_rows(cur, rows):
+    buffer = io.StringIO()
+    count = 0
+    for song_id, rank, neighbour_id, score in rows:
+        buffer.write(f'{song_id}\t{rank}\t{neighbour_id}\t{score:.6g}\n')
+        count += 1
+    buffer.seek(0)
+    cur.copy_expert('COPY song_neighbour (song_id, rank, neighbour_id, score) FROM STDIN', buffer)
+    return count
+
+
+def rebuild(conn, top_k=TOP_K, min_shared=1):
+    """Recompute every song's neighbours in one transaction; returns (songs, rows).
+
+    Readers keep seeing the old rows until commit. The queue is emptied
+    before song_playlist is read, so playlists changed during the build stay
+    queued (and are recomputed once more by the next refresh).
+    """
+    cur = _cursor(conn)
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+    cur.execute('DELETE FROM song_neighbour_queue')
+    cur.execute('DELETE FROM song_neighbour_removed')
+    matrix, song_ids = incidence_matrix(_read_pairs(cur, 'SELECT song_id, playlist_id FROM song_playlist'))
+    cur.execute('DELETE FROM song_neighbour')
+    count = _write_rows(cur, neighbour_rows(matrix, song_ids, top_k=top_k, min_shared=min_shared))
+    conn.commit()
+    return len(song_ids), count
+
+
+def refresh_cap(mean_length, max_rows=REFRESH_MAX_ROWS):
+    """Most playlists a song may be in and still be recomputed incrementally.
+
+    Each of a playlist's ``mean_length`` songs reads about ``mean_length``
+    rows per playlist it is in, so at this cap one changed playlist reads up
+    to ``max_rows``. More popular songs keep their lists until the next full
+    build; one more playlist moves their scores by less than 1 / cap.
+    """
+    mean_length = max(mean_length or 0, 1.0)
+    return max(1, int(max_rows / (mean_length * mean_length)))
+
+
+def refresh(conn, top_k=TOP_K, min_shared=1, batch=REFRESH_BATCH, max_rows=REFRESH_MAX_ROWS):
+    """Recompute the songs of up to ``batch`` queued playlists and the songs removed from them.
+
+    Only the playlists that share a song with them are read: that is every
+    co-occurrence of the changed songs; their total playlist counts are
+    fetched separately for the cosine denominator. While those playlists
+    hold more than about ``max_rows`` rows, the batch is put back and halved.
+    Returns ``(playlist_ids, song_ids)``, or None when another process holds
+    the lock.
+    """
+    np, _ = _numeric()
+    cur = _cursor(conn)
+    while True:
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (LOCK_ID,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return None
+        cur.execute(DEQUEUE_SQL, (batch,))
+        playlist_ids = [row[0] for row in cur.fetchall()]
+        if not playlist_ids:
+            conn.rollback()
+            return [], []
+
+        cur.execute(MEAN_PLAYLIST_LENGTH_SQL)
+        mean_length = cur.fetchone()[0]
+        cur.execute(DEQUEUE_REMOVED_SQL, (playlist_ids,))
+        removed = sorted({row[0] for row in cur.fetchall()})
+        cur.execute(CHANGED_SONGS_SQL, {'playlists': playlist_ids, 'removed': removed,
+                                        'max_playlists': refresh_cap(mean_length, max_rows)})
+        changed = [row[0] for row in cur.fetchall()]
+        if len(playlist_ids) == 1 or not changed:
+            break
+        cur.execute(NEIGHBOURHOOD_SIZE_SQL, (changed,))
+        if cur.fetchone()[0] * max(mean_length or 0, 1.0) <= max_rows:
+            break
+        conn.rollback()  # the playlists go back to the queue
+        batch = len(playlist_ids) // 2
+
+    if changed:
+        matrix, song_ids = incidence_matrix(_read_pairs(cur, NEIGHBOURHOOD_SQL, (changed,)))
+        cur.execute(PLAYLIST_COUNTS_SQL, (song_ids.tolist(),))
+        totals = dict(cur.fetchall())
+        counts = np.array([totals.get(int(song_id), 0) for song_id in song_ids])
+        rows = np.flatnonzero(np.isin(song_ids, changed))
+        cur.execute('DELETE FROM song_neighbour WHERE song_id = ANY(%s)', (changed,))
+        _write_rows(cur, neighbour_rows(matrix, song_ids, rows=rows, counts=counts,
+                                        top_k=top_k, min_shared=min_shared))
+    conn.commit()
+    return playlist_ids, changed
+
+
+# ==================== BACKGROUND REFRESH ====================
+
+
+class NeighbourRefresher(db.Refresher):
+    """Drains ``song_neighbour_queue`` every ``interval`` seconds in a daemon thread.
+
+    ``on_update(song_ids)`` is called after each committed batch (the app
+    invalidates those song pages).
+    """
+
+    name = 'neighbour-refresher'
+
+    def __init__(self, pool, interval=60.0, top_k=TOP_K, min_shared=1, on_update=None):
+        super().__init__(pool, interval)
+        self.top_k = top_k
+        self.min_shared = min_shared
+        self.on_update = on_update
+
+    def run_once(self):
+        """Process queued playlists until the queue is empty; returns the songs recomputed"""
+        total = 0
+        batch = REFRESH_BATCH
+        while True:
+            with self.connection() as conn:
+                result = refresh(conn, self.top_k, self.min_shared, batch=batch)
+            if not result or not result[0]:
+                return total
+            # start the next batch from the size that fitted
+            batch = min(REFRESH_BATCH, 2 * len(result[0]))
+            song_ids = result[1]
+            total += len(song_ids)
+            if song_ids and self.on_update:
+                self.on_update(song_ids)
+
+    def can_start(self):
+        if not available():
+            log.warning('numpy/scipy not installed, song recommendations are not refreshed')
+            return False
+        return True
+
+
+def refresher_from_env(pool, on_update=None):
+    """RECOMMEND_REFRESH_INTERVAL in seconds (0 disables), RECOMMEND_TOP_K, RECOMMEND_MIN_SHARED"""
+    return NeighbourRefresher(
+        pool,
+        interval=float(os.getenv('RECOMMEND_REFRESH_INTERVAL', 60)),
+        top_k=int(os.getenv('RECOMMEND_TOP_K', TOP_K)),
+        min_shared=int(os.getenv('RECOMMEND_MIN_SHARED', 1)),
+        on_update=on_update,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--top-k', type=int, default=int(os.getenv('RECOMMEND_TOP_K', TOP_K)))
+    parser.add_argument('--min-shared', type=int, default=int(os.getenv('RECOMMEND_MIN_SHARED', 1)))
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    conn = psycopg2.connect(**db.config_from_env())
+    start = time.perf_counter()
+    try:
+        if args.command == 'build':
+            songs, rows = rebuild(conn, args.top_k, args.min_shared)
+            print(f'{rows} neighbours for {songs} songs')
+        else:
+            total = 0
+            while True:
+                result = refresh(conn, args.top_k, args.min_shared)
+                if result is None:
+                    print('another refresh is running')
+                    return 1
+                if not result[0]:
+                    break
+                total += len(result[1])
+            print(f'recomputed {total} songs')
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f'{args.command} failed: {e}')
+        return 1
+    finally:
+        conn.close()
+    print(f'done in {time.perf_counter() - start:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""Parameterized reports for the analytical questions of main.xml.
+
+Each report has the form written in main.xml (``naive_sql``, kept for
+benchmarks/report_bench.py) and the form the app runs:
+
+* D7  moderators of only the given channel - lookup in the per-moderator
+  summary of migration 0011 (maintained by triggers) instead of an EXCEPT
+  of two joins;
+* D8  artists featured in every event - division as one GROUP BY over the
+  (username, event_id) index compared with the event count, instead of
+  COUNT(DISTINCT) on both sides;
+* D9  events in a city - index lookup on location.city, no DISTINCT *;
+* D11 events featuring only one given artist - NOT EXISTS on the
+  event's other artists instead of an EXCEPT of two joins;
+* D12 playlists containing a song - EXISTS semi-join, no DISTINCT;
+* D13 artists selling a product - EXISTS on (product_name, username);
+* D14 artists with no songs - NOT EXISTS anti-join instead of EXCEPT.
+
+With ``REPORTS_USE_VIEWS=1`` the D8, D11 and D14 reports read the
+materialized views of migration 0009, which :class:`ReportRefresher`
+refreshes every ``REPORTS_REFRESH_INTERVAL`` seconds.
+"""
+import os
+
+import db
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class Report:
+    """One question: SQL with ``%(name)s`` parameters (defaults from main.xml) and ``%(limit)s``"""
+
+    def __init__(self, question, title, sql, naive_sql, params=None, view_sql=None, login_required=False):
+        self.question = question
+        self.title = title
+        self.sql = sql
+        self.naive_sql = naive_sql
+        self.params = params or {}
+        self.view_sql = view_sql
+        self.login_required = login_required
+
+    def arguments(self, args, limit=DEFAULT_LIMIT):
+        """Query parameters from ``args`` (a mapping), falling back to the defaults"""
+        values = {name: (args.get(name) or default).strip() for name, default in self.params.items()}
+        values['limit'] = limit
+        return values
+
+    def run(self, conn, args, limit=DEFAULT_LIMIT, use_views=False, naive=False):
+        sql = self.naive_sql if naive else (self.view_sql if use_views and self.view_sql else self.sql)
+        cur = conn.cursor()
+        cur.execute(sql, self.arguments(args, limit))
+        return cur.fetchall()
+
+
+ARTIST_COLUMNS = 'au.username, u.full_name, au.genre'
+EVENT_COLUMNS = 'e.event_id, e.description, e.date, e.conditions'
+
+REPORTS = {
+    'channel-only-moderators': Report(
+        'D7', 'Moderators of only the given channel',
+        '''
+        SELECT mc.username, u.full_name, mc.channel_count
+        FROM moderator_channel mc
+        JOIN users u ON u.username = mc.username
+        WHERE mc.only_channel_name = %(channel)s
+        ORDER BY mc.username
+        LIMIT %(limit)s
+        ''',
+        '''
+        SELECT * FROM (
+            SELECT full_name
+            FROM public_channel
+            NATURAL JOIN users
+            WHERE channel_name = %(channel)s
+            EXCEPT
+            SELECT full_name
+            FROM public_channel
+            NATURAL JOIN users
+            WHERE channel_name <> %(channel)s
+        ) r
+        ORDER BY full_name
+        LIMIT %(limit)s
+        ''',
+        params={'channel': 'Chanel123'},
+    ),
+    'artists-in-all-events': Report(
+        'D8', 'Artists featured in all events',
+        f'''
+        SELECT {ARTIST_COLUMNS}
+        FROM (
+            SELECT username
+            FROM event_artist_user
+            GROUP BY username
+            HAVING COUNT(*) = (SELECT COUNT(*) FROM event)
+        ) d
+        JOIN artist_user au ON au.username = d.username
+        JOIN users u ON u.username = au.username
+        ORDER BY au.username
+        LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT {ARTIST_COLUMNS}
+        FROM artist_user au
+        JOIN users u ON u.username = au.username
+        WHERE au.username IN (
+            SELECT DISTINCT username
+            FROM event_artist_user
+            GROUP BY username
+            HAVING COUNT(DISTINCT event_id) = (SELECT COUNT(DISTINCT event_id) FROM event)
+        )
+        ORDER BY au.username
+        LIMIT %(limit)s
+        ''',
+        view_sql='''
+        SELECT username, full_name, genre
+        FROM report_artists_in_all_events
+        ORDER BY username
+        LIMIT %(limit)s
+        ''',
+    ),
+    'events-in-city': Report(
+        'D9', 'Events in a city',
+        f'''
+        SELECT {EVENT_COLUMNS}, l.country, l.city, l.address
+        FROM location l
+        JOIN event e ON e.location_id = l.location_id
+        WHERE l.city = %(city)s
+        ORDER BY e.date, e.event_id
+        LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT {EVENT_COLUMNS}, l.country, l.city, l.address
+        FROM event e
+        NATURAL JOIN (
+            SELECT DISTINCT *
+            FROM location
+            WHERE city = %(city)s
+        ) l
+        ORDER BY e.date, e.event_id
+        LIMIT %(limit)s
+        ''',
+        params={'city': 'Prague'},
+    ),
+    'single-artist-events': Report(
+        'D11', 'Events featuring only the given artist',
+        f'''
+        SELECT {EVENT_COLUMNS}
+        FROM users u
+        JOIN event_artist_user ea ON ea.username = u.username
+        JOIN event e ON e.event_id = ea.event_id
+        WHERE u.full_name = %(artist)s
+          AND NOT EXISTS (
+              SELECT 1 FROM event_artist_user other
+              WHERE other.event_id = ea.event_id AND other.username <> ea.username
+          )
+        ORDER BY e.date, e.event_id
+        LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT * FROM (
+            SELECT DISTINCT {EVENT_COLUMNS}
+            FROM event e
+            JOIN event_artist_user ea ON ea.event_id = e.event_id
+            JOIN users u ON u.username = ea.username
+            WHERE u.full_name = %(artist)s
+            EXCEPT
+            SELECT DISTINCT {EVENT_COLUMNS}
+            FROM event e
+            JOIN event_artist_user ea ON ea.event_id = e.event_id
+            JOIN users u ON u.username = ea.username
+            WHERE u.full_name != %(artist)s
+        ) e
+        ORDER BY e.date, e.event_id
+        LIMIT %(limit)s
+        ''',
+        params={'artist': 'Hannah Jackson'},
+        view_sql=f'''
+        SELECT {EVENT_COLUMNS}
+        FROM users u
+        JOIN report_single_artist_events r ON r.username = u.username
+        JOIN event e ON e.event_id = r.event_id
+        WHERE u.full_name = %(artist)s
+        ORDER BY e.date, e.event_id
+        LIMIT %(limit)s
+        ''',
+    ),
+    'playlists-with-song': Report(
+        'D12', 'Playlists containing a song',
+        '''
+        SELECT p.playlist_id, p.username AS owner, p.description, p.link
+        FROM playlist p
+        WHERE EXISTS (
+            SELECT 1
+            FROM song s
+            JOIN song_playlist sp ON sp.song_id = s.song_id
+            WHERE s.name = %(song)s AND sp.playlist_id = p.playlist_id
+        )
+        ORDER BY p.playlist_id
+        LIMIT %(limit)s
+        ''',
+        '''
+        SELECT DISTINCT p.playlist_id, p.username AS owner, p.description, p.link
+        FROM playlist p
+        NATURAL JOIN song_playlist
+        NATURAL JOIN song
+        WHERE song.name = %(song)s
+        ORDER BY p.playlist_id
+        LIMIT %(limit)s
+        ''',
+        params={'song': 'Push it'},
+        login_required=True,
+    ),
+    'artists-selling-product': Report(
+        'D13', 'Artists selling a product',
+        f'''
+        SELECT {ARTIST_COLUMNS}
+        FROM artist_user au
+        JOIN users u ON u.username = au.username
+        WHERE EXISTS (
+            SELECT 1 FROM merchandise_product mp
+            WHERE mp.username = au.username AND mp.product_name = %(product)s
+        )
+        ORDER BY au.username
+        LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT {ARTIST_COLUMNS}
+        FROM artist_user au
+        JOIN users u ON u.username = au.username
+        JOIN merchandise_product mp ON mp.username = au.username
+        WHERE mp.product_name = %(product)s
+        ORDER BY au.username
+        LIMIT %(limit)s
+        ''',
+        params={'product': 'Pink hoodie'},
+    ),
+    'artists-without-songs': Report(
+        'D14', 'Artists with no songs',
+        f'''
+        SELECT {ARTIST_COLUMNS}
+        FROM artist_user au
+        JOIN users u ON u.username = au.username
+        WHERE NOT EXISTS (SELECT 1 FROM song_artist_user sau WHERE sau.username = au.username)
+        ORDER BY au.username
+        LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT * FROM (
+            SELECT DISTINCT {ARTIST_COLUMNS}
+            FROM artist_user au
+            NATURAL JOIN users u
+            EXCEPT
+            SELECT DISTINCT {ARTIST_COLUMNS}
+            FROM song_artist_user sau
+            JOIN artist_user au ON au.username = sau.username
+            JOIN users u ON u.username = au.username
+        ) r
+        ORDER BY username
+        LIMIT %(limit)s
+        ''',
+        view_sql='''
+        SELECT username, full_name, genre
+        FROM report_artists_without_songs
+        ORDER BY username
+        LIMIT %(limit)s
+        ''',
+    ),
+}
+
+
+class ReportRefresher(db.Refresher):
+    """Calls ``report_refresh()`` every ``interval`` seconds in a daemon thread.
+
+    Every worker runs one; the function refreshes only views older than the
+    interval, under an advisory lock, so each view is rebuilt once per period.
+    """
+
+    name = 'report-refresher'
+
+    def __init__(self, pool, interval=900.0):
+        super().__init__(pool, interval)
+
+    def run_once(self):
+        """Refresh the stale views; returns how many"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT report_refresh(make_interval(secs => %s)) AS refreshed', (self.interval,))
+            refreshed = cur.fetchone()['refreshed']
+            conn.commit()
+            return refreshed
+
+
+def use_views_from_env():
+    return os.getenv('REPORTS_USE_VIEWS') == '1'
+
+
+def init_app(app, refresher, use_views):
+    app.extensions['reports_use_views'] = use_views
+    app.before_request(refresher.start)
+
+
+def refresher_from_env(pool):
+    """REPORTS_REFRESH_INTERVAL in seconds; the thread only runs with REPORTS_USE_VIEWS=1"""
+    interval = float(os.getenv('REPORTS_REFRESH_INTERVAL', 900)) if use_views_from_env() else 0
+    return ReportRefresher(pool, interval=interval)
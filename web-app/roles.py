@@ -0,0 +1,90 @@
+"""User role resolution.
+
+A user's role is decided by which type table holds their username. It is
+resolved with LEFT JOINs (one round trip) and cached in the session under
+``user_type``; profile updates drop the cached value so it is re-resolved.
+"""
+from flask import session
+
+ROLES = ('artist', 'manager', 'content_moderator', 'basic')
+
+ROLE_JOINS = '''
+    LEFT JOIN artist_user au ON au.username = u.username
+    LEFT JOIN manager_user mu ON mu.username = u.username
+    LEFT JOIN content_moderator_user cm ON cm.username = u.username
+'''
+
+ROLE_CASE = '''
+    CASE
+        WHEN au.username IS NOT NULL THEN 'artist'
+        WHEN mu.username IS NOT NULL THEN 'manager'
+        WHEN cm.username IS NOT NULL THEN 'content_moderator'
+        ELSE 'basic'
+    END
+'''
+
+LOGIN_SQL = f'''
+    SELECT u.username, u.full_name, u.email, u.password_hash, {ROLE_CASE} AS user_type
+    FROM users u
+    {ROLE_JOINS}
+    WHERE u.email = %s
+'''
+
+ROLE_SQL = f'''
+    SELECT {ROLE_CASE} AS user_type
+    FROM users u
+    {ROLE_JOINS}
+    WHERE u.username = %s
+'''
+
+# user row, role, type-specific row and an artist's songs in one round trip
+PROFILE_SQL = f'''
+    SELECT to_jsonb(u) AS user,
+           {ROLE_CASE} AS user_type,
+           COALESCE(to_jsonb(au), to_jsonb(mu), to_jsonb(cm), to_jsonb(bu), '{{}}'::jsonb) AS type_info,
+           CASE WHEN au.username IS NULL THEN '[]'::jsonb ELSE (
+               SELECT COALESCE(jsonb_agg(jsonb_build_object('song_id', s.song_id, 'name', s.name)
+                                         ORDER BY s.name), '[]'::jsonb)
+               FROM song s
+               JOIN song_artist_user sau ON s.song_id = sau.song_id
+               WHERE sau.username = u.username
+           ) END AS artist_songs
+    FROM users u
+    {ROLE_JOINS}
+    LEFT JOIN basic_user bu ON bu.username = u.username
+    WHERE u.username = %s
+'''
+
+
+def find_login(conn, email):
+    """User row with ``user_type`` for the login form, or None"""
+    cur = conn.cursor()
+    cur.execute(LOGIN_SQL, (email,))
+    return cur.fetchone()
+
+
+def load_profile(conn, username):
+    """(user, user_type, type_info, artist_songs), or None for an unknown user"""
+    cur = conn.cursor()
+    cur.execute(PROFILE_SQL, (username,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row['user'], row['user_type'], row['type_info'], row['artist_songs']
+
+
+def current_role(conn):
+    """The logged-in user's role, resolved once and then cached in the session"""
+    if 'username' not in session:
+        return None
+    if session.get('user_type') not in ROLES:
+        cur = conn.cursor()
+        cur.execute(ROLE_SQL, (session['username'],))
+        row = cur.fetchone()
+        session['user_type'] = row['user_type'] if row else 'basic'
+    return session['user_type']
+
+
+def invalidate_role():
+    """Forget the cached role; the next current_role() call re-resolves it"""
+    session.pop('user_type', None)
@@ -0,0 +1,51 @@
+"""Ranked search across artists, songs, events and playlists.
+
+Reads the ``search_document`` table from migration 0002: full-text matches
+(with prefix matching on every term) and trigram word similarity on titles,
+so "beatls" still finds "The Beatles", ranked together in one query.
+"""
+import re
+
+from psycopg2.extras import RealDictCursor
+
+ENTITY_TYPES = ('artist', 'song', 'event', 'playlist')
+PER_PAGE = 20
+MAX_PAGE = 50
+
+SEARCH_SQL = '''
+    SELECT d.entity_type, d.entity_id, d.title, d.subtitle,
+           ts_rank_cd(d.document, to_tsquery('simple', %(tsquery)s))
+             + word_similarity(%(raw)s, d.title) AS rank
+    FROM search_document d
+    WHERE (d.document @@ to_tsquery('simple', %(tsquery)s) OR %(raw)s <%% d.title)
+      AND (%(entity_type)s::varchar IS NULL OR d.entity_type = %(entity_type)s)
+    ORDER BY rank DESC, d.entity_type, d.entity_id
+    LIMIT %(limit)s OFFSET %(offset)s
+'''
+
+
+def to_prefix_tsquery(text):
+    """'abbey ro' -> 'abbey:* & ro:*'; only word characters reach to_tsquery"""
+    words = re.findall(r'\w+', text.lower())
+    return ' & '.join(f'{word}:*' for word in words)
+
+
+def search(conn, text, entity_type=None, page=1, per_page=PER_PAGE):
+    """One page of ranked results and whether another page follows"""
+    tsquery = to_prefix_tsquery(text)
+    if not tsquery:
+        return [], False
+    if entity_type not in ENTITY_TYPES:
+        entity_type = None
+    page = max(1, min(page, MAX_PAGE))
+
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(SEARCH_SQL, {
+        'tsquery': tsquery,
+        'raw': text,
+        'entity_type': entity_type,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    })
+    rows = cur.fetchall()
+    return rows[:per_page], len(rows) > per_page
@@ -0,0 +1,125 @@
+"""Production launcher: gunicorn with a preloaded app, configured from the environment.
+
+    python serve.py [--bind 0.0.0.0:8000] [--workers N] [--threads N]
+
+The app is imported and every template loaded once in the master (from the
+bytecode cache, see templating.py), then forked into ``WEB_WORKERS``
+workers (default: one per core) with ``WEB_THREADS`` threads each. Each worker opens its own connection pools
+(``DB_POOL_MAX`` defaults to the thread count plus ``BACKGROUND_THREADS``) and fills them before it
+accepts requests. Workers are recycled after ``WEB_MAX_REQUESTS`` requests
+(plus up to ``WEB_MAX_REQUESTS_JITTER`` so they do not restart together).
+
+Signals to the master: HUP starts fresh workers and lets the old ones
+finish their requests; TERM shuts down gracefully. Because the app is
+preloaded, deploying new code needs USR2 (start a new master) and then
+TERM to the old master.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+import psycopg2
+from gunicorn.app.base import BaseApplication
+
+log = logging.getLogger('serve')
+
+# threads per worker that take connections from the same pool as the request threads: summary_refresher,
+# neighbour_refresher, report_refresher and channel_directory (a refresh can hold its connection for seconds)
+BACKGROUND_THREADS = 4
+
+
+# ==================== GUNICORN HOOKS ====================
+
+
+def when_ready(server):
+    server.log.info('master %s ready, %s workers x %s threads',
+                    os.getpid(), server.cfg.workers, server.cfg.threads)
+
+
+def post_fork(server, worker):
+    """Per-worker state: connection pools are opened here, never in the master"""
+    import app as web
+
+    start = time.perf_counter()
+    try:
+        web.db_pool.prefill()
+        for replica in web.db_router.replicas:
+            replica.prefill()
+    except psycopg2.Error as e:
+        # the worker still starts; pools connect on the first request instead
+        server.log.warning('worker %s could not prefill the pool: %s', worker.pid, e)
+    web.summary_refresher.start()
+    web.neighbour_refresher.start()
+    web.report_refresher.start()
+    web.channel_directory.start()
+    server.log.info('worker %s warmed up in %.0f ms', worker.pid, (time.perf_counter() - start) * 1000)
+
+
+def worker_exit(server, worker):
+    import app as web
+
+    web.db_pool.closeall()
+    for replica in web.db_router.replicas:
+        replica.closeall()
+    web.password_hasher.shutdown()
+
+
+class Launcher(BaseApplication):
+    """gunicorn application serving an already imported WSGI app"""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def options_from_env(bind=None, workers=None, threads=None):
+    threads = threads or int(os.getenv('WEB_THREADS', 4))
+    return {
+        'bind': bind or os.getenv('WEB_BIND', '0.0.0.0:8000'),
+        'workers': workers or int(os.getenv('WEB_WORKERS', 0)) or multiprocessing.cpu_count(),
+        'threads': threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'max_requests': int(os.getenv('WEB_MAX_REQUESTS', 1000)),
+        'max_requests_jitter': int(os.getenv('WEB_MAX_REQUESTS_JITTER', 100)),
+        'timeout': int(os.getenv('WEB_TIMEOUT', 30)),
+        'graceful_timeout': int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(os.getenv('WEB_KEEPALIVE', 5)),
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bind')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    options = options_from_env(args.bind, args.workers, args.threads)
+    # every thread may hold a connection; the pools are sized before app.py builds them
+    os.environ.setdefault('DB_POOL_MAX', str(options['threads'] + BACKGROUND_THREADS))
+
+    import app as web
+    import templating
+
+    count, seconds = templating.compile_all(web.app.jinja_env)
+    log.info('loaded %d templates in %.0f ms', count, seconds * 1000)
+    Launcher(web.app, options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Homepage statistics with a TTL cache.
+
+All four counts are fetched in one round trip. When the optional
+``counters.sql`` triggers are installed (STATS_USE_COUNTERS=1) the counts
+are read from the ``table_counter`` rows instead of scanning the tables.
+"""
+import os
+import threading
+import time
+
+STAT_TABLES = {
+    'users': 'users',
+    'artists': 'artist_user',
+    'songs': 'song',
+    'events': 'event',
+}
+
+COUNT_SQL = 'SELECT ' + ',\n       '.join(
+    f'(SELECT COUNT(*) FROM {table}) AS {key}' for key, table in STAT_TABLES.items()
+)
+
+COUNTER_SQL = 'SELECT ' + ',\n       '.join(
+    f"COALESCE(MAX(row_count) FILTER (WHERE table_name = '{table}'), 0) AS {key}"
+    for key, table in STAT_TABLES.items()
+) + '\nFROM table_counter'
+
+
+class StatsCache:
+    """Caches the homepage counts for ``ttl`` seconds"""
+
+    def __init__(self, ttl=60.0, use_counters=False):
+        self.ttl = ttl
+        self.use_counters = use_counters
+        self._lock = threading.Lock()
+        self._stats = None
+        self._expires = 0.0
+
+    def cached(self):
+        """Cached counts, or None when they have expired"""
+        with self._lock:
+            if self._stats is not None and time.monotonic() < self._expires:
+                return dict(self._stats)
+        return None
+
+    @property
+    def sql(self):
+        return COUNTER_SQL if self.use_counters else COUNT_SQL
+
+    def store(self, row):
+        """Cache the row fetched with :attr:`sql`"""
+        stats = {key: int(value) for key, value in row.items()}
+        with self._lock:
+            self._stats = stats
+            self._expires = time.monotonic() + self.ttl
+        return dict(stats)
+
+    def get(self, connect):
+        """Return cached counts, querying ``connect()`` when stale.
+
+        The caller passes the primary: invalidate() follows writes, and a
+        replica behind them would be cached for the whole TTL.
+        """
+        stats = self.cached()
+        if stats is not None:
+            return stats
+
+        cur = connect().cursor()
+        cur.execute(self.sql)
+        return self.store(cur.fetchone())
+
+    def invalidate(self):
+        """Drop the cached counts after a write that changes them"""
+        with self._lock:
+            self._stats = None
+            self._expires = 0.0
+
+
+def stats_from_env():
+    return StatsCache(
+        ttl=float(os.getenv('STATS_TTL', 60)),
+        use_counters=os.getenv('STATS_USE_COUNTERS', '0') == '1',
+    )
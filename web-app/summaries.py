@@ -0,0 +1,31 @@
+"""Background refresh of the catalogue summary tables (migration 0005).
+
+Triggers keep ``song_summary`` and ``artist_summary`` current on every
+write, but ``artist_summary.next_event_date`` also changes when an event
+simply passes. :class:`SummaryRefresher` runs ``artist_summary_expire()``
+every ``interval`` seconds in a daemon thread of each worker process.
+"""
+import os
+
+import db
+
+
+class SummaryRefresher(db.Refresher):
+    name = 'summary-refresher'
+
+    def __init__(self, pool, interval=3600.0):
+        super().__init__(pool, interval)
+
+    def run_once(self):
+        """Refresh artists whose next event has passed; returns how many"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT artist_summary_expire() AS expired')
+            expired = cur.fetchone()['expired']
+            conn.commit()
+            return expired
+
+
+def refresher_from_env(pool):
+    """SUMMARY_REFRESH_INTERVAL in seconds, 0 disables the thread"""
+    return SummaryRefresher(pool, interval=float(os.getenv('SUMMARY_REFRESH_INTERVAL', 3600)))
@@ -0,0 +1,77 @@
+"""Production Jinja setup: on-disk bytecode cache and ahead-of-time compilation.
+
+Templates are compiled to Python bytecode once and stored in
+``JINJA_CACHE_DIR`` (default ``web-app/.jinja_cache``), so new processes
+skip parsing and code generation. Template files are not re-checked on
+every render unless ``JINJA_AUTO_RELOAD=1`` (or the app runs in debug).
+
+    python templating.py build      # at build/deploy time: compile every template into the cache
+    python templating.py clear
+"""
+import argparse
+import os
+import sys
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jinja_cache')
+
+
+def cache_dir():
+    return os.getenv('JINJA_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def bytecode_cache(directory, is_async=False):
+    # an async environment (Quart, asgi.py) compiles templates to different code: keep it in files of its own
+    return FileSystemBytecodeCache(directory, '%s.async.jinja.cache' if is_async else '%s.jinja.cache')
+
+
+def init_app(app):
+    """Attach the bytecode cache; call before the first render"""
+    auto_reload = os.getenv('JINJA_AUTO_RELOAD')
+    if auto_reload is not None:
+        app.config['TEMPLATES_AUTO_RELOAD'] = auto_reload == '1'
+    # otherwise left at None: Flask then follows app.debug, also when it is set later (app.run(debug=True))
+    directory = cache_dir()
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = bytecode_cache(directory, app.jinja_env.is_async)
+    if auto_reload is not None:
+        app.jinja_env.auto_reload = app.config['TEMPLATES_AUTO_RELOAD']
+
+
+def compile_all(env):
+    """Load every template (filling the bytecode cache); returns (count, seconds)"""
+    start = time.perf_counter()
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    return len(names), time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['build', 'clear'])
+    args = parser.parse_args(argv)
+
+    # no database or secrets are needed to compile templates
+    from flask import Flask
+
+    app = Flask(__name__)
+    init_app(app)
+    if args.command == 'clear':
+        app.jinja_env.bytecode_cache.clear()
+        print(f'cleared {cache_dir()}')
+        return 0
+    app.jinja_env.bytecode_cache.clear()
+    count, seconds = compile_all(app.jinja_env)
+    print(f'compiled {count} templates into {cache_dir()} in {seconds * 1000:.0f} ms')
+    async_env = app.jinja_env.overlay(enable_async=True, bytecode_cache=bytecode_cache(cache_dir(), True))
+    count, seconds = compile_all(async_env)
+    print(f'compiled {count} async templates (asgi.py) in {seconds * 1000:.0f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
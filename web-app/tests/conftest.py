@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app's modules are imported top-level (``import db``), as when run from web-app/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,71 @@
+from flask import Flask, g
+from psycopg2 import extensions
+
+import instrumentation
+
+
+class FakeConnection:
+    """Only what _log_slow reads before EXPLAIN; EXPLAIN itself would fail on it"""
+
+    autocommit = False
+    server_version = 160000
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor:
+    connection = FakeConnection()
+
+
+INSERTED = b'''
+    INSERT INTO merchandise_product (username, product_name, product_price)
+    VALUES (1,'card 4111 1111 1111 1111',9.5),(2,'it''s (a) "test", ok',E'\\\\'),
+           (3,'x',1) ON CONFLICT DO NOTHING
+'''
+
+
+def test_numbered_positional():
+    assert instrumentation._numbered('SELECT * FROM song WHERE song_id = %s AND name = %s') == \
+        'SELECT * FROM song WHERE song_id = $1 AND name = $2'
+
+
+def test_numbered_named_reuses_numbers():
+    statement = 'SELECT %(a)s, %(b)s, %(a)s WHERE x LIKE %s'
+    assert instrumentation._numbered(statement) == 'SELECT $1, $2, $1 WHERE x LIKE $3'
+
+
+def test_numbered_unescapes_percent():
+    assert instrumentation._numbered("SELECT 'a%%' || %s") == "SELECT 'a%' || $1"
+
+
+def test_elide_values_keeps_the_statement_shape():
+    statement = instrumentation._statement(FakeCursor(), INSERTED, None)
+    assert statement == ('INSERT INTO merchandise_product (username, product_name, product_price) '
+                         'VALUES (...) /* 3 rows */ ON CONFLICT DO NOTHING')
+
+
+def test_elide_values_in_a_subquery():
+    statement = ("UPDATE song_playlist sp SET position = v.position - 3 "
+                 "FROM (VALUES (10,1),(11,2)) AS v(song_id, position) WHERE sp.song_id = v.song_id")
+    assert instrumentation._elide_values(statement) == (
+        'UPDATE song_playlist sp SET position = v.position - 3 '
+        'FROM (VALUES (...) /* 2 rows */) AS v(song_id, position) WHERE sp.song_id = v.song_id')
+
+
+def test_parameterized_statements_are_kept():
+    statement = 'INSERT INTO playlist (username, description) VALUES (%s, %s)'
+    assert instrumentation._statement(FakeCursor(), statement, ('1', 'd')) == statement
+
+
+def test_record_and_slow_log_leave_out_inlined_values(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'SLOW_QUERY_MS', 0)
+    app = Flask(__name__)
+    with app.test_request_context('/'):
+        instrumentation._record(FakeCursor(), INSERTED, None, 0.5)
+        (statement, _), = g.sql['statements']
+    slow = instrumentation.slow_queries[-1]
+    for text in (statement, slow['query']):
+        assert '4111' not in text
+        assert 'VALUES (...) /* 3 rows */' in text
+    assert slow['plan'] is None